@@ -0,0 +1,338 @@
+"""Answers the README questions locally from the tables in processed_data/, without a
+round trip to GCS and BigQuery.
+
+`get_warehouse('auto')` loads the files into in-memory DuckDB tables when DuckDB is
+installed. Otherwise it loads the few tables the questions need into memory, indexed on
+activity_id, and answers them with hash joins in plain Python. Both engines give the
+same rows:
+
+    python analytics.py --directory processed_data --engine python
+
+Each table is read from its top-level file (`lap_data.csv`, `.csv.gz` or `.parquet`). If
+there is none, its shards under `lap_data/` are read: those of the latest full run, and of
+every incremental run after it, as the `run-<run id>.json` files tell them apart. Failing
+that, the incremental deltas `lap_data-<run id>.*` are read. Across incremental runs, the
+latest run that contains an activity replaces its earlier rows, as the loader does.
+"""
+import argparse
+import csv
+import gzip
+import json
+import time
+from pathlib import Path
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+from tables import TABLES, coerce
+from writers import pq
+
+
+SPECS = {spec.name: spec for spec in TABLES}
+EXTENSIONS = ('csv', 'csv.gz', 'parquet')
+DUCKDB_TYPES = {'STRING': 'VARCHAR', 'INTEGER': 'BIGINT', 'FLOAT': 'DOUBLE', 'DATE': 'DATE'}
+
+# Tables the three questions read
+QUESTION_TABLES = ('activity_data', 'lap_data', 'step_data')
+
+
+def _extension(path):
+    return path.name.partition('.')[2]
+
+
+def run_mode(directory, run_id):
+    """'full' or 'incremental', from the run-<run id>.json the import wrote next to the tables"""
+    path = Path(directory) / f"run-{run_id}.json"
+    if not path.exists():
+        return 'full'
+    with open(path) as run_file:
+        return json.load(run_file).get('mode', 'full')
+
+
+def _shard_run(path):
+    """Run id of a shard named <run id>-<index>.*"""
+    return path.name.split('-')[0]
+
+
+def table_files(directory, table_name):
+    """(paths, runs) of a table in directory, in run order. runs is None when the paths hold
+    one snapshot of the table, else the run id of each path: incremental runs, where a
+    later run replaces the rows of the activities it contains"""
+    directory = Path(directory)
+    for extension in EXTENSIONS:
+        path = directory / f"{table_name}.{extension}"
+        if path.exists():
+            return [path], None
+    shard_directory = directory / table_name
+    if shard_directory.is_dir():
+        shards = sorted(path for path in shard_directory.iterdir() if _extension(path) in EXTENSIONS)
+        if shards:
+            runs = sorted({_shard_run(path) for path in shards})
+            full = [run_id for run_id in runs if run_mode(directory, run_id) == 'full']
+            #A full run replaces every run before it, and the incremental runs after it are its deltas
+            if full:
+                runs = runs[runs.index(full[-1]):]
+            paths = [path for path in shards if _shard_run(path) in runs]
+            if runs == full[-1:]:
+                return paths, None
+            return paths, [_shard_run(path) for path in paths]
+    deltas = sorted(path for path in directory.glob(f"{table_name}-*") if _extension(path) in EXTENSIONS)
+    if deltas:
+        return deltas, [path.name[len(table_name) + 1:].partition('.')[0] for path in deltas]
+    raise FileNotFoundError(f"No {table_name} files in {directory}")
+
+
+def read_rows(path, spec):
+    """Rows of one csv or Parquet table file, coerced to the spec's column types"""
+    if _extension(path) == 'parquet':
+        if pq is None:
+            raise ImportError("pyarrow is required to read parquet files: pip install pyarrow")
+        return pq.read_table(path).to_pylist()
+    types = {field.name: field.type for field in spec.fields}
+    opener = gzip.open if _extension(path) == 'csv.gz' else open
+    with opener(path, 'rt', newline='', encoding='utf-8') as csv_file:
+        return [{name: coerce(types[name], value) if value != '' else None for name, value in row.items()}
+                for row in csv.DictReader(csv_file)]
+
+
+def load_table(directory, table_name):
+    paths, runs = table_files(directory, table_name)
+    spec = SPECS[table_name]
+    if runs is None:
+        return [row for path in paths for row in read_rows(path, spec)]
+    #(run id, rows) of each activity; the paths come in run order, so a later run replaces the rows
+    by_activity = {}
+    for path, run_id in zip(paths, runs):
+        for row in read_rows(path, spec):
+            latest = by_activity.get(row["activity_id"])
+            if latest is None or latest[0] != run_id:
+                by_activity[row["activity_id"]] = latest = (run_id, [])
+            latest[1].append(row)
+    return [row for _, rows in by_activity.values() for row in rows]
+
+
+def _user_order(row):
+    return row["user_id"] is None, row["user_id"] or ''
+
+
+def _total(values):
+    """SUM: None when there is nothing to add up"""
+    values = [value for value in values if value is not None]
+    return sum(values) if values else None
+
+
+class PythonWarehouse:
+    """The question tables held in memory: activities indexed by activity_id and laps and
+    steps grouped by it, so every question is a hash join"""
+
+    name = 'python'
+
+    def __init__(self, directory='./processed_data'):
+        self.activities = {row["activity_id"]: row for row in load_table(directory, 'activity_data')}
+        self.laps = {}
+        for row in load_table(directory, 'lap_data'):
+            self.laps.setdefault(row["activity_id"], []).append(row)
+        self.steps = load_table(directory, 'step_data')
+
+    def pace_target_delta(self):
+        """Question 1: each user's average of pace_average_mps - pace_average_text over PACE steps"""
+        diffs = {}
+        for step in self.steps:
+            activity = self.activities.get(step["activity_id"])
+            if activity is None or step["target_type"] != 'PACE':
+                continue
+            user_diffs = diffs.setdefault(activity["user_id"], [])
+            if step["pace_average_mps"] is not None and step["pace_average_text"] is not None:
+                user_diffs.append(step["pace_average_mps"] - step["pace_average_text"])
+        rows = [{"user_id": user_id, "avg_pace_diff": sum(values) / len(values) if values else None}
+                for user_id, values in diffs.items()]
+        return sorted(rows, key=_user_order)
+
+    def _runs(self):
+        """(activity, lap distance total, lap total_time total) of every activity with laps"""
+        for activity_id, laps in self.laps.items():
+            activity = self.activities.get(activity_id)
+            if activity is not None:
+                yield (activity, _total(lap["distance"] for lap in laps),
+                       _total(lap["total_time"] for lap in laps))
+
+    def weekly_distance(self):
+        """Question 2: each user's lap distance per week of plan against the previous week"""
+        weeks = {}
+        for activity, distance, _ in self._runs():
+            week = weeks.setdefault((activity["user_id"], activity["week_of_plan"]), {"activities": 0, "distances": []})
+            week["activities"] += 1
+            if distance is not None:
+                week["distances"].append(distance)
+
+        rows = []
+        for (user_id, week_of_plan), week in weeks.items():
+            total = _total(week["distances"])
+            previous = None
+            if user_id is not None and week_of_plan is not None and (user_id, week_of_plan - 1) in weeks:
+                previous = _total(weeks[(user_id, week_of_plan - 1)]["distances"])
+            rows.append({
+                "user_id": user_id,
+                "week_of_plan": week_of_plan,
+                "activities": week["activities"],
+                "total_distance": total,
+                "previous_week_distance": previous,
+                "distance_change": total - previous if total is not None and previous is not None else None,
+            })
+        return sorted(rows, key=lambda row: _user_order(row) + (row["week_of_plan"] is None, row["week_of_plan"] or 0))
+
+    def workout_comparison(self):
+        """Question 3: every activity of each workout ranked by average speed, fastest first"""
+        workouts = {}
+        for activity, distance, total_time in self._runs():
+            if activity["workout_id"] is None:
+                continue
+            speed = distance / (total_time / 1000) if distance is not None and total_time else None
+            workouts.setdefault(activity["workout_id"], []).append({
+                "workout_id": activity["workout_id"],
+                "user_id": activity["user_id"],
+                "activity_id": activity["activity_id"],
+                "total_distance": distance,
+                "total_time": total_time,
+                "average_speed_mps": speed,
+            })
+
+        rows = []
+        for workout_id in sorted(workouts):
+            ranked = sorted(workouts[workout_id], key=lambda row: (row["average_speed_mps"] is None,
+                                                                   -(row["average_speed_mps"] or 0),
+                                                                   row["activity_id"]))
+            rows.extend(dict(row, rank=rank) for rank, row in enumerate(ranked, 1))
+        return rows
+
+
+class DuckDbWarehouse:
+    """The question tables read once into an in-memory DuckDB database, so each question
+    is a columnar query rather than a rescan of the files"""
+
+    name = 'duckdb'
+
+    PACE_TARGET_DELTA = """
+        SELECT a.user_id, AVG(s.pace_average_mps - s.pace_average_text) AS avg_pace_diff
+        FROM step_data s JOIN activity_data a USING (activity_id)
+        WHERE s.target_type = 'PACE'
+        GROUP BY a.user_id
+        ORDER BY a.user_id NULLS LAST"""
+
+    WEEKLY_DISTANCE = """
+        WITH weeks AS (
+            SELECT a.user_id, a.week_of_plan, COUNT(DISTINCT a.activity_id) AS activities,
+                   SUM(l.distance) AS total_distance
+            FROM activity_data a JOIN lap_data l USING (activity_id)
+            GROUP BY a.user_id, a.week_of_plan)
+        SELECT w.user_id, w.week_of_plan, w.activities, w.total_distance,
+               p.total_distance AS previous_week_distance,
+               w.total_distance - p.total_distance AS distance_change
+        FROM weeks w
+        LEFT JOIN weeks p ON p.user_id = w.user_id AND p.week_of_plan = w.week_of_plan - 1
+        ORDER BY w.user_id NULLS LAST, w.week_of_plan NULLS LAST"""
+
+    WORKOUT_COMPARISON = """
+        WITH runs AS (
+            SELECT a.workout_id, a.user_id, a.activity_id,
+                   SUM(l.distance) AS total_distance, SUM(l.total_time) AS total_time
+            FROM activity_data a JOIN lap_data l USING (activity_id)
+            WHERE a.workout_id IS NOT NULL
+            GROUP BY a.workout_id, a.user_id, a.activity_id),
+        speeds AS (
+            SELECT *, total_distance / (NULLIF(total_time, 0) / 1000) AS average_speed_mps FROM runs)
+        SELECT workout_id, user_id, activity_id, total_distance, total_time, average_speed_mps,
+               ROW_NUMBER() OVER (PARTITION BY workout_id
+                                  ORDER BY average_speed_mps DESC NULLS LAST, activity_id) AS rank
+        FROM speeds
+        ORDER BY workout_id, rank"""
+
+    def __init__(self, directory='./processed_data'):
+        if duckdb is None:
+            raise ImportError("duckdb is required for the duckdb engine: pip install duckdb")
+        self.connection = duckdb.connect()
+        for table_name in QUESTION_TABLES:
+            self.connection.execute(f"CREATE TABLE {table_name} AS {self._select(directory, table_name)}")
+
+    def _select(self, directory, table_name):
+        paths, runs = table_files(directory, table_name)
+        spec = SPECS[table_name]
+        sources = []
+        csv_paths = [str(path) for path in paths if _extension(path) != 'parquet']
+        parquet_paths = [str(path) for path in paths if _extension(path) == 'parquet']
+        if csv_paths:
+            columns = ", ".join(f"'{field.name}': '{DUCKDB_TYPES[field.type]}'" for field in spec.fields)
+            sources.append(f"SELECT * FROM read_csv({csv_paths!r}, header = true, columns = {{{columns}}}, "
+                           f"filename = true)")
+        if parquet_paths:
+            sources.append(f"SELECT * FROM read_parquet({parquet_paths!r}, filename = true)")
+        select = " UNION ALL BY NAME ".join(sources)
+        if runs is not None:
+            #Run ids sort in run order, so the latest run holding an activity wins
+            values = ", ".join(f"('{path}', '{run_id}')" for path, run_id in zip(paths, runs))
+            select = (f"SELECT * FROM ({select}) JOIN (VALUES {values}) AS runs(filename, run_id) USING (filename) "
+                      f"QUALIFY run_id = max(run_id) OVER (PARTITION BY activity_id)")
+        return select
+
+    def _query(self, sql):
+        cursor = self.connection.execute(sql)
+        names = [column[0] for column in cursor.description]
+        return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def pace_target_delta(self):
+        return self._query(self.PACE_TARGET_DELTA)
+
+    def weekly_distance(self):
+        return self._query(self.WEEKLY_DISTANCE)
+
+    def workout_comparison(self):
+        return self._query(self.WORKOUT_COMPARISON)
+
+
+WAREHOUSES = {'duckdb': DuckDbWarehouse, 'python': PythonWarehouse}
+
+
+def get_warehouse(engine='auto', directory='./processed_data'):
+    """Warehouse over directory by engine name; 'auto' is duckdb when installed, else python"""
+    if engine == 'auto':
+        engine = 'duckdb' if duckdb is not None else 'python'
+    try:
+        warehouse_class = WAREHOUSES[engine]
+    except KeyError:
+        raise ValueError(f"Unknown engine {engine}, expected 'auto' or one of {sorted(WAREHOUSES)}")
+    return warehouse_class(directory)
+
+
+QUESTIONS = ('pace_target_delta', 'weekly_distance', 'workout_comparison')
+
+
+def answer_questions(warehouse):
+    """{question: {"rows": [...], "milliseconds": ...}} for the three README questions"""
+    answers = {}
+    for question in QUESTIONS:
+        started = time.perf_counter()
+        rows = getattr(warehouse, question)()
+        answers[question] = {"rows": rows, "milliseconds": round((time.perf_counter() - started) * 1000, 3)}
+    return answers
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Answer the README questions from the local processed tables")
+    parser.add_argument('--directory', default='./processed_data')
+    parser.add_argument('--engine', default='auto', choices=['auto'] + sorted(WAREHOUSES))
+    args = parser.parse_args(argv)
+
+    try:
+        started = time.perf_counter()
+        warehouse = get_warehouse(args.engine, args.directory)
+        load_milliseconds = round((time.perf_counter() - started) * 1000, 3)
+        result = dict(engine=warehouse.name, load_milliseconds=load_milliseconds, **answer_questions(warehouse))
+        print(json.dumps(result, indent=2, default=str))
+    except Exception as e:
+        print(f"Failed to answer questions from {args.directory}: {e}")
+
+
+if __name__ == "__main__":
+    main()
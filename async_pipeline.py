@@ -0,0 +1,218 @@
+"""Asyncio pipeline mode: reading, extraction, writing and upload run as concurrent stages
+joined by bounded queues.
+
+    reader -> [files] -> extractors -> [row batches] -> writer -> [finished files] -> uploaders
+
+Each stage hands its blocking work to an executor, so the event loop keeps the other
+stages moving. Flattening is CPU-bound and would hold the GIL against the writer, so on
+machines with CPUs to spare it runs on a pool of worker processes. Their results are
+queued as futures in file order, so the rows come out in the same order as the serial path. Reads and writes each get
+one thread, and uploads go through the shared GcsUploader. A full queue makes the stage
+before it wait, so at most `queue_size` files and flattened activities are held at any
+time, and no more than `queue_size` finished files wait for an upload slot.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+_DONE = object()
+
+
+def _read_bytes(path):
+    with open(path, 'rb') as json_file:
+        return json_file.read()
+
+
+class Records(list):
+    """Row tuples in field order, as ExtractionEngine emits them to writerecords()"""
+
+
+class BufferSink:
+    """Keeps the records, or column batches, the engine emits for one activity until the writer stage takes them"""
+
+    def __init__(self):
+        self.batches = []
+
+    def writerecords(self, records):
+        self.batches.append(Records(records))
+
+    def write_columns(self, batch):
+        self.batches.append(batch)
+
+
+def _added(totals, counts):
+    """totals with counts added key by key; either may be None"""
+    if counts is None:
+        return totals
+    if totals is None:
+        totals = dict.fromkeys(counts, 0)
+    for key, value in counts.items():
+        totals[key] += value
+    return totals
+
+
+def flatten(engine, activity):
+    """Runs engine over one activity into buffers and returns ({table: batches}, stats of this call)"""
+    engine.stats = {spec.name: {"rows_out": 0, "failures": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0}
+                    for spec in engine.specs}
+    sinks = {spec.name: BufferSink() for spec in engine.specs}
+    engine.run([activity], sinks)
+    return {name: sink.batches for name, sink in sinks.items()}, engine.stats
+
+
+class AsyncPipeline:
+    """Flattens json_files with `flatten_file(content)`, which returns ({table: batches},
+    per-table stats, waypoint reduction counts or None[, step template cache counts or
+    None]) and must be picklable when
+    extract_workers > 0. Each table is written to paths[table name] through
+    make_writer(path, spec) as extract_tables does, and every finished file is uploaded
+    with `upload(path)`, which returns a concurrent future. Shards report themselves
+    finished by being appended to `closed` as they close, and `outputs` lists the
+    whole-table files to upload once every writer is closed. With extract_workers=0,
+    flattening runs on a single thread in this process instead; the default is one
+    worker process per CPU beyond the one the writer needs"""
+
+    def __init__(self, flatten_file, specs, paths, make_writer, upload, closed=None, outputs=(),
+                 queue_size=8, upload_slots=4, extract_workers=None):
+        self.flatten_file = flatten_file
+        self.specs = list(specs)
+        self.paths = paths
+        self.make_writer = make_writer
+        self.writers = {}
+        self._writers_closed = False
+        self.upload = upload
+        self.closed = closed if closed is not None else []
+        self._handed_over = 0
+        self.outputs = list(outputs)
+        self.queue_size = queue_size
+        self.upload_slots = upload_slots
+        if extract_workers is None:
+            extract_workers = min(4, (os.cpu_count() or 1) - 1)
+        self.extract_workers = extract_workers
+        self.visited = 0
+        # Per-table rows out, failures and flattening time, as in ExtractionEngine.stats
+        self.table_stats = {spec.name: {"rows_out": 0, "failures": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0}
+                            for spec in self.specs}
+        self.reduction = None
+        self.templates = None
+        # Seconds each stage spent on its own work; extraction is summed over its workers
+        self.stats = {"read": 0.0, "extract": 0.0, "write": 0.0, "upload": 0.0}
+
+    def run(self, json_files):
+        """Runs the whole pipeline and returns the number of activities visited"""
+        try:
+            for spec in self.specs:
+                self.writers[spec.name] = self.make_writer(self.paths[spec.name], spec)
+            return asyncio.run(self._run(json_files))
+        finally:
+            if not self._writers_closed:
+                self._close_writers()
+
+    def _extract_executor(self):
+        if self.extract_workers > 0:
+            return ProcessPoolExecutor(self.extract_workers)
+        return ThreadPoolExecutor(1, 'pipeline-extract')
+
+    async def _run(self, json_files):
+        files = asyncio.Queue(self.queue_size)
+        batches = asyncio.Queue(self.queue_size)
+        finished = asyncio.Queue(self.queue_size)
+        with ThreadPoolExecutor(1, 'pipeline-read') as reader, self._extract_executor() as extractor, \
+                ThreadPoolExecutor(1, 'pipeline-write') as writer:
+            tasks = [asyncio.create_task(self._read(json_files, files, reader)),
+                     asyncio.create_task(self._extract(files, batches, extractor)),
+                     asyncio.create_task(self._write(batches, finished, writer))]
+            tasks += [asyncio.create_task(self._upload(finished)) for _ in range(self.upload_slots)]
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in pending:
+                task.cancel()
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+        return self.visited
+
+    async def _timed(self, stage, executor, function, *args):
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+        finally:
+            self.stats[stage] += time.perf_counter() - started
+
+    async def _read(self, json_files, files, executor):
+        for path in json_files:
+            await files.put(await self._timed('read', executor, _read_bytes, path))
+        await files.put(_DONE)
+
+    async def _extract(self, files, batches, executor):
+        """Submits every file as soon as it is read; the futures queue up in file order"""
+        loop = asyncio.get_running_loop()
+        while True:
+            content = await files.get()
+            if content is _DONE:
+                await batches.put(_DONE)
+                return
+            await batches.put(loop.run_in_executor(executor, self.flatten_file, content))
+
+    def _count(self, stats, reduction, templates=None):
+        self.visited += 1
+        for name, table_stats in stats.items():
+            for key, value in table_stats.items():
+                self.table_stats[name][key] += value
+            self.stats["extract"] += table_stats["wall_seconds"]
+        self.reduction = _added(self.reduction, reduction)
+        self.templates = _added(self.templates, templates)
+
+    def _write_batches(self, tables):
+        for name, table_batches in tables.items():
+            writer = self.writers[name]
+            try:
+                for batch in table_batches:
+                    if isinstance(batch, Records):
+                        writer.writerecords(batch)
+                    elif isinstance(batch, list):
+                        writer.writerows(batch)
+                    elif hasattr(writer, 'write_columns'):
+                        writer.write_columns(batch)
+                    else:
+                        writer.writerows(batch.rows())
+            except Exception as e:
+                self.table_stats[name]["failures"] += 1
+                print(f"Failed to write {name} :{e}")
+
+    def _close_writers(self):
+        self._writers_closed = True
+        for writer in self.writers.values():
+            writer.close()
+
+    async def _hand_over_closed(self, finished):
+        """Queues the shards that closed during the last write for upload"""
+        while self._handed_over < len(self.closed):
+            self._handed_over += 1
+            await finished.put(self.closed[self._handed_over - 1])
+
+    async def _write(self, batches, finished, executor):
+        while True:
+            flattened = await batches.get()
+            if flattened is _DONE:
+                break
+            tables, stats, *counts = await flattened
+            self._count(stats, *counts)
+            await self._timed('write', executor, self._write_batches, tables)
+            await self._hand_over_closed(finished)
+        await self._timed('write', executor, self._close_writers)
+        await self._hand_over_closed(finished)
+        for path in self.outputs:
+            await finished.put(path)
+        for _ in range(self.upload_slots):
+            await finished.put(_DONE)
+
+    async def _upload(self, finished):
+        while True:
+            path = await finished.get()
+            if path is _DONE:
+                return
+            started = time.perf_counter()
+            await asyncio.wrap_future(self.upload(path))
+            self.stats["upload"] += time.perf_counter() - started
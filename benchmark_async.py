@@ -0,0 +1,84 @@
+"""Benchmarks the asyncio pipeline against the batch and streaming imports, uploading to
+a local GCS stand-in that adds network-like latency and bandwidth
+
+    python benchmark_async.py --activities 200 --waypoints 5000 --shard-rows 50000 --latency 0.05 --mbps 50
+
+Every mode writes shards of --shard-rows rows (gzipped with --compression gzip), so
+shards upload while later activities are still being flattened. The JSON result has
+each mode's wall time and peak memory, the busy seconds of every pipeline stage, and
+whether all modes wrote the same rows.
+"""
+import argparse
+import gzip
+import json
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from local_gcs import LocalStorageClient
+from synthetic_data import write_corpus
+from workout_importer import WorkoutImporter
+
+
+def measure(data_directory, directory, args, **options):
+    output_directory = Path(directory) / "processed_data"
+    output_directory.mkdir()
+    client = LocalStorageClient(f"{directory}/gcs", latency=args.latency, bytes_per_second=args.mbps * 2**20)
+    if args.trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    importer = WorkoutImporter(data_directory, storage_client=client, shard_rows=args.shard_rows,
+                               compression=args.compression, queue_size=args.queue_size, **options)
+    importer.output_directory = str(output_directory)
+    importer.import_data()
+    seconds = time.perf_counter() - started
+    peak = None
+    if args.trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    stages = {record["table"]: round(record["wall_seconds"], 3)
+              for record in importer.metrics.tables.values() if record["stage"] == 'pipeline'}
+    return {"seconds": round(seconds, 3), "peak_allocated_mb": round(peak / 2**20, 1) if peak is not None else None, "stage_seconds": stages}
+
+
+def table_rows(directory):
+    """Every table's rows, read back from the shards in the local bucket"""
+    rows = {}
+    for shard in sorted(Path(directory, "gcs", "runna").glob("*/*.csv*")):
+        opener = gzip.open if shard.suffix == '.gz' else open
+        with opener(shard, 'rt') as shard_file:
+            rows.setdefault(shard.parent.name, []).extend(shard_file.read().splitlines()[1:])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--activities', type=int, default=200)
+    parser.add_argument('--waypoints', type=int, default=5000)
+    parser.add_argument('--shard-rows', type=int, default=50000)
+    parser.add_argument('--queue-size', type=int, default=8)
+    parser.add_argument('--compression', choices=['gzip'])
+    parser.add_argument('--extract-workers', type=int, help="async flattening processes, 0 for a thread")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds added to every upload")
+    parser.add_argument('--mbps', type=float, default=50, help="simulated upload bandwidth in MB/s")
+    parser.add_argument('--trace-memory', action='store_true', help="measure peak memory (slows both modes down)")
+    args = parser.parse_args()
+
+    modes = {"batch": {}, "streaming": {"streaming": True}, "async": {"asynchronous": True, "extract_workers": args.extract_workers}}
+    results = {"corpus": vars(args)}
+    rows = []
+    with tempfile.TemporaryDirectory() as data_directory:
+        write_corpus(data_directory, args.activities, args.waypoints)
+        for mode, options in modes.items():
+            with tempfile.TemporaryDirectory() as directory:
+                results[mode] = measure(data_directory, directory, args, **options)
+                rows.append(table_rows(directory))
+    for mode in ("batch", "streaming"):
+        results[f"speedup_over_{mode}"] = round(results[mode]["seconds"] / results["async"]["seconds"], 2)
+    results["same_rows"] = all(table_rows == rows[0] for table_rows in rows)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Benchmarks the JSON decoders against the stdlib on ./data and a synthetic corpus
+
+    python benchmark_decoders.py --activities 10 --waypoints 20000 --extra-keys 10
+
+--extra-keys adds that many keys no table reads to every waypoint of the synthetic
+corpus, to show what projection saves when devices send more than we import.
+"""
+import argparse
+import json
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from decoders import DECODERS, get_decoder, ijson, orjson, projection
+from synthetic_data import write_corpus
+from tables import TABLES
+from workout_importer import list_json_files
+
+
+AVAILABLE = {'json': True, 'orjson': orjson is not None, 'ijson': ijson is not None}
+
+
+def add_extra_keys(directory, extra_keys):
+    for path in list_json_files(directory):
+        with open(path) as json_file:
+            activity = json.load(json_file)
+        for waypoint in activity["waypoints"]:
+            waypoint.update((f"sensor{index}", index * 0.5) for index in range(extra_keys))
+        with open(path, 'w') as json_file:
+            json.dump(activity, json_file)
+
+
+def measure(decoder, json_files):
+    """Decodes every file, holding the activities like load_json_files does"""
+    total_bytes = sum(path.stat().st_size for path in json_files)
+    started = time.perf_counter()
+    activities = [decoder.load(path) for path in json_files]
+    seconds = time.perf_counter() - started
+
+    tracemalloc.start()
+    activities = [decoder.load(path) for path in json_files]
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del activities
+    return {"seconds": round(seconds, 3), "mb_per_second": round(total_bytes / 2**20 / seconds, 1),
+            "held_mb": round(held / 2**20, 1)}
+
+
+def run(json_files):
+    keep = projection(TABLES)
+    results = {}
+    for name in DECODERS:
+        if not AVAILABLE[name]:
+            results[name] = "not installed"
+            continue
+        results[name] = measure(get_decoder(name), json_files)
+        results[f"{name}+projection"] = measure(get_decoder(name, keep), json_files)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--activities', type=int, default=10)
+    parser.add_argument('--waypoints', type=int, default=20000)
+    parser.add_argument('--extra-keys', type=int, default=0)
+    args = parser.parse_args()
+
+    results = {"sample_files": run(list_json_files('./data'))}
+    with tempfile.TemporaryDirectory() as directory:
+        write_corpus(directory, args.activities, args.waypoints)
+        if args.extra_keys:
+            add_extra_keys(directory, args.extra_keys)
+        results["synthetic"] = dict(corpus=vars(args), **run(list_json_files(directory)))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
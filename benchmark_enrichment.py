@@ -0,0 +1,48 @@
+"""Checks that waypoint enrichment stays linear in the number of waypoints
+
+    python benchmark_enrichment.py --sizes 1000,10000,100000,400000
+
+Times WaypointEnricher.enrich on one synthetic activity of each size (best of --repeat runs)
+and reports the cost per waypoint. `growth` is the per-waypoint cost of the largest activity
+over that of the smallest: about 1 when the stage is linear, and about the size ratio if it
+were quadratic.
+"""
+import argparse
+import json
+import time
+
+from enrichment import WaypointEnricher
+from synthetic_data import generate_activity
+
+
+def best_seconds(enricher, activity, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        enricher.enrich(activity)
+        seconds = time.perf_counter() - started
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1000,10000,100000,400000', help="waypoints per activity, comma separated")
+    parser.add_argument('--laps', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    enricher = WaypointEnricher()
+    results = {"corpus": vars(args), "sizes": []}
+    for size in [int(size) for size in args.sizes.split(',')]:
+        activity = generate_activity(0, size, laps=args.laps)
+        seconds = best_seconds(enricher, activity, args.repeat)
+        results["sizes"].append({"waypoints": size, "seconds": round(seconds, 4),
+                                 "us_per_waypoint": round(seconds / size * 1e6, 3)})
+    sizes = results["sizes"]
+    results["growth"] = round(sizes[-1]["us_per_waypoint"] / sizes[0]["us_per_waypoint"], 2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
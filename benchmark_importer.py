@@ -0,0 +1,80 @@
+"""Benchmarks the per-table scans against the single-pass extraction engine
+
+    python benchmark_importer.py --activities 200 --waypoints 5000
+"""
+import argparse
+import json
+import tempfile
+import time
+import tracemalloc
+
+from synthetic_data import write_corpus
+from tables import ExtractionEngine
+from workout_importer import WorkoutImporter, extract_tables
+
+
+class LocalImporter(WorkoutImporter):
+    """WorkoutImporter that keeps its output on disk instead of uploading it"""
+
+    def upload_to_gcs(self, bucket_name, source_file_path, destination_blob_name):
+        pass
+
+
+class CountingList(list):
+    """List that counts how many times it is iterated over"""
+
+    passes = 0
+
+    def __iter__(self):
+        self.passes += 1
+        return super().__iter__()
+
+
+def five_scans(importer):
+    """One engine per table, each scanning the whole of combined_data, as before the single pass"""
+    for spec in importer.tables():
+        engine = ExtractionEngine(importer.today, [spec])
+        extract_tables(importer.combined_data, engine, {spec.name: importer._output_path(spec.name)})
+
+
+def single_pass(importer):
+    importer.import_data()
+
+
+def measure(run, data_directory, output_directory, **options):
+    """Times loading plus extraction, so streaming and parallel modes are comparable"""
+    tracemalloc.start()
+    started = time.perf_counter()
+    importer = LocalImporter(data_directory, **options)
+    importer.output_directory = output_directory
+    importer.combined_data = CountingList(importer.combined_data)
+    run(importer)
+    seconds = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"passes": importer.combined_data.passes, "seconds": round(seconds, 3),
+            "peak_allocated_mb": round(peak / 2**20, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--activities', type=int, default=100)
+    parser.add_argument('--waypoints', type=int, default=5000)
+    parser.add_argument('--laps', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_directory, tempfile.TemporaryDirectory() as output_directory:
+        write_corpus(data_directory, args.activities, args.waypoints, args.laps)
+        results = {
+            "corpus": vars(args),
+            "five_scans": measure(five_scans, data_directory, output_directory),
+            "single_pass": measure(single_pass, data_directory, output_directory),
+            "streaming": measure(single_pass, data_directory, output_directory, streaming=True),
+            "parallel": measure(single_pass, data_directory, output_directory, workers=args.workers),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Measures the dedup-and-order stage's peak memory and time against its sort buffer
+
+    python benchmark_ordering.py --activities 1000 --waypoints 1000 --buffers 1000,250,50
+
+Generates the activities lazily, with --duplicates of them delivered a second time, and
+runs ActivityOrderer over them once per buffer size. tracemalloc's peak shows the memory
+held: with a buffer as large as the corpus everything is sorted in memory, and smaller
+buffers spill sorted runs to disk, so the peak follows the buffer instead of the corpus.
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+from ordering import ActivityOrderer
+from synthetic_data import generate_activity
+
+
+def activities(count, waypoints, duplicates):
+    for index in range(count):
+        yield generate_activity(index, waypoints, laps=5)
+    for index in range(0, count, max(1, count // duplicates)) if duplicates else ():
+        yield dict(generate_activity(index, waypoints, laps=5), recordType="GARMIN")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--activities', type=int, default=1000)
+    parser.add_argument('--waypoints', type=int, default=1000)
+    parser.add_argument('--duplicates', type=int, default=100, help="activities delivered twice")
+    parser.add_argument('--buffers', default='1000,250,50', help="sort buffer sizes, comma separated")
+    args = parser.parse_args()
+
+    results = {"corpus": vars(args), "buffers": []}
+    for buffer_size in [int(size) for size in args.buffers.split(',')]:
+        orderer = ActivityOrderer(buffer_size=buffer_size)
+        tracemalloc.start()
+        started = time.perf_counter()
+        for _ in orderer.apply(activities(args.activities, args.waypoints, args.duplicates)):
+            pass
+        seconds = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results["buffers"].append(dict(orderer.stats, buffer_size=buffer_size, seconds=round(seconds, 2),
+                                       peak_memory_mb=round(peak / 2**20, 1)))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
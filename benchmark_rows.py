@@ -0,0 +1,83 @@
+"""Benchmarks dict rows against tuple records for waypoint_data and step_data
+
+    python benchmark_rows.py --activities 20 --waypoints 20000 --repeat-depth 3
+
+Bytes per row is the memory held by the rows of every activity, not counting the
+activities themselves, so it covers the row containers plus the values coerced for them.
+Throughput is the time to extract and write the rows to csv with writerows() and writerecords().
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from synthetic_data import generate_activity
+from tables import STEP_DATA, WAYPOINT_DATA, ExtractionEngine
+from writers import CsvTableWriter
+
+PROCESSING_TIME = "2024-11-04"
+
+
+def dict_rows(engine, spec, activity):
+    return engine.rows(spec.name, activity)
+
+
+def records(engine, spec, activity):
+    return engine.records(spec.name, activity)
+
+
+def bytes_per_row(spec, activities, min_rows=50_000):
+    """Memory held by the rows of all activities in each representation. Activities are
+    visited again until there are min_rows rows, since a few have only a handful of steps"""
+    engine = ExtractionEngine(PROCESSING_TIME, specs=[spec])
+    rows = sum(1 for activity in activities for _ in engine.records(spec.name, activity))
+    activities = activities * max(1, -(-min_rows // max(rows, 1)))
+    result = {}
+    for build in (dict_rows, records):
+        tracemalloc.start()
+        held = [row for activity in activities for row in build(engine, spec, activity)]
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result[build.__name__] = round(current / len(held), 1)
+        result["rows"] = len(held)
+        del held
+    result["reduction"] = round(1 - result["records"] / result["dict_rows"], 2)
+    return result
+
+
+def throughput(spec, activities, directory):
+    engine = ExtractionEngine(PROCESSING_TIME, specs=[spec])
+    seconds = {}
+    for build, method in ((dict_rows, 'writerows'), (records, 'writerecords')):
+        started = time.perf_counter()
+        writer = CsvTableWriter(os.path.join(directory, f"{spec.name}-{build.__name__}.csv"), spec)
+        for activity in activities:
+            getattr(writer, method)(build(engine, spec, activity))
+        writer.close()
+        seconds[build.__name__] = time.perf_counter() - started
+    result = {name: {"seconds": round(value, 4)} for name, value in seconds.items()}
+    result["speedup"] = round(seconds["dict_rows"] / seconds["records"], 2)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--activities', type=int, default=20)
+    parser.add_argument('--waypoints', type=int, default=20_000)
+    parser.add_argument('--repeat-depth', type=int, default=3, help="nesting of repeat steps, for more step rows")
+    args = parser.parse_args()
+
+    activities = [generate_activity(index, args.waypoints, repeat_depth=args.repeat_depth)
+                  for index in range(args.activities)]
+    results = {"corpus": vars(args)}
+    with tempfile.TemporaryDirectory() as directory:
+        for spec in (WAYPOINT_DATA, STEP_DATA):
+            results[spec.name] = {"bytes_per_row": bytes_per_row(spec, activities),
+                                  "csv": throughput(spec, activities, directory)}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
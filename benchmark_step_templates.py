@@ -0,0 +1,61 @@
+"""Compares flattening step_data per activity against the step template cache
+
+    python benchmark_step_templates.py --activities 20000 --plans 200 --repeat-depth 2
+
+Builds a synthetic corpus in which the activities share --plans distinct stepsV2 trees,
+then times ExtractionEngine.records for step_data with and without StepTemplates (best of
+--repeat runs) and reports the cache's hit rate.
+"""
+import argparse
+import json
+import time
+
+from step_templates import StepTemplates
+from synthetic_data import generate_activity
+from tables import STEP_DATA, ExtractionEngine
+
+
+def best_seconds(make_engine, activities, repeat):
+    best = None
+    for _ in range(repeat):
+        engine = make_engine()
+        started = time.perf_counter()
+        for activity in activities:
+            for _ in engine.records('step_data', activity):
+                pass
+        seconds = time.perf_counter() - started
+        best = seconds if best is None else min(best, seconds)
+    return best, engine
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--activities', type=int, default=20000)
+    parser.add_argument('--plans', type=int, default=200, help="distinct stepsV2 trees in the corpus")
+    parser.add_argument('--repeat-depth', type=int, default=2)
+    parser.add_argument('--cache-size', type=int, default=1024)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    activities = [generate_activity(index, 1, laps=1, repeat_depth=args.repeat_depth, step_plans=args.plans)
+                  for index in range(args.activities)]
+    plain, _ = best_seconds(lambda: ExtractionEngine("2024-01-01", [STEP_DATA]), activities, args.repeat)
+    cached, engine = best_seconds(
+        lambda: ExtractionEngine("2024-01-01", [STEP_DATA], record_builders={
+            'step_data': StepTemplates("2024-01-01", maxsize=args.cache_size)}),
+        activities, args.repeat)
+    stats = engine.record_builders['step_data'].stats
+    results = {
+        "corpus": vars(args),
+        "flatten_seconds": round(plain, 4),
+        "cached_seconds": round(cached, 4),
+        "speedup": round(plain / cached, 2),
+        "us_per_activity": {"flatten": round(plain / args.activities * 1e6, 2),
+                            "cached": round(cached / args.activities * 1e6, 2)},
+        "cache": dict(stats, hit_rate=round(stats["hits"] / max(1, stats["hits"] + stats["misses"]), 4)),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
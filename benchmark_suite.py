@@ -0,0 +1,139 @@
+"""End-to-end benchmark of WorkoutImporter over synthetic corpora of several sizes
+
+    python benchmark_suite.py --sizes 20x1000,10x10000,2x100000 --output results.json
+    python benchmark_suite.py --baseline results.json
+
+Each size is <activities>x<waypoints per activity>. For every size a corpus is generated
+with synthetic_data.py and imported once by each of the import paths import_data runs:
+write_tables (batch), write_tables_parallel (--workers processes) and write_tables_async,
+with uploads going to a local stand-in for GCS. Each path's total and its own stages (load,
+extract, merge, upload, ...) are timed and memory-profiled. The results are JSON, and
+--baseline compares them against an earlier run and exits 1 on a regression.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+from local_gcs import LocalStorageClient
+from metrics import PipelineMetrics
+from synthetic_data import write_corpus
+from workout_importer import WorkoutImporter
+
+
+# The WorkoutImporter options that make import_data run each path
+MODES = {
+    'write_tables': {},
+    'write_tables_parallel': {"workers": 2},
+    'write_tables_async': {"asynchronous": True},
+}
+
+
+def parse_sizes(sizes):
+    """'20x1000,2x100000' -> [(20, 1000), (2, 100000)]"""
+    return [tuple(int(part) for part in size.split('x')) for size in sizes.split(',')]
+
+
+def run_mode(metrics, mode, data_directory, directory, trace_memory=True, **options):
+    """Imports the corpus through one path. Its total goes in metrics as the stage `mode`, and
+    the importer's own stages and tables follow as `<mode>/<stage>`"""
+    output_directory = f"{directory}/{mode}"
+    os.makedirs(output_directory)
+    with metrics.stage(mode) as record:
+        importer = WorkoutImporter(data_directory, trace_memory=trace_memory, output_directory=output_directory,
+                                   storage_client=LocalStorageClient(f"{directory}/gcs-{mode}"), **options)
+        importer.import_data()
+        importer.uploader.close()
+    for stage in importer.metrics.stages:
+        metrics.stages.append(dict(stage, stage=f"{mode}/{stage['stage']}"))
+        if stage["stage"] == 'extract':
+            record["rows_in"] += stage["rows_in"]
+            record["rows_out"] += stage["rows_out"]
+    for (stage, table_name), table in importer.metrics.tables.items():
+        metrics.tables[(f"{mode}/{stage}", table_name)] = dict(table, stage=f"{mode}/{stage}")
+    for name, counts in importer.metrics.counters.items():
+        metrics.count(f"{mode}/{name}", **counts)
+
+
+def run_size(activities, waypoints, laps=10, repeat_depth=1, garmin_share=0.5, seed=0, trace_memory=True,
+             workers=2):
+    """Generates one corpus and returns the per-stage and per-table metrics of importing it
+    through every path"""
+    metrics = PipelineMetrics()
+    with tempfile.TemporaryDirectory() as directory:
+        data_directory = f"{directory}/data"
+        write_corpus(data_directory, activities, waypoints, laps, seed=seed,
+                     repeat_depth=repeat_depth, garmin_share=garmin_share)
+        corpus_bytes = sum(path.stat().st_size for path in Path(data_directory).iterdir())
+        for mode, options in MODES.items():
+            if "workers" in options:
+                options = dict(options, workers=workers)
+            run_mode(metrics, mode, data_directory, directory, trace_memory, **options)
+
+    report = metrics.report()
+    report["corpus"] = {"activities": activities, "waypoints": waypoints, "laps": laps,
+                        "repeat_depth": repeat_depth, "garmin_share": garmin_share,
+                        "seed": seed, "bytes": corpus_bytes, "workers": workers}
+    return report
+
+
+def compare(baseline, results, tolerance=0.2, min_seconds=0.05):
+    """Lists the stages whose wall time grew by more than tolerance over the baseline run of
+    the same corpus size. Stages faster than min_seconds in both runs are too noisy to judge"""
+    baseline_runs = {run["size"]: run for run in baseline["runs"]}
+    regressions = []
+    for run in results["runs"]:
+        before = baseline_runs.get(run["size"])
+        if before is None:
+            continue
+        seconds_before = {stage["stage"]: stage["wall_seconds"] for stage in before["stages"]}
+        for stage in run["stages"]:
+            old, new = seconds_before.get(stage["stage"]), stage["wall_seconds"]
+            if old is None or max(old, new) < min_seconds:
+                continue
+            if new > old * (1 + tolerance):
+                regressions.append({"size": run["size"], "stage": stage["stage"],
+                                    "baseline_seconds": old, "seconds": new})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='20x1000,10x10000,2x100000')
+    parser.add_argument('--laps', type=int, default=10)
+    parser.add_argument('--repeat-depth', type=int, default=1)
+    parser.add_argument('--garmin-share', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=2, help="processes used by write_tables_parallel")
+    parser.add_argument('--no-trace-memory', action='store_true', help="skip tracemalloc, for cleaner timings")
+    parser.add_argument('--output', help="write the results to this JSON file instead of stdout")
+    parser.add_argument('--baseline', help="earlier results to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    results = {"python": sys.version.split()[0], "runs": []}
+    for activities, waypoints in parse_sizes(args.sizes):
+        report = run_size(activities, waypoints, args.laps, args.repeat_depth, args.garmin_share,
+                          args.seed, trace_memory=not args.no_trace_memory, workers=args.workers)
+        results["runs"].append(dict(report, size=f"{activities}x{waypoints}"))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(json.load(baseline_file), results, args.tolerance)
+        for regression in regressions:
+            print(f"{regression['size']} {regression['stage']}: "
+                  f"{regression['baseline_seconds']:.3f}s -> {regression['seconds']:.3f}s")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+"""Benchmarks the dict-per-row waypoint path against the NumPy column-array path
+
+    python benchmark_waypoints.py --activities 5 --waypoints 100000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from synthetic_data import generate_activity
+from tables import WAYPOINT_DATA, ExtractionEngine
+from waypoints import WaypointArrays
+from writers import WRITERS, pa
+
+PROCESSING_TIME = "2024-11-04"
+
+
+def dict_rows(activities, writer):
+    engine = ExtractionEngine(PROCESSING_TIME, specs=[WAYPOINT_DATA])
+    for activity in activities:
+        writer.writerows(engine.rows('waypoint_data', activity))
+
+
+def column_arrays(activities, writer):
+    builder = WaypointArrays(PROCESSING_TIME)
+    for activity in activities:
+        writer.write_columns(builder.build(activity))
+
+
+def throughput(run, activities, output_format, directory):
+    rows = sum(len(activity['waypoints']) for activity in activities)
+    writer_class = WRITERS[output_format]
+    path = os.path.join(directory, f"{run.__name__}.{writer_class.extension}")
+    started = time.perf_counter()
+    writer = writer_class(path, WAYPOINT_DATA)
+    run(activities, writer)
+    writer.close()
+    seconds = time.perf_counter() - started
+    return {"seconds": round(seconds, 3), "rows_per_second": int(rows / seconds)}
+
+
+def bytes_per_row(activity):
+    """Memory held by one activity's waypoint rows in each representation"""
+    engine = ExtractionEngine(PROCESSING_TIME, specs=[WAYPOINT_DATA])
+    builder = WaypointArrays(PROCESSING_TIME)
+    rows = len(activity['waypoints'])
+    result = {}
+    for name, build in [("dict_rows", lambda: list(engine.rows('waypoint_data', activity))),
+                        ("column_arrays", lambda: builder.build(activity))]:
+        tracemalloc.start()
+        held = build()
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result[name] = round(current / rows, 1)
+        del held
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--activities', type=int, default=5)
+    parser.add_argument('--waypoints', type=int, default=100_000)
+    args = parser.parse_args()
+
+    activities = [generate_activity(index, args.waypoints) for index in range(args.activities)]
+    results = {"corpus": vars(args), "bytes_per_row": bytes_per_row(activities[0])}
+    formats = ['csv', 'parquet'] if pa is not None else ['csv']
+    with tempfile.TemporaryDirectory() as directory:
+        for output_format in formats:
+            results[output_format] = {run.__name__: throughput(run, activities, output_format, directory)
+                                      for run in (dict_rows, column_arrays)}
+            results[output_format]["speedup"] = round(
+                results[output_format]["dict_rows"]["seconds"] / results[output_format]["column_arrays"]["seconds"], 1)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
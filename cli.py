@@ -0,0 +1,189 @@
+"""Command line entry point for the importer and the loader
+
+    python cli.py extract --data-directory ./data
+    python cli.py upload --bucket runna
+    python cli.py load <run id> --bucket runna --dataset runna
+    python cli.py run-all --data-directory ./data --bucket runna --dataset runna
+
+extract flattens the activity JSON files and stages them in a local directory that stands in
+for the bucket (<output directory>/staged/<bucket>), so it needs neither the Google Cloud SDK
+nor credentials. upload then copies the staged files to GCS under the same blob names, and
+load runs the BigQuery load jobs. run-all extracts, uploads as files are finished and loads
+in one process.
+
+Only the modules a subcommand needs are imported once it runs, and the cloud SDKs only when
+a client is first used, so --help and extract start without paying for them.
+"""
+import argparse
+import os
+import sys
+
+from decoders import DECODERS
+from ordering import PRECEDENCES
+from step_templates import DEFAULT_CACHE_SIZE
+
+
+def add_import_arguments(parser):
+    """The importer's options, shared by workout_importer.py, extract and run-all"""
+    parser.add_argument('--data-directory', default='./data', help="directory holding the activity JSON files")
+    parser.add_argument('--output-directory', default='./processed_data', help="where table files are written")
+    parser.add_argument('--bucket', default='runna', help="GCS bucket the files are staged in")
+    parser.add_argument('--incremental', action='store_true',
+                        help="parse only new or changed files into a run of delta files, tracked in manifest.json")
+    parser.add_argument('--streaming', action='store_true',
+                        help="parse one file at a time instead of loading the whole data directory first")
+    parser.add_argument('--workers', type=int, default=1, help="worker processes splitting the data files")
+    parser.add_argument('--vectorized', action='store_true', help="build waypoint_data as NumPy arrays")
+    parser.add_argument('--decoder', default='auto', choices=['auto'] + sorted(DECODERS),
+                        help="JSON decoder; auto is orjson when installed, else json")
+    parser.add_argument('--project', action='store_true', help="keep only the lap and waypoint keys the tables read")
+    parser.add_argument('--queue-size', type=int, default=8, help="items held between the asyncio pipeline's stages")
+    parser.add_argument('--upload-workers', type=int, default=4, help="files uploaded at once")
+    parser.add_argument('--report', help="write a JSON run report to this path")
+    parser.add_argument('--profile', help="dump cProfile stats to this path")
+    parser.add_argument('--trace-memory', action='store_true', help="record peak memory per stage")
+    parser.add_argument('--shard-rows', type=int, help="start a new shard after this many rows")
+    parser.add_argument('--shard-bytes', type=int, help="start a new shard once a shard reaches this size")
+    parser.add_argument('--compression', choices=['gzip', 'zstd', 'snappy'],
+                        help="gzip for csv; zstd, gzip or snappy for parquet")
+    parser.add_argument('--format', default='csv', choices=['csv', 'parquet'])
+    parser.add_argument('--summaries', action='store_true',
+                        help="also write activity_summary, user_week_summary and workout_leaderboard")
+    parser.add_argument('--downsample', metavar='STRATEGY:VALUE',
+                        help="reduce the waypoints: time:<seconds>, distance:<meters> or simplify:<tolerance>")
+    parser.add_argument('--async', dest='asynchronous', action='store_true',
+                        help="overlap reading, extraction, writing and upload in an asyncio pipeline")
+    parser.add_argument('--enrich', action='store_true',
+                        help="add pace, grade and heart rate zone columns to waypoint_data, and lap_splits")
+    parser.add_argument('--max-heart-rate', type=int, default=190, help="heart rate zones are fractions of this")
+    parser.add_argument('--surrogate-keys', action='store_true',
+                        help="write integer keys in place of ids and enum strings, with dimension tables")
+    parser.add_argument('--step-cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+                        help="distinct workout step trees kept flattened for reuse (default %(default)s), 0 to flatten "
+                             "every activity")
+    parser.add_argument('--dedupe', choices=sorted(PRECEDENCES),
+                        help="sort the activities by user and start time, keeping one copy of each activityId "
+                             "by this precedence")
+    parser.add_argument('--sort-buffer', type=int, default=10_000,
+                        help="activities sorted in memory before a sorted run is spilled to disk")
+    parser.add_argument('--extract-workers', type=int,
+                        help="worker processes flattening files in the asyncio pipeline, 0 for a thread; "
+                             "defaults to one per spare CPU")
+
+
+def add_load_arguments(parser):
+    parser.add_argument('--dataset', default='runna', help="BigQuery dataset the tables are loaded into")
+    parser.add_argument('--max-concurrent-jobs', type=int, default=5, help="load jobs running at once")
+
+
+def staging_directory(args):
+    return args.staging or os.path.join(args.output_directory, 'staged')
+
+
+def extract(args):
+    """Runs the importer with a local directory standing in for the bucket, and returns the run id"""
+    from local_gcs import LocalStorageClient
+    from workout_importer import importer_from_args
+
+    os.makedirs(args.output_directory, exist_ok=True)
+    staging = staging_directory(args)
+    importer = importer_from_args(args, storage_client=LocalStorageClient(staging))
+    run_id = importer.import_data()
+    print(f"Staged the tables in {os.path.join(staging, args.bucket)}" + (f" for run {run_id}" if run_id else ""))
+    return run_id
+
+
+def staged_files(staging, bucket_name):
+    """(path, blob name) of every file staged for bucket_name, in blob name order"""
+    from local_gcs import LocalStorageClient
+
+    bucket = LocalStorageClient(staging).bucket(bucket_name)
+    return [(str(blob.path), blob.name) for blob in bucket.list_blobs()]
+
+
+def upload(args, storage_client=None):
+    """Uploads every staged file to the bucket under its blob name, removing it once uploaded"""
+    from uploader import GcsUploader
+
+    files = staged_files(staging_directory(args), args.bucket)
+    with GcsUploader(client=storage_client, max_workers=args.upload_workers) as uploader:
+        for path, blob_name in files:
+            uploader.submit(args.bucket, path, blob_name)
+        uploader.wait()
+    for path, _ in files:
+        os.remove(path)
+    print(f"Uploaded {len(files)} files to {args.bucket}")
+    return len(files)
+
+
+def load(args, metrics=None):
+    from load_multiple_csv import load_csv_files_to_bigquery
+
+    return load_csv_files_to_bigquery(args.bucket, args.dataset, args.run_id, args.max_concurrent_jobs,
+                                      metrics=metrics, surrogate_keys=args.surrogate_keys, enriched=args.enriched)
+
+
+def run_all(args):
+    """Extracts while uploading to the bucket, then loads that run. Both stages go in one report"""
+    from workout_importer import importer_from_args
+
+    os.makedirs(args.output_directory, exist_ok=True)
+    importer = importer_from_args(args)
+    run_id = importer.import_data()
+    args.run_id, args.enriched = run_id, args.enrich
+    try:
+        #Without a run id the loader would reload the top level files, replacing the deltas loaded so far
+        if args.incremental and run_id is None:
+            print("Nothing to load")
+            return []
+        return load(args, metrics=importer.metrics)
+    finally:
+        if args.report:
+            importer.metrics.write_report(args.report)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    extract_parser = commands.add_parser('extract', help="flatten the JSON files and stage them locally")
+    add_import_arguments(extract_parser)
+    extract_parser.add_argument('--staging', help="local bucket directory, defaults to <output directory>/staged")
+    extract_parser.set_defaults(handler=extract)
+
+    upload_parser = commands.add_parser('upload', help="upload the staged files to GCS")
+    upload_parser.add_argument('--output-directory', default='./processed_data')
+    upload_parser.add_argument('--staging', help="local bucket directory, defaults to <output directory>/staged")
+    upload_parser.add_argument('--bucket', default='runna')
+    upload_parser.add_argument('--upload-workers', type=int, default=4)
+    upload_parser.set_defaults(handler=upload)
+
+    load_parser = commands.add_parser('load', help="load the uploaded files into BigQuery")
+    # Pass the run id printed by a sharded or incremental import to load only that run
+    load_parser.add_argument('run_id', nargs='?', default=None)
+    load_parser.add_argument('--bucket', default='runna')
+    add_load_arguments(load_parser)
+    load_parser.add_argument('--surrogate-keys', action='store_true',
+                             help="top level files were written with --surrogate-keys; run files say so themselves")
+    load_parser.add_argument('--enriched', action='store_true', help="top level files were written with --enrich")
+    load_parser.set_defaults(handler=load)
+
+    run_all_parser = commands.add_parser('run-all', help="extract, upload and load in one process")
+    add_import_arguments(run_all_parser)
+    add_load_arguments(run_all_parser)
+    run_all_parser.set_defaults(handler=run_all)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        args.handler(args)
+    except Exception as e:
+        print(f"{args.command} failed: {e}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
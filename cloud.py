@@ -0,0 +1,59 @@
+"""Lazy access to the Google Cloud SDKs, with one shared client of each kind per process.
+
+Importing google.cloud.storage and google.cloud.bigquery takes longer than importing the rest
+of the importer together, and needs the SDKs installed. `storage` and `bigquery` here stand
+in for those modules and import them on first attribute access, so a run that never talks
+to GCS or BigQuery, such as `cli.py extract`, never loads them:
+
+    from cloud import bigquery, storage_client
+    config = bigquery.LoadJobConfig()     # imports google.cloud.bigquery now
+    client = storage_client()             # the same storage.Client for every caller
+"""
+import importlib
+import threading
+
+
+class LazyModule:
+    """Module stand-in that imports the named module the first time an attribute is read.
+    Attributes set on it, such as mock.patch's, shadow the module's own"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if attribute.startswith('__'):
+            raise AttributeError(attribute)
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+
+storage = LazyModule('google.cloud.storage')
+bigquery = LazyModule('google.cloud.bigquery')
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def _shared(client_class):
+    """One client per client class, built on first use. Keyed by the class, so a patched
+    Client gets a client of its own"""
+    with _lock:
+        if client_class not in _clients:
+            _clients[client_class] = client_class()
+        return _clients[client_class]
+
+
+def storage_client():
+    """The process's google.cloud.storage.Client"""
+    return _shared(storage.Client)
+
+
+def bigquery_client():
+    """The process's google.cloud.bigquery.Client"""
+    return _shared(bigquery.Client)
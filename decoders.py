@@ -0,0 +1,189 @@
+"""Pluggable JSON decoders for the activity files.
+
+`get_decoder('auto')` picks orjson when it is installed and falls back to the stdlib
+json module. The ijson decoder parses event by event, building each lap and waypoint
+straight from the parser events, so keys no table consumes are never materialised.
+"""
+import io
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+# Top level arrays whose elements are the `item` of a table's rows
+ITEM_ARRAYS = {'lap_data': 'laps', 'waypoint_data': 'waypoints'}
+
+
+def projection(specs):
+    """Maps each array of ITEM_ARRAYS to the element keys its table reads, e.g.
+    {'waypoints': frozenset({'distance', 'heartRate', ...}), 'laps': ...}"""
+    keep = {}
+    for spec in specs:
+        array = ITEM_ARRAYS.get(spec.name)
+        if array is not None:
+            keep[array] = frozenset(field.source.split('.')[1] for field in spec.fields
+                                    if field.source.startswith('item.'))
+    return keep
+
+
+def project(activity, keep):
+    """Drops the keys of the projected arrays' elements that no table reads"""
+    for array, keys in keep.items():
+        items = activity.get(array)
+        if items:
+            activity[array] = [item if item.keys() <= keys
+                               else {key: value for key, value in item.items() if key in keys}
+                               for item in items]
+    return activity
+
+
+class JsonDecoder:
+    """Decodes a whole file with the stdlib json module"""
+
+    name = 'json'
+
+    def __init__(self, projection=None):
+        self.projection = projection
+
+    def _decode(self, json_file):
+        return json.load(json_file)
+
+    def load(self, path):
+        with open(path, 'r') as json_file:
+            activity = self._decode(json_file)
+        return project(activity, self.projection) if self.projection else activity
+
+    def loads(self, content):
+        activity = json.loads(content)
+        return project(activity, self.projection) if self.projection else activity
+
+
+class OrjsonDecoder(JsonDecoder):
+    """Decodes a whole file with orjson, about 3x faster than the stdlib"""
+
+    name = 'orjson'
+
+    def __init__(self, projection=None):
+        if orjson is None:
+            raise ImportError("orjson is required for the orjson decoder: pip install orjson")
+        super().__init__(projection)
+
+    def _decode(self, json_file):
+        return orjson.loads(json_file.read())
+
+    def loads(self, content):
+        activity = orjson.loads(content)
+        return project(activity, self.projection) if self.projection else activity
+
+
+def _build(events, event, value, keys):
+    """Builds the value that starts with (event, value) from the rest of the events.
+    Map keys are shared through the `keys` memo, as the stdlib scanner does"""
+    if event == 'start_map':
+        obj = {}
+        for event, key in events:
+            if event == 'end_map':
+                return obj
+            obj[keys.setdefault(key, key)] = _build(events, *next(events), keys)
+    if event == 'start_array':
+        items = []
+        for event, value in events:
+            if event == 'end_array':
+                return items
+            items.append(_build(events, event, value, keys))
+    return value
+
+
+def _skip(events, event):
+    if event not in ('start_map', 'start_array'):
+        return
+    depth = 1
+    for event, _ in events:
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+            if depth == 0:
+                return
+
+
+def _build_projected_array(events, kept, keys):
+    """Builds a list of objects keeping only the kept keys, skipping the other values unbuilt"""
+    kept = {key: key for key in kept}
+    items = []
+    for event, value in events:
+        if event == 'end_array':
+            return items
+        if event != 'start_map':
+            items.append(_build(events, event, value, keys))
+            continue
+        item = {}
+        for event, key in events:
+            if event == 'end_map':
+                break
+            event, value = next(events)
+            key = kept.get(key)
+            if key is not None:
+                item[key] = _build(events, event, value, keys)
+            else:
+                _skip(events, event)
+        items.append(item)
+    return items
+
+
+class IjsonDecoder(JsonDecoder):
+    """Event-based decoder: the laps and waypoints arrays are built element by element
+    from the parser events, keeping only the projected keys of each element"""
+
+    name = 'ijson'
+
+    def __init__(self, projection=None):
+        if ijson is None:
+            raise ImportError("ijson is required for the ijson decoder: pip install ijson")
+        super().__init__(projection)
+
+    def _decode(self, json_file):
+        events = iter(ijson.basic_parse(json_file, use_float=True))
+        event, value = next(events)
+        keys = {}
+        if event != 'start_map' or not self.projection:
+            return _build(events, event, value, keys)
+        activity = {}
+        for event, key in events:
+            if event == 'end_map':
+                break
+            event, value = next(events)
+            if key in self.projection and event == 'start_array':
+                activity[key] = _build_projected_array(events, self.projection[key], keys)
+            else:
+                activity[key] = _build(events, event, value, keys)
+        return activity
+
+    def load(self, path):
+        with open(path, 'rb') as json_file:
+            return self._decode(json_file)
+
+    def loads(self, content):
+        return self._decode(io.BytesIO(content))
+
+
+DECODERS = {'json': JsonDecoder, 'orjson': OrjsonDecoder, 'ijson': IjsonDecoder}
+
+
+def get_decoder(name='auto', projection=None):
+    """Decoder instance by name; 'auto' is orjson when installed, else the stdlib"""
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    try:
+        decoder_class = DECODERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown decoder {name}, expected 'auto' or one of {sorted(DECODERS)}")
+    return decoder_class(projection)
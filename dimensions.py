@@ -0,0 +1,185 @@
+"""Dimension tables and integer surrogate keys for the repeated string columns.
+
+With surrogate keys, the fact tables carry `*_key` integers in place of the
+activity, user, plan and workout ids and of the low-cardinality enum strings
+(record_type, waypoint type, step intensity, ...). Each string is kept once in the
+dimension tables:
+
+    dim_activity (activity_key, activity_id)    dim_user (user_key, user_id)
+    dim_plan (plan_key, plan_id)                dim_workout (workout_key, workout_id)
+    dim_enum (enum_key, enum_type, value)
+
+A DimensionStore hands out keys in order of first sight and is saved next to the manifest.
+A value keeps its key for good, so keys stay stable across incremental runs and earlier
+deltas never need rewriting. The dimension tables are snapshots: every run writes them
+whole from the store, and the loader replaces them.
+"""
+import json
+import os
+
+from tables import Field, TableSpec, field_names
+from waypoints import ColumnBatch, np
+
+
+# The columns replaced by keys in each fact table, and the dimension each key points into
+KEYED_COLUMNS = {
+    'activity_data': {'activity_id': 'activity', 'user_id': 'user', 'plan_id': 'plan', 'workout_id': 'workout',
+                      'record_type': 'enum', 'unit_of_measure': 'enum'},
+    'lap_data': {'activity_id': 'activity'},
+    'workout_metadata': {'activity_id': 'activity', 'workout_type': 'enum', 'run_type': 'enum'},
+    'waypoint_data': {'activity_id': 'activity', 'type': 'enum'},
+    'step_data': {'activity_id': 'activity', 'step_type': 'enum', 'intensity': 'enum', 'duration_type': 'enum',
+                  'duration_value_type': 'enum', 'target_type': 'enum'},
+    'waypoint_buckets': {'activity_id': 'activity'},
+    'lap_splits': {'activity_id': 'activity', 'step_intensity': 'enum'},
+}
+
+# Dimensions keyed by a single id column, in the order their tables are written
+ID_DIMENSIONS = ['activity', 'user', 'plan', 'workout']
+
+
+def _id_dimension_spec(dimension):
+    return TableSpec(f"dim_{dimension}", None, [
+        Field(f"{dimension}_key", f"{dimension}_key", "INTEGER", mode="REQUIRED"),
+        Field(f"{dimension}_id", f"{dimension}_id", "STRING", mode="REQUIRED"),
+        Field("processing_time", "processing_time", "DATE", mode="REQUIRED"),
+    ], cluster_fields=(f"{dimension}_key",))
+
+
+DIM_ACTIVITY, DIM_USER, DIM_PLAN, DIM_WORKOUT = [_id_dimension_spec(dimension) for dimension in ID_DIMENSIONS]
+
+DIM_ENUM = TableSpec('dim_enum', None, [
+    Field("enum_key", "enum_key", "INTEGER", mode="REQUIRED"),
+    Field("enum_type", "enum_type", "STRING", mode="REQUIRED"),
+    Field("value", "value", "STRING", mode="REQUIRED"),
+    Field("processing_time", "processing_time", "DATE", mode="REQUIRED"),
+], cluster_fields=('enum_type',))
+
+DIMENSION_TABLES = [DIM_ACTIVITY, DIM_USER, DIM_PLAN, DIM_WORKOUT, DIM_ENUM]
+
+
+def key_column(name):
+    """activity_id -> activity_key, intensity -> intensity_key"""
+    return f"{name[:-len('_id')] if name.endswith('_id') else name}_key"
+
+
+def keyed_spec(spec):
+    """The spec as written with surrogate keys: keyed columns become INTEGER key columns
+    in the same place, and the table is clustered on the keys instead"""
+    keyed = KEYED_COLUMNS.get(spec.name)
+    if not keyed:
+        return spec
+    fields = [field._replace(name=key_column(field.name), type="INTEGER", transform=None) if field.name in keyed
+              else field for field in spec.fields]
+    cluster_fields = tuple(key_column(name) if name in keyed else name for name in spec.cluster_fields)
+    return spec._replace(fields=fields, cluster_fields=cluster_fields)
+
+
+class DimensionStore:
+    """Surrogate keys of every id and enum value seen so far, by dimension. Enum keys
+    share one sequence across enum types, so dim_enum can be joined on enum_key alone"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.ids = {dimension: {} for dimension in ID_DIMENSIONS}
+        self.enums = {}
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as store_file:
+                saved = json.load(store_file)
+            self.ids.update(saved["ids"])
+            self.enums = saved["enums"]
+        self._enum_count = sum(len(values) for values in self.enums.values())
+
+    def interner(self, dimension, enum_type=None):
+        """Function from a value to its key, handing out the next key to new values. None stays None"""
+        if dimension == 'enum':
+            keys = self.enums.setdefault(enum_type, {})
+        else:
+            keys = self.ids[dimension]
+
+        def key(value):
+            if value is None:
+                return None
+            found = keys.get(value)
+            if found is None:
+                if dimension == 'enum':
+                    self._enum_count += 1
+                    found = self._enum_count
+                else:
+                    found = len(keys) + 1
+                keys[value] = found
+            return found
+        return key
+
+    def keys(self, dimension, values):
+        """Keys already assigned to values, skipping values that have none"""
+        keys = self.ids[dimension]
+        return [keys[value] for value in values if value in keys]
+
+    def dimension_rows(self, spec_name, processing_time):
+        if spec_name == DIM_ENUM.name:
+            return [{"enum_key": key, "enum_type": enum_type, "value": value, "processing_time": processing_time}
+                    for enum_type, values in sorted(self.enums.items()) for value, key in values.items()]
+        dimension = spec_name[len('dim_'):]
+        return [{key_column(dimension): key, f"{dimension}_id": value, "processing_time": processing_time}
+                for value, key in self.ids[dimension].items()]
+
+    def save(self):
+        """Writes the store atomically, like the manifest"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as store_file:
+            json.dump({"ids": self.ids, "enums": self.enums}, store_file, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class KeyingWriter:
+    """Wraps a fact table's writer, which was opened with keyed_spec(spec), and replaces the
+    keyed columns of every row, record or column batch with their surrogate keys"""
+
+    def __init__(self, writer, spec, store):
+        self.writer = writer
+        self.spec = keyed_spec(spec)
+        self._names = field_names(spec)
+        keyed = KEYED_COLUMNS[spec.name]
+        self._keys = [(index, name, store.interner(keyed[name], name)) for index, name in enumerate(self._names)
+                      if name in keyed]
+
+    def _keyed(self, records):
+        keys = self._keys
+        for record in records:
+            record = list(record)
+            for index, _, key in keys:
+                record[index] = key(record[index])
+            yield tuple(record)
+
+    def writerecords(self, records):
+        self.writer.writerecords(self._keyed(records))
+
+    def writerows(self, rows):
+        names = self._names
+        self.writer.writerecords(self._keyed([row[name] for name in names] for row in rows))
+
+    def write_columns(self, batch):
+        if not hasattr(self.writer, 'write_columns'):
+            self.writerows(batch.rows())
+            return
+        constants = dict(batch.constants)
+        values = batch.values
+        renamed = {}
+        for _, name, key in self._keys:
+            if name in constants:
+                constants[key_column(name)] = key(constants.pop(name))
+            else:
+                values[name] = [key(value) for value in values[name].tolist()]
+                renamed[name] = key_column(name)
+        if renamed:
+            #Arrays holding objects cannot be viewed with a renamed dtype, so the columns are copied
+            names = values.dtype.names
+            keyed = np.empty(len(values), [(renamed.get(name, name), values.dtype[name]) for name in names])
+            for name in names:
+                keyed[renamed.get(name, name)] = values[name]
+            values = keyed
+        self.writer.write_columns(ColumnBatch(self.spec, values, constants))
+
+    def close(self):
+        self.writer.close()
@@ -0,0 +1,228 @@
+"""Optional waypoint reduction for high-frequency streams.
+
+A reducer keeps a subset of each activity's waypoints: the first point of every fixed
+time bucket, a point every N metres, or the points a tolerance-based line simplification
+needs. Lap and step boundaries (lapIndex/stepIndex changes, or lap start timestamps for
+devices that do not tag their points) and `type` markers such as `start` are always kept.
+Every kept point stands for the run of points up to the next one. These runs are summarised
+as rows of `waypoint_buckets`, with mean/max heart rate, speed and cadence.
+
+    reducer = make_reducer('time:5')      # 5 second buckets
+    reducer = make_reducer('distance:10') # a point every 10 metres
+    reducer = make_reducer('simplify:1')  # line simplification, tolerance scale 1
+"""
+import abc
+import math
+from bisect import bisect_right
+
+from tables import Field, TableSpec
+
+
+def _buckets(activity):
+    for bucket in activity.get('waypointBuckets') or ():
+        yield bucket, bucket['bucket_index'], None
+
+
+WAYPOINT_BUCKETS = TableSpec('waypoint_buckets', _buckets, [
+    Field("activity_id", "activity.activityId", "STRING", mode="REQUIRED"),
+    Field("bucket_index", "index", "INTEGER", mode="REQUIRED"),
+    Field("start_timestamp", "item.start_timestamp", "INTEGER"),
+    Field("end_timestamp", "item.end_timestamp", "INTEGER"),
+    Field("point_count", "item.point_count", "INTEGER"),
+    Field("lap_index", "item.lap_index", "INTEGER"),
+    Field("step_index", "item.step_index", "INTEGER"),
+    Field("start_distance", "item.start_distance", "FLOAT"),
+    Field("end_distance", "item.end_distance", "FLOAT"),
+    Field("heart_rate_mean", "item.heart_rate_mean", "FLOAT"),
+    Field("heart_rate_max", "item.heart_rate_max", "FLOAT"),
+    Field("speed_mean", "item.speed_mean", "FLOAT"),
+    Field("speed_max", "item.speed_max", "FLOAT"),
+    Field("cadence_mean", "item.cadence_mean", "FLOAT"),
+    Field("cadence_max", "item.cadence_max", "FLOAT"),
+    Field("processing_time", "processing_time", "DATE", mode="REQUIRED"),
+])
+
+# Channels summarised per bucket: output column prefix -> waypoint key
+AGGREGATES = {'heart_rate': 'heartRate', 'speed': 'speed', 'cadence': 'cadence'}
+
+# Largest deviation from the simplified line allowed per channel, at tolerance 1
+SIMPLIFY_TOLERANCES = {'speed': 0.25, 'heartRate': 3.0, 'elevation': 1.0, 'cadence': 4.0}
+
+
+def _segment_starts(waypoints, lap_starts):
+    """Indices where a new lap or step starts"""
+    starts = []
+    previous = None
+    for index, waypoint in enumerate(waypoints):
+        timestamp = waypoint.get('timestamp')
+        lap = bisect_right(lap_starts, timestamp) if lap_starts and timestamp is not None else None
+        key = (waypoint.get('lapIndex'), waypoint.get('stepIndex'), lap)
+        if key != previous:
+            starts.append(index)
+            previous = key
+    return starts
+
+
+def _stats(values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return None, None
+    return sum(values) / len(values), max(values)
+
+
+def _bucket(waypoints, index, start, end):
+    first, last = waypoints[start], waypoints[end - 1]
+    bucket = {
+        "bucket_index": index,
+        "start_timestamp": first.get('timestamp'),
+        "end_timestamp": last.get('timestamp'),
+        "point_count": end - start,
+        "lap_index": first.get('lapIndex'),
+        "step_index": first.get('stepIndex'),
+        "start_distance": first.get('distance'),
+        "end_distance": last.get('distance'),
+    }
+    span = waypoints[start:end]
+    for prefix, key in AGGREGATES.items():
+        bucket[f"{prefix}_mean"], bucket[f"{prefix}_max"] = _stats(waypoint.get(key) for waypoint in span)
+    return bucket
+
+
+class WaypointReducer(abc.ABC):
+    """Base reducer: subclasses add the points their strategy keeps within one segment"""
+
+    def __init__(self):
+        self.stats = {"activities": 0, "points_in": 0, "points_out": 0}
+
+    @abc.abstractmethod
+    def keep_in_segment(self, waypoints, start, end, keep):
+        """Adds the indices of the points to keep in waypoints[start:end] to the set keep"""
+
+    def kept_indices(self, activity):
+        waypoints = activity.get('waypoints') or []
+        lap_starts = sorted(lap['startTimestamp'] for lap in activity.get('laps') or ()
+                            if lap.get('startTimestamp') is not None)
+        keep = set()
+        starts = _segment_starts(waypoints, lap_starts)
+        for start, end in zip(starts, starts[1:] + [len(waypoints)]):
+            keep.update((start, end - 1))
+            self.keep_in_segment(waypoints, start, end, keep)
+        keep.update(index for index, waypoint in enumerate(waypoints) if waypoint.get('type'))
+        return sorted(keep)
+
+    def reduce(self, activity):
+        """Copy of the activity with only the kept waypoints, plus the buckets they stand for"""
+        waypoints = activity.get('waypoints') or []
+        kept = self.kept_indices(activity)
+        buckets = [_bucket(waypoints, index, start, end)
+                   for index, (start, end) in enumerate(zip(kept, kept[1:] + [len(waypoints)]))]
+        self.stats["activities"] += 1
+        self.stats["points_in"] += len(waypoints)
+        self.stats["points_out"] += len(kept)
+        return dict(activity, waypoints=[waypoints[index] for index in kept], waypointBuckets=buckets)
+
+    def ratio(self):
+        """Points kept per point read"""
+        return self.stats["points_out"] / self.stats["points_in"] if self.stats["points_in"] else 1.0
+
+
+class TimeBuckets(WaypointReducer):
+    """Keeps the first point of every `seconds` long bucket of a segment"""
+
+    def __init__(self, seconds):
+        super().__init__()
+        self.bucket_ms = seconds * 1000
+
+    def keep_in_segment(self, waypoints, start, end, keep):
+        origin = waypoints[start].get('timestamp')
+        previous = None
+        for index in range(start, end):
+            timestamp = waypoints[index].get('timestamp')
+            if origin is None or timestamp is None:
+                continue
+            bucket = (timestamp - origin) // self.bucket_ms
+            if bucket != previous:
+                keep.add(index)
+                previous = bucket
+
+
+class DistanceThinning(WaypointReducer):
+    """Keeps a point each time the runner has moved `meters` since the last kept one"""
+
+    def __init__(self, meters):
+        super().__init__()
+        self.meters = meters
+
+    def keep_in_segment(self, waypoints, start, end, keep):
+        last = waypoints[start].get('distance')
+        for index in range(start + 1, end):
+            distance = waypoints[index].get('distance')
+            if distance is None:
+                continue
+            if last is None or distance - last >= self.meters:
+                keep.add(index)
+                last = distance
+
+
+class LineSimplification(WaypointReducer):
+    """Ramer-Douglas-Peucker over the time series of speed, heart rate, elevation and cadence:
+    a point is kept when any channel strays further than its tolerance from the straight line
+    between the kept points around it. The waypoints carry no coordinates, so the line is the
+    metric profile rather than a GPS track"""
+
+    def __init__(self, tolerance=1.0, tolerances=SIMPLIFY_TOLERANCES):
+        super().__init__()
+        self.tolerances = {key: value * tolerance for key, value in tolerances.items()}
+
+    def _deviation(self, waypoints, first, last, index):
+        x0, x1 = waypoints[first].get('timestamp'), waypoints[last].get('timestamp')
+        x = waypoints[index].get('timestamp')
+        if None in (x0, x1, x) or x1 == x0:
+            share = (index - first) / (last - first)
+        else:
+            share = (x - x0) / (x1 - x0)
+        worst = 0.0
+        for key, tolerance in self.tolerances.items():
+            y0, y1, y = waypoints[first].get(key), waypoints[last].get(key), waypoints[index].get(key)
+            if None in (y0, y1, y):
+                continue
+            worst = max(worst, abs(y - (y0 + (y1 - y0) * share)) / tolerance)
+        return worst
+
+    def keep_in_segment(self, waypoints, start, end, keep):
+        #Iterative, so 100k point segments do not hit the recursion limit
+        stack = [(start, end - 1)]
+        while stack:
+            first, last = stack.pop()
+            if last - first < 2:
+                continue
+            worst, worst_index = max((self._deviation(waypoints, first, last, index), index)
+                                     for index in range(first + 1, last))
+            if worst > 1.0:
+                keep.add(worst_index)
+                stack.append((first, worst_index))
+                stack.append((worst_index, last))
+
+
+REDUCERS = {'time': TimeBuckets, 'distance': DistanceThinning, 'simplify': LineSimplification}
+
+
+def make_reducer(spec):
+    """Reducer from '<strategy>:<parameter>', e.g. 'time:5', 'distance:10' or 'simplify:1'.
+    The parameter must be a positive number; only simplify may leave it out"""
+    strategy, _, parameter = spec.partition(':')
+    try:
+        reducer_class = REDUCERS[strategy]
+    except KeyError:
+        raise ValueError(f"Unknown downsampling {spec}, expected one of {sorted(REDUCERS)} as <strategy>:<value>")
+    if not parameter:
+        if reducer_class is LineSimplification:
+            return reducer_class()
+        raise ValueError(f"Downsampling {spec} needs a value, e.g. {strategy}:5")
+    try:
+        value = float(parameter)
+    except ValueError:
+        value = None
+    if value is None or not math.isfinite(value) or value <= 0:
+        raise ValueError(f"Downsampling {spec} needs a positive number after '{strategy}:'")
+    return reducer_class(value)
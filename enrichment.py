@@ -0,0 +1,223 @@
+"""Optional enrichment of the waypoints with derived metrics, computed per activity with NumPy.
+
+For every waypoint, from `distance`, `timestamp`, `elevation` and `heartRate`:
+- pace_s_per_km: instantaneous pace since the previous point
+- rolling_pace_s_per_km: pace over the trailing `window_seconds`
+- grade_percent: elevation change over the trailing `grade_meters`, which smooths out GPS noise
+- hr_zone: heart rate zone 1-5, by the zone bounds as fractions of `max_heart_rate`
+
+These columns are written alongside the raw ones in `waypoint_data`. Each lap also gets a row of
+`lap_splits`: its distance, time and pace from the waypoints, the seconds spent in each zone, and
+the pace target of the workout step its `wktStepIndex` points to. Every array operation is a single
+pass or a binary search per point, so the cost grows linearly with the number of waypoints.
+
+    enricher = WaypointEnricher(max_heart_rate=185)
+    activity = enricher.enrich(activity)
+"""
+from tables import WAYPOINT_DATA, Field, TableSpec
+from waypoints import MISSING_INT, ColumnBatch, WaypointArrays, np
+
+
+# Lower bounds of zones 2-5 as fractions of the maximum heart rate; zone 1 is everything below
+HR_ZONE_BOUNDS = (0.6, 0.7, 0.8, 0.9)
+HR_ZONES = len(HR_ZONE_BOUNDS) + 1
+
+METRIC_FIELDS = [
+    Field("pace_s_per_km", "parent.pace_s_per_km", "FLOAT"),
+    Field("rolling_pace_s_per_km", "parent.rolling_pace_s_per_km", "FLOAT"),
+    Field("grade_percent", "parent.grade_percent", "FLOAT"),
+    Field("hr_zone", "parent.hr_zone", "INTEGER"),
+]
+METRIC_NAMES = [field.name for field in METRIC_FIELDS]
+
+
+def _nullable(values):
+    """Array as a list, with None for NaN"""
+    return [None if value != value else value for value in values.tolist()]
+
+
+def _enriched_waypoint_records(activity):
+    waypoints = activity.get('waypoints') or ()
+    metrics = activity.get('waypointMetrics')
+    if metrics is None:
+        for waypoint in waypoints:
+            yield waypoint, None, None
+        return
+    columns = [_nullable(metrics[name]) for name in METRIC_NAMES]
+    for waypoint, values in zip(waypoints, zip(*columns)):
+        yield waypoint, None, dict(zip(METRIC_NAMES, values))
+
+
+# waypoint_data with the derived columns before processing_time
+ENRICHED_WAYPOINT_DATA = WAYPOINT_DATA._replace(
+    records=_enriched_waypoint_records, fields=WAYPOINT_DATA.fields[:-1] + METRIC_FIELDS + WAYPOINT_DATA.fields[-1:])
+
+
+def _splits(activity):
+    for split in activity.get('lapSplits') or ():
+        yield split, split['lap_order'], None
+
+
+LAP_SPLITS = TableSpec('lap_splits', _splits, [
+    Field("activity_id", "activity.activityId", "STRING", mode="REQUIRED"),
+    Field("lap_order", "index", "INTEGER", mode="REQUIRED"),
+    Field("wkt_step_index", "item.wkt_step_index", "INTEGER"),
+    Field("step_intensity", "item.step_intensity", "STRING"),
+    Field("point_count", "item.point_count", "INTEGER"),
+    Field("distance", "item.distance", "FLOAT"),
+    Field("elapsed_seconds", "item.elapsed_seconds", "FLOAT"),
+    Field("pace_s_per_km", "item.pace_s_per_km", "FLOAT"),
+    Field("target_pace_s_per_km", "item.target_pace_s_per_km", "FLOAT"),
+    Field("pace_vs_target_s_per_km", "item.pace_vs_target_s_per_km", "FLOAT"),
+    Field("average_heart_rate", "item.average_heart_rate", "FLOAT"),
+] + [Field(f"zone_{zone}_seconds", f"item.zone_{zone}_seconds", "FLOAT") for zone in range(1, HR_ZONES + 1)] + [
+    Field("processing_time", "processing_time", "DATE", mode="REQUIRED"),
+])
+
+
+def workout_steps(activity):
+    """The workout's steps in the order laps number them with wktStepIndex: the children of a
+    repeat step come first, then the repeat step itself"""
+    steps = []
+    for step in (activity.get('plannedWorkoutMetadata') or {}).get('stepsV2') or ():
+        if step.get('type') == 'WorkoutRepeatStep':
+            steps.extend(step.get('steps') or ())
+        steps.append(step)
+    return steps
+
+
+def _column(waypoints, key):
+    return np.array([waypoint.get(key) for waypoint in waypoints], dtype=float)
+
+
+def _running_max(values):
+    """Non-decreasing copy for binary searches, treating missing values as -inf"""
+    return np.maximum.accumulate(np.where(np.isnan(values), -np.inf, values))
+
+
+def _trailing_ratio(numerator, denominator, starts, scale):
+    """scale * (numerator[i] - numerator[start]) / (denominator[i] - denominator[start]), NaN
+    where the denominator did not grow"""
+    change = denominator - denominator[starts]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(change > 0, scale * (numerator - numerator[starts]) / change, np.nan)
+
+
+class WaypointEnricher:
+    """Adds `waypointMetrics` (one array per derived column) and `lapSplits` to each activity.
+    Zone time is the time to the next point, ignoring gaps longer than max_gap_seconds (pauses)"""
+
+    def __init__(self, max_heart_rate=190, zone_bounds=HR_ZONE_BOUNDS, window_seconds=30, grade_meters=50,
+                 max_gap_seconds=10):
+        if np is None:
+            raise ImportError("numpy is required for waypoint enrichment: pip install numpy")
+        self.max_heart_rate = max_heart_rate
+        self.zone_bounds = np.array(zone_bounds) * max_heart_rate
+        self.window_seconds = window_seconds
+        self.grade_meters = grade_meters
+        self.max_gap_seconds = max_gap_seconds
+        self.stats = {"activities": 0, "points": 0}
+
+    def metrics(self, waypoints):
+        """Derived per-waypoint arrays, plus the seconds each point stands for and its zone"""
+        seconds = _column(waypoints, 'timestamp') / 1000
+        distance = _column(waypoints, 'distance')
+        elevation = _column(waypoints, 'elevation')
+        heart_rate = _column(waypoints, 'heartRate')
+
+        pace = _trailing_ratio(seconds, distance, np.maximum(np.arange(len(seconds)) - 1, 0), 1000)
+        elapsed = _running_max(seconds)
+        window_starts = np.searchsorted(elapsed, elapsed - self.window_seconds, side='left')
+        rolling_pace = _trailing_ratio(seconds, distance, window_starts, 1000)
+        covered = _running_max(distance)
+        grade_starts = np.searchsorted(covered, covered - self.grade_meters, side='left')
+        grade = _trailing_ratio(elevation, distance, grade_starts, 100)
+
+        valid_heart_rate = heart_rate > 0
+        zone = np.searchsorted(self.zone_bounds, np.where(valid_heart_rate, heart_rate, 0), side='right') + 1
+        hr_zone = np.where(valid_heart_rate, zone, np.nan)
+
+        step = np.diff(seconds, append=seconds[-1:]) if len(seconds) else seconds
+        step = np.where((step >= 0) & (step <= self.max_gap_seconds), step, 0.0)
+        metrics = {"pace_s_per_km": pace, "rolling_pace_s_per_km": rolling_pace,
+                   "grade_percent": grade, "hr_zone": hr_zone}
+        return metrics, seconds, distance, heart_rate, step, zone * valid_heart_rate
+
+    def splits(self, activity, seconds, distance, heart_rate, step, zone):
+        """One row per lap, from the waypoints between its start and the next lap's start"""
+        laps = activity.get('laps') or ()
+        lap_starts = np.array([lap.get('startTimestamp') for lap in laps], dtype=float) / 1000
+        if not len(laps) or np.isnan(lap_starts).any():
+            return []
+        lap_of_point = np.clip(np.searchsorted(lap_starts, np.nan_to_num(seconds, nan=-np.inf), side='right') - 1,
+                               0, None)
+        counts = np.bincount(lap_of_point, minlength=len(laps))
+        firsts = np.concatenate(([0], np.cumsum(counts)))
+        valid = ~np.isnan(heart_rate) & (heart_rate > 0)
+        heart_rate_sums = np.bincount(lap_of_point, np.where(valid, heart_rate, 0), minlength=len(laps))
+        heart_rate_counts = np.bincount(lap_of_point, valid, minlength=len(laps))
+        zone_seconds = np.bincount(lap_of_point * HR_ZONES + np.maximum(zone - 1, 0), step * (zone > 0),
+                                   minlength=len(laps) * HR_ZONES).reshape(len(laps), HR_ZONES)
+        steps = workout_steps(activity)
+
+        splits = []
+        for index, lap in enumerate(laps):
+            first, end = firsts[index], firsts[index + 1]
+            #A lap runs until the first point of the next one, or the last point for the final lap
+            last = min(end, len(seconds) - 1)
+            lap_distance = float(distance[last] - distance[first]) if end > first else None
+            lap_seconds = float(seconds[last] - seconds[first]) if end > first else None
+            pace = lap_seconds / lap_distance * 1000 if lap_distance and lap_seconds is not None else None
+            step_index = lap.get('wktStepIndex')
+            step = steps[step_index] if step_index is not None and 0 <= step_index < len(steps) else {}
+            target_speed = ((step.get('paces') or {}).get('average') or {}).get('mps')
+            target_pace = 1000 / target_speed if target_speed else None
+            split = {
+                "lap_order": index,
+                "wkt_step_index": step_index,
+                "step_intensity": step.get('intensity'),
+                "point_count": int(counts[index]),
+                "distance": lap_distance,
+                "elapsed_seconds": lap_seconds,
+                "pace_s_per_km": pace,
+                "target_pace_s_per_km": target_pace,
+                "pace_vs_target_s_per_km": pace - target_pace if pace is not None and target_pace else None,
+                "average_heart_rate": (float(heart_rate_sums[index] / heart_rate_counts[index])
+                                       if heart_rate_counts[index] else None),
+            }
+            for zone_index in range(HR_ZONES):
+                split[f"zone_{zone_index + 1}_seconds"] = float(zone_seconds[index, zone_index])
+            splits.append(split)
+        return splits
+
+    def enrich(self, activity):
+        """Copy of the activity with its waypoint metrics and lap splits"""
+        waypoints = activity.get('waypoints') or []
+        metrics, seconds, distance, heart_rate, step, zone = self.metrics(waypoints)
+        self.stats["activities"] += 1
+        self.stats["points"] += len(waypoints)
+        return dict(activity, waypointMetrics=metrics,
+                    lapSplits=self.splits(activity, seconds, distance, heart_rate, step, zone))
+
+
+class EnrichedWaypointArrays(WaypointArrays):
+    """Column builder for the enriched waypoint_data: the raw columns as WaypointArrays builds
+    them, with the derived arrays copied in from the activity's waypointMetrics"""
+
+    def __init__(self, processing_time, spec=ENRICHED_WAYPOINT_DATA):
+        super().__init__(processing_time, spec)
+        self.enriched_dtype = np.dtype(self.dtype.descr + [(field.name, 'i8' if field.type == 'INTEGER' else 'f8')
+                                                           for field in METRIC_FIELDS])
+
+    def build(self, activity):
+        batch = super().build(activity)
+        values = np.empty(len(batch), self.enriched_dtype)
+        for name in batch.values.dtype.names:
+            values[name] = batch.values[name]
+        metrics = activity.get('waypointMetrics')
+        for field in METRIC_FIELDS:
+            column = metrics[field.name] if metrics is not None else np.full(len(batch), np.nan)
+            if field.type == 'INTEGER':
+                column = np.where(np.isnan(column), MISSING_INT, np.nan_to_num(column)).astype('i8')
+            values[field.name] = column
+        return ColumnBatch(self.spec, values, batch.constants)
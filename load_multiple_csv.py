@@ -1,55 +1,246 @@
-from google.cloud import bigquery, storage
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import json
 import os
+import time
 
+from cloud import bigquery, storage
+from cloud import bigquery_client as shared_bigquery_client, storage_client as shared_storage_client
+from dimensions import DIMENSION_TABLES, KEYED_COLUMNS, keyed_spec
+from downsampling import WAYPOINT_BUCKETS
+from enrichment import ENRICHED_WAYPOINT_DATA, LAP_SPLITS
+from summaries import SNAPSHOT_TABLES, SUMMARY_TABLES
+from tables import TABLES
 
-from google.cloud import bigquery
-from google.cloud import storage
+SPECS_BY_TABLE = {spec.name: spec
+                  for spec in TABLES + SUMMARY_TABLES + [WAYPOINT_BUCKETS, LAP_SPLITS] + DIMENSION_TABLES}
+SNAPSHOT_TABLE_NAMES = {spec.name for spec in SNAPSHOT_TABLES + DIMENSION_TABLES}
 
-def load_csv_files_to_bigquery(bucket_name, dataset_id):
+
+def bigquery_schema(spec):
+    """Explicit BigQuery schema of a table from the shared registry in tables.py"""
+    return [bigquery.SchemaField(field.name, field.type, mode=field.mode) for field in spec.fields]
+
+
+def time_partitioning(spec):
+    return bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY, field=spec.partition_field)
+
+
+def ensure_table(bigquery_client, dataset_id, spec):
+    """Creates the table partitioned and clustered as registered, if it does not exist yet"""
+    table = bigquery.Table(bigquery_client.dataset(dataset_id).table(spec.name), schema=bigquery_schema(spec))
+    table.time_partitioning = time_partitioning(spec)
+    table.clustering_fields = list(spec.cluster_fields)
+    bigquery_client.create_table(table, exists_ok=True)
+
+
+def load_job_config(extension, write_disposition=None, spec=None):
+    """Registered tables load with their explicit schema, partitioning and clustering;
+    anything else falls back to autodetect for csv. Parquet files carry their own types.
+    The write disposition defaults to WRITE_TRUNCATE"""
+    write_disposition = write_disposition or bigquery.WriteDisposition.WRITE_TRUNCATE
+    config = bigquery.LoadJobConfig(write_disposition=write_disposition)
+    if extension == '.parquet':
+        config.source_format = bigquery.SourceFormat.PARQUET
+    else:
+        config.source_format = bigquery.SourceFormat.CSV
+        config.skip_leading_rows = 1  # Skip the header row
+    if spec is None:
+        config.autodetect = extension != '.parquet'  # Automatically detect the schema
+        return config
+    config.schema = bigquery_schema(spec)
+    config.time_partitioning = time_partitioning(spec)
+    config.clustering_fields = list(spec.cluster_fields)
+    if write_disposition == bigquery.WriteDisposition.WRITE_APPEND:
+        #Columns registered after the table was created, such as step_data's pace seconds, are added
+        config.schema_update_options = [bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION]
+    return config
+
+
+def delete_redelivered_activities(bigquery_client, dataset_id, table_name, activity_ids, keyed=False):
+    """Removes the previous rows of re-delivered activities so the appended delta replaces them.
+    Tables written with surrogate keys are matched on activity_key, so activity_ids are keys"""
+    column, column_type = ("activity_key", "INT64") if keyed else ("activity_id", "STRING")
+    query = f"DELETE FROM `{dataset_id}.{table_name}` WHERE {column} IN UNNEST(@activity_ids)"
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ArrayQueryParameter("activity_ids", column_type, activity_ids)]
+    )
+    bigquery_client.query(query, job_config=job_config).result()
+
+
+LoadReport = namedtuple('LoadReport', ['table_name', 'uris', 'status', 'output_rows', 'seconds', 'error'])
+
+
+def group_blobs(blob_names, run_id=None):
+    """Groups blobs into one load per table so per-run or per-shard files share a multi-URI job,
+    as {table: (extension, names)}. Without a run id only top level table files are picked up;
+    with one, only the <table>/<run id>[-<shard>] files of that run. Extensions are kept whole
+    (.csv.gz). A table staged in two formats, e.g. activity_data and activity_data.parquet, raises
+    a ValueError, since either load would replace the other"""
+    groups = {}
+    for name in blob_names:
+        table_name, _, file_name = name.rpartition('/')
+        stem, dot, extension = file_name.partition('.')
+        extension = dot + extension
+        if run_id:
+            if table_name in ('', 'runs') or not (stem == run_id or stem.startswith(f"{run_id}-")):
+                continue
+        elif table_name:
+            continue
+        table_name = table_name or stem
+        staged_extension, names = groups.setdefault(table_name, (extension, []))
+        if staged_extension != extension:
+            raise ValueError(f"Table {table_name} is staged both as {names[0]} and as {name}; "
+                             f"remove the stale format before loading")
+        names.append(name)
+    return groups
+
+
+def source_uris(bucket_name, names, extension, run_id=None):
+    """Source URIs of one table's load. The shards of a run, <table>/<run id>-<index><extension>,
+    collapse into a single wildcard URI, so any number of shards is one logical table"""
+    table_name = names[0].rpartition('/')[0]
+    shard_prefix = f"{table_name}/{run_id}-"
+    if run_id and len(names) > 1 and all(name.startswith(shard_prefix) for name in names):
+        return [f'gs://{bucket_name}/{shard_prefix}*{extension}']
+    return [f'gs://{bucket_name}/{name}' for name in names]
+
+
+def table_spec(table_name, surrogate_keys=False, enriched=False):
+    """Registered spec of a table as it was written, or None for unregistered tables"""
+    spec = SPECS_BY_TABLE.get(table_name)
+    if enriched and table_name == ENRICHED_WAYPOINT_DATA.name:
+        spec = ENRICHED_WAYPOINT_DATA
+    if spec is not None and surrogate_keys:
+        return keyed_spec(spec)
+    return spec
+
+
+def _run_load_job(bigquery_client, dataset_id, table_name, uris, job_config, redelivered, surrogate_keys=False,
+                  enriched=False):
+    """Submits one load job and waits on it; runs on a worker thread"""
+    started = time.perf_counter()
+    try:
+        if table_name in SPECS_BY_TABLE:
+            ensure_table(bigquery_client, dataset_id, table_spec(table_name, surrogate_keys, enriched))
+        if redelivered:
+            delete_redelivered_activities(bigquery_client, dataset_id, table_name, redelivered,
+                                          surrogate_keys and table_name in KEYED_COLUMNS)
+        table_ref = bigquery_client.dataset(dataset_id).table(table_name)
+        load_job = bigquery_client.load_table_from_uri(uris, table_ref, job_config=job_config)
+        load_job.result()
+        print(f'Loaded {len(uris)} file(s) into {dataset_id}.{table_name}')
+        return LoadReport(table_name, uris, 'SUCCESS', load_job.output_rows, time.perf_counter() - started, None)
+    except Exception as e:
+        print(f"Error loading {dataset_id}.{table_name}: {e}")
+        return LoadReport(table_name, uris, 'FAILED', None, time.perf_counter() - started, str(e))
+
+
+def print_load_report(reports):
+    for report in reports:
+        print(f"{report.table_name}: {report.status} ({len(report.uris)} file(s), "
+              f"{report.seconds:.1f}s){' - ' + report.error if report.error else ''}")
+
+
+def record_load_metrics(metrics, reports):
+    """Adds each table's load job to the 'bigquery_load' stage of a PipelineMetrics"""
+    for report in reports:
+        metrics.table('bigquery_load', report.table_name, rows_out=report.output_rows,
+                      wall_seconds=report.seconds, failures=int(report.status == 'FAILED'))
+
+
+def load_csv_files_to_bigquery(bucket_name, dataset_id, run_id=None, max_concurrent_jobs=5, metrics=None,
+                               surrogate_keys=False, enriched=False, bigquery_client=None, storage_client=None):
+    """Loads the staged files into BigQuery. Without a run id every top level table file
+    replaces its table. With one, only that run's <table>/<run id> files are loaded: a full
+    sharded run replaces each table, while an incremental run's deltas are appended after
+    deleting the rows of any activity the run re-delivered. Files written with surrogate
+    keys or enriched waypoints load with the keyed or enriched schemas; a run file says
+    so itself, top level files need surrogate_keys=True or enriched=True.
+
+    Each table is loaded by one multi-URI job. Up to max_concurrent_jobs jobs run at once
+    and a per-table report is returned once all of them have finished. When a PipelineMetrics
+    is given, the load is timed as its 'bigquery_load' stage. The clients default to the
+    process's shared ones."""
     if not bucket_name or not dataset_id:
         raise ValueError("Bucket name and dataset ID must be provided")
 
-    # Initialize BigQuery client and GCS client in order to connect to GCP 
-    bigquery_client = bigquery.Client()
-    storage_client = storage.Client()
+    # Reuse the process's BigQuery and GCS clients to connect to GCP
+    bigquery_client = bigquery_client or shared_bigquery_client()
+    storage_client = storage_client or shared_storage_client()
 
     try:
         bucket = storage_client.bucket(bucket_name)
-        blobs = bucket.list_blobs()
-        
-        for blob in blobs:
-            
-            # Define the URI for the CSV file in the bucket
-            uri = f'gs://{bucket_name}/{blob.name}'
-            
-            table_ref = bigquery_client.dataset(dataset_id).table(blob.name)
-            
-            # Configure the load job
-            job_config = bigquery.LoadJobConfig(
-                write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
-                source_format=bigquery.SourceFormat.CSV,
-                skip_leading_rows=1,  # Skip the header row
-                autodetect=True,  # Automatically detect the schema
-            )
-            
-            # Load the CSV file into BigQuery
-            load_job = bigquery_client.load_table_from_uri(
-                uri,
-                table_ref,
-                job_config=job_config
-            )
-
-            load_job.result()
-            print(f'Loaded {blob.name} into {dataset_id}.{blob.name}')
+        write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
+        redelivered = []
+        redelivered_keys = []
+        if run_id:
+            run = json.loads(bucket.blob(f"runs/{run_id}.json").download_as_text())
+            surrogate_keys = run.get("surrogate_keys", surrogate_keys)
+            enriched = run.get("enriched", enriched)
+            # A full (sharded) run replaces the tables; an incremental one appends its deltas
+            if run.get("mode", "incremental") == "incremental":
+                write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+                redelivered = run.get("redelivered_activity_ids", [])
+                redelivered_keys = run.get("redelivered_activity_keys", [])
+        groups = group_blobs([blob.name for blob in bucket.list_blobs()], run_id)
     except Exception as e:
         print(f"Error loading files {e}")
         raise
 
+    stage = metrics.stage('bigquery_load') if metrics is not None else nullcontext()
+    with stage, ThreadPoolExecutor(max_workers=max_concurrent_jobs) as executor:
+        futures = []
+        for table_name, (extension, names) in groups.items():
+            # Summary snapshots are rebuilt whole by every run, so they always replace their table
+            snapshot = table_name in SNAPSHOT_TABLE_NAMES
+            job_config = load_job_config(extension,
+                                         bigquery.WriteDisposition.WRITE_TRUNCATE if snapshot else write_disposition,
+                                         table_spec(table_name, surrogate_keys, enriched))
+            if snapshot:
+                table_redelivered = []
+            elif surrogate_keys and table_name in KEYED_COLUMNS:
+                table_redelivered = redelivered_keys
+            else:
+                table_redelivered = redelivered
+            futures.append(executor.submit(_run_load_job, bigquery_client, dataset_id, table_name,
+                                           source_uris(bucket_name, names, extension, run_id), job_config,
+                                           table_redelivered, surrogate_keys, enriched))
+    reports = [future.result() for future in futures]
+    print_load_report(reports)
+    if metrics is not None:
+        record_load_metrics(metrics, reports)
+
+    failed = [report.table_name for report in reports if report.status == 'FAILED']
+    if failed:
+        raise RuntimeError(f"Failed to load tables: {', '.join(failed)}")
+    return reports
+
 if __name__ == '__main__':
-    # Define name of dataset and bucket name created in GCP project
-    bucket_name = 'runna'
-    dataset_id = 'runna'
-    
-    load_csv_files_to_bigquery(bucket_name, dataset_id)
+    import argparse
+    from metrics import PipelineMetrics, profiled
+
+    parser = argparse.ArgumentParser(description="Load the staged files into BigQuery")
+    # Pass the run id printed by an incremental import to append only that run
+    parser.add_argument('run_id', nargs='?', default=None)
+    # Names of the bucket and dataset created in the GCP project
+    parser.add_argument('--bucket', default='runna')
+    parser.add_argument('--dataset', default='runna')
+    parser.add_argument('--report', help="write a JSON run report to this path")
+    parser.add_argument('--profile', help="dump cProfile stats to this path")
+    parser.add_argument('--surrogate-keys', action='store_true',
+                        help="top level files were written with --surrogate-keys; run files say so themselves")
+    parser.add_argument('--enriched', action='store_true', help="top level files were written with --enrich")
+    args = parser.parse_args()
+
+    metrics = PipelineMetrics()
+    try:
+        with profiled(args.profile):
+            load_csv_files_to_bigquery(args.bucket, args.dataset, args.run_id, metrics=metrics,
+                                       surrogate_keys=args.surrogate_keys, enriched=args.enriched)
+    finally:
+        if args.report:
+            metrics.write_report(args.report)
 
 
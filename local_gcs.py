@@ -0,0 +1,62 @@
+import os
+import shutil
+import time
+from pathlib import Path
+
+
+class LocalBlob:
+    def __init__(self, bucket, name, chunk_size=None):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = chunk_size
+
+    @property
+    def path(self):
+        return self.bucket.path / self.name
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def upload_from_filename(self, filename):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(filename, self.path)
+        self.bucket.client.simulate_transfer(os.path.getsize(filename))
+
+    def download_as_text(self):
+        return self.path.read_text()
+
+
+class LocalBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.path = Path(client.root) / name
+
+    def blob(self, blob_name, chunk_size=None):
+        return LocalBlob(self, blob_name, chunk_size)
+
+    def list_blobs(self, prefix=None):
+        if not self.path.exists():
+            return []
+        names = sorted(path.relative_to(self.path).as_posix() for path in self.path.rglob('*') if path.is_file())
+        return [LocalBlob(self, name) for name in names if prefix is None or name.startswith(prefix)]
+
+
+class LocalStorageClient:
+    """Stand-in for google.cloud.storage.Client that keeps buckets as local directories,
+    for tests, benchmarks and offline runs. latency (seconds per upload) and bytes_per_second
+    make uploads take about as long as they would over a network"""
+
+    def __init__(self, root, latency=0.0, bytes_per_second=None):
+        self.root = root
+        self.latency = latency
+        self.bytes_per_second = bytes_per_second
+
+    def simulate_transfer(self, size):
+        delay = self.latency + (size / self.bytes_per_second if self.bytes_per_second else 0.0)
+        if delay:
+            time.sleep(delay)
+
+    def bucket(self, bucket_name):
+        return LocalBucket(self, bucket_name)
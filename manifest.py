@@ -0,0 +1,54 @@
+import hashlib
+import json
+import os
+
+
+class Manifest:
+    """Local record of the activity files already imported (path, size, mtime, content hash)
+    so incremental runs only parse files that are new or changed"""
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        if os.path.exists(path):
+            with open(path, 'r') as manifest_file:
+                self.files = json.load(manifest_file)
+        self.known_activity_ids = {activity_id for entry in self.files.values()
+                                   for activity_id in entry.get('activity_ids', [])}
+
+    @staticmethod
+    def digest(content):
+        return hashlib.sha256(content).hexdigest()
+
+    def is_changed(self, json_file):
+        """New files are always pending; known files are only hashed when size or mtime moved"""
+        entry = self.files.get(str(json_file))
+        if entry is None:
+            return True
+        stat = os.stat(json_file)
+        if stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime_ns']:
+            return False
+        with open(json_file, 'rb') as f:
+            if self.digest(f.read()) == entry['sha256']:
+                entry['mtime_ns'] = stat.st_mtime_ns
+                return False
+        return True
+
+    def pending(self, json_files):
+        return [json_file for json_file in json_files if self.is_changed(json_file)]
+
+    def record(self, json_file, content, activity_id):
+        stat = os.stat(json_file)
+        self.files[str(json_file)] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": self.digest(content),
+            "activity_ids": [activity_id],
+        }
+
+    def save(self):
+        """Writes the manifest atomically so an interrupted run never leaves it half written"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as manifest_file:
+            json.dump(self.files, manifest_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,106 @@
+import cProfile
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+
+def _counters():
+    return {"wall_seconds": 0.0, "cpu_seconds": 0.0, "rows_in": 0, "rows_out": 0,
+            "bytes_written": 0, "peak_memory_bytes": None, "failures": 0}
+
+
+class PipelineMetrics:
+    """Collects per-stage and per-table timings, row counts, bytes, memory peaks and failures
+    for one run, and writes them as a JSON run report.
+
+    Peak memory comes from tracemalloc, which slows Python allocation down noticeably, so it
+    is only measured when trace_memory is set.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.stages = []
+        self.tables = {}
+        # Named groups of plain counts, such as the step template cache's hits and misses
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Times a stage; the yielded dict can be filled with rows/bytes while it runs"""
+        record = dict(_counters(), stage=name)
+        started_tracing = False
+        if self.trace_memory:
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.start()
+                started_tracing = True
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        except Exception:
+            record["failures"] += 1
+            raise
+        finally:
+            record["wall_seconds"] += time.perf_counter() - wall
+            record["cpu_seconds"] += time.process_time() - cpu
+            if self.trace_memory:
+                record["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+                if started_tracing:
+                    tracemalloc.stop()
+            self.stages.append(record)
+
+    def table(self, stage, table_name, **counts):
+        """Adds counts (rows_out=..., bytes_written=..., failures=...) to a table within a stage"""
+        record = self.tables.setdefault((stage, table_name), dict(_counters(), stage=stage, table=table_name))
+        for key, value in counts.items():
+            if value is not None:
+                record[key] = (record[key] or 0) + value
+        return record
+
+    def count(self, name, **counts):
+        """Adds counts to the named counter group, creating any count not seen before"""
+        group = self.counters.setdefault(name, {})
+        for key, value in counts.items():
+            group[key] = group.get(key, 0) + value
+        return group
+
+    def failure(self, stage, table_name=None):
+        if table_name is None:
+            self.stages.append(dict(_counters(), stage=stage, failures=1))
+        else:
+            self.table(stage, table_name, failures=1)
+
+    def report(self):
+        return {
+            "started_at": self.started_at,
+            "stages": self.stages,
+            "tables": list(self.tables.values()),
+            "counters": self.counters,
+            "failures": sum(record["failures"] for record in self.stages)
+                        + sum(record["failures"] for record in self.tables.values()),
+        }
+
+    def write_report(self, path):
+        with open(path, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=2)
+        print(f"Run report written to {path}")
+
+
+@contextmanager
+def profiled(path):
+    """Runs the block under cProfile and dumps the stats to path; a no-op when path is None"""
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print(f"Profile written to {path}")
@@ -0,0 +1,158 @@
+"""Optional dedup-and-order stage for the activities, ahead of downsampling and extraction.
+
+Activities come out sorted by (userId, start time), where the start time is `createdOn`, else
+the first lap's `startTimestamp`, else the first waypoint's `timestamp`. Rows of a user then
+sit together, which helps compression and BigQuery clustering. When an activityId is
+delivered more than once, e.g. a PHONE and a GARMIN copy or a re-sync, only one copy is kept,
+chosen by a precedence:
+- garmin: a GARMIN copy over a PHONE one, then the copy with the most waypoints
+- most_waypoints: the copy with the most waypoints
+- latest: the copy read last
+- first: the copy read first
+Remaining ties go to the copy read last.
+
+Sorting is an external merge sort, so memory stays bounded. Up to `buffer_size` activities
+are sorted in memory; beyond that, each full buffer is spilled to disk as a sorted run, and the
+runs are merged lazily. Only the winning copy's rank per activityId is held for the whole pass.
+
+    orderer = ActivityOrderer(precedence='garmin', buffer_size=5000)
+    activities = orderer.apply(activities)
+"""
+import heapq
+import os
+import pickle
+import tempfile
+from operator import itemgetter
+
+
+def _garmin(activity, sequence):
+    return activity.get('recordType') == 'GARMIN', len(activity.get('waypoints') or ()), sequence
+
+
+def _most_waypoints(activity, sequence):
+    return len(activity.get('waypoints') or ()), sequence
+
+
+def _latest(activity, sequence):
+    return sequence
+
+
+def _first(activity, sequence):
+    return -sequence
+
+
+# Rank of a copy of an activity read at position sequence; the highest rank is kept
+PRECEDENCES = {'garmin': _garmin, 'most_waypoints': _most_waypoints, 'latest': _latest, 'first': _first}
+
+# Runs merged at once; more runs are first merged into longer ones, bounding open files
+MERGE_FAN_IN = 64
+
+
+def start_time(activity):
+    """createdOn, the first lap's startTimestamp or the first waypoint's timestamp, or None"""
+    start = activity.get('createdOn')
+    if start is None:
+        for key, timestamp in (('laps', 'startTimestamp'), ('waypoints', 'timestamp')):
+            items = activity.get(key)
+            if items:
+                start = items[0].get(timestamp)
+                if start is not None:
+                    break
+    return start if isinstance(start, (int, float)) else None
+
+
+def sort_key(activity, sequence):
+    """(userId, start time, activityId, sequence): activities without a start time come last
+    for their user, and sequence keeps the order total and stable"""
+    start = start_time(activity)
+    return (str(activity.get('userId') or ''), start is None, start or 0, str(activity.get('activityId') or ''),
+            sequence)
+
+
+def _write_run(entries, directory, index):
+    path = os.path.join(directory, f"run-{index:06d}.pickle")
+    with open(path, 'wb') as run_file:
+        for entry in entries:
+            pickle.dump(entry, run_file, pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def _read_run(path):
+    with open(path, 'rb') as run_file:
+        while True:
+            try:
+                yield pickle.load(run_file)
+            except EOFError:
+                return
+
+
+class ActivityOrderer:
+    """Sorts activities by user and start time, dropping duplicate activityIds by precedence.
+    stats counts the activities read and written, the duplicates dropped and the runs spilled"""
+
+    def __init__(self, precedence='garmin', buffer_size=10_000, spill_directory=None):
+        if precedence not in PRECEDENCES:
+            raise ValueError(f"Unknown precedence {precedence}, expected one of {', '.join(PRECEDENCES)}")
+        if buffer_size < 1:
+            raise ValueError("buffer_size must be at least 1")
+        self.precedence = precedence
+        self.rank = PRECEDENCES[precedence]
+        self.buffer_size = buffer_size
+        self.spill_directory = spill_directory
+        self.stats = {"activities_in": 0, "activities_out": 0, "duplicates": 0, "spilled_runs": 0,
+                      "spilled_bytes": 0}
+
+    def apply(self, activities):
+        """Yields the activities in order, once all of them have been read"""
+        with tempfile.TemporaryDirectory(dir=self.spill_directory, prefix='activity-runs-') as directory:
+            winners = {}
+            runs = []
+            buffer = []
+            for sequence, activity in enumerate(activities):
+                self.stats["activities_in"] += 1
+                activity_id = activity.get('activityId')
+                if activity_id is not None:
+                    rank = self.rank(activity, sequence)
+                    best = winners.get(activity_id)
+                    if best is not None and best[0] >= rank:
+                        #A copy that loses now never wins, since the best rank only grows
+                        self.stats["duplicates"] += 1
+                        continue
+                    if best is not None:
+                        #The earlier copy is dropped when the runs are merged
+                        self.stats["duplicates"] += 1
+                    winners[activity_id] = (rank, sequence)
+                buffer.append((sort_key(activity, sequence), activity))
+                if len(buffer) >= self.buffer_size:
+                    buffer.sort(key=itemgetter(0))
+                    runs.append(self._spill(buffer, directory))
+                    buffer = []
+            buffer.sort(key=itemgetter(0))
+
+            while len(runs) > MERGE_FAN_IN:
+                merged = heapq.merge(*[_read_run(path) for path in runs[:MERGE_FAN_IN]], key=itemgetter(0))
+                path = self._spill(merged, directory)
+                for spilled in runs[:MERGE_FAN_IN]:
+                    os.remove(spilled)
+                runs = runs[MERGE_FAN_IN:] + [path]
+
+            for key, activity in heapq.merge(*[_read_run(path) for path in runs], buffer, key=itemgetter(0)):
+                activity_id = activity.get('activityId')
+                if activity_id is not None and winners[activity_id][1] != key[-1]:
+                    continue
+                self.stats["activities_out"] += 1
+                yield activity
+
+    def _spill(self, entries, directory):
+        """Writes sorted entries as the next run file"""
+        path = _write_run(entries, directory, self.stats["spilled_runs"])
+        self.stats["spilled_runs"] += 1
+        self.stats["spilled_bytes"] += os.path.getsize(path)
+        return path
+
+
+def make_orderer(precedence, buffer_size=10_000, spill_directory=None):
+    """ActivityOrderer for a precedence name, or None when precedence is None"""
+    if precedence is None:
+        return None
+    return ActivityOrderer(precedence, buffer_size, spill_directory)
@@ -0,0 +1,102 @@
+"""Cache of flattened step_data templates for repeated workout plans.
+
+Many users run the same workout, and each of their activities carries the same
+`plannedWorkoutMetadata.stepsV2` tree. Apart from activity_id, the step_data records of
+an activity depend only on that tree and the run's processing_time. StepTemplates
+flattens each distinct tree once into a template of records, keyed by the values the
+spec reads from each step, and stamps the activity's own columns into copies of it:
+
+    engine = ExtractionEngine(processing_time, record_builders={'step_data': StepTemplates(processing_time)})
+
+Templates are kept in a bounded LRU cache. `stats` counts hits, misses and evictions.
+"""
+from collections import OrderedDict
+
+from tables import STEP_DATA, compile_field, compile_getter, compile_value
+
+# Distinct step trees kept flattened, each a few records
+DEFAULT_CACHE_SIZE = 1024
+
+
+class StepTemplates:
+    """Builds a table's records from cached per-structure templates. Columns sourced from
+    the activity are stamped per activity; every other column is read once per template"""
+
+    def __init__(self, processing_time, spec=STEP_DATA, maxsize=DEFAULT_CACHE_SIZE):
+        self.spec = spec
+        self.maxsize = maxsize
+        getters = [get for _, get in (compile_field(field, processing_time) for field in spec.fields)]
+        self._stamps = [(index, getters[index]) for index, field in enumerate(spec.fields)
+                        if field.source.startswith('activity.')]
+        #A template only depends on the position and the item and parent keys its columns read.
+        #A key entry is (index, *values read), and each column is built from one of its slots
+        sources = list(dict.fromkeys(field.source for field in spec.fields
+                                     if field.source.startswith(('item.', 'parent.'))))
+        self._key_getters = [compile_getter(source, processing_time) for source in sources]
+        self._columns = []
+        for field, get in zip(spec.fields, getters):
+            if field.source == 'index' or field.source in sources:
+                slot = 0 if field.source == 'index' else 1 + sources.index(field.source)
+                self._columns.append((slot, compile_value(field)))
+            elif field.source.startswith('activity.'):
+                self._columns.append((None, None))
+            else:
+                self._columns.append((None, get(None, None, None, None)))
+        self._templates = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def structure_key(self, activity):
+        """The values the spec reads from each of the activity's steps, which fully determine
+        its template. Keys no column reads, such as __typename, leave it unchanged"""
+        getters = self._key_getters
+        return tuple((index, *[get(None, item, index, parent) for get in getters])
+                     for item, index, parent in self.spec.records(activity))
+
+    def _build(self, key):
+        """Template records from a key's entries, with None in the stamped columns"""
+        columns = self._columns
+        return tuple(tuple([value if slot is None else value(entry[slot]) for slot, value in columns])
+                     for entry in key)
+
+    def template(self, activity):
+        """The activity's records with None in the stamped columns, from the cache when its steps were seen"""
+        key = self.structure_key(activity)
+        if not key:
+            return ()
+        try:
+            template = self._templates.get(key)
+        except TypeError:
+            #A step value that is itself an object or list can't be hashed, so it is built uncached
+            self.stats["misses"] += 1
+            return self._build(key)
+        if template is not None:
+            self._templates.move_to_end(key)
+            self.stats["hits"] += 1
+            return template
+        self.stats["misses"] += 1
+        template = self._templates[key] = self._build(key)
+        if len(self._templates) > self.maxsize:
+            self._templates.popitem(last=False)
+            self.stats["evictions"] += 1
+        return template
+
+    def records(self, activity):
+        """The activity's records, as ExtractionEngine.records would build them"""
+        template = self.template(activity)
+        if not template or not self._stamps:
+            return template
+        if len(self._stamps) == 1:
+            index, get = self._stamps[0]
+            value = (get(activity, None, None, None),)
+            return [record[:index] + value + record[index + 1:] for record in template]
+        values = [(index, get(activity, None, None, None)) for index, get in self._stamps]
+        stamped = []
+        for record in template:
+            record = list(record)
+            for index, value in values:
+                record[index] = value
+            stamped.append(tuple(record))
+        return stamped
+
+    def __len__(self):
+        return len(self._templates)
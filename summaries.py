@@ -0,0 +1,222 @@
+"""Summary tables rolled up from the activities during the import pass.
+
+`activity_summary` is an ordinary per-activity table that the extraction engine fills in
+the same pass as the raw tables. `user_week_summary` and `workout_leaderboard` are built
+from the activity summaries kept in a SummaryStore. The store is saved between incremental
+runs, so they are rebuilt from one small row per activity instead of rescanning laps,
+steps and waypoints. They are snapshots, so the loader replaces them on every run.
+"""
+import json
+import os
+
+from tables import Field, TableSpec, field_names
+
+
+def summarize_activity(activity):
+    """Totals of one activity from its laps, and its average speed against the PACE targets of its steps"""
+    laps = activity.get('laps') or ()
+    distance = sum(lap.get('distance') or 0 for lap in laps)
+    total_time = sum(lap.get('totalTime') or 0 for lap in laps)
+    moving_time = sum(lap.get('movingTime') or 0 for lap in laps)
+    seconds = (moving_time or total_time) / 1000
+    speed = distance / seconds if seconds else None
+
+    targets = []
+    metadata = activity.get('plannedWorkoutMetadata') or {}
+    for step in metadata.get('stepsV2') or ():
+        for sub_step in step.get('steps') or (step,):
+            paces = sub_step.get('paces') or {}
+            target = (paces.get('average') or {}).get('mps')
+            if sub_step.get('targetType') == 'PACE' and target is not None:
+                targets.append(target)
+    target_speed = sum(targets) / len(targets) if targets else None
+
+    return {
+        "lap_count": len(laps),
+        "total_distance": distance,
+        "total_time": total_time,
+        "moving_time": moving_time,
+        "start_timestamp": laps[0].get('startTimestamp') if laps else None,
+        "average_speed_mps": speed,
+        "target_speed_mps": target_speed,
+        "speed_vs_target_mps": speed - target_speed if speed is not None and target_speed is not None else None,
+    }
+
+
+def _activity_summary_records(activity):
+    yield summarize_activity(activity), 0, None
+
+
+ACTIVITY_SUMMARY = TableSpec('activity_summary', _activity_summary_records, [
+    Field("activity_id", "activity.activityId", "STRING", mode="REQUIRED"),
+    Field("user_id", "activity.userId", "STRING"),
+    Field("workout_id", "activity.workoutId", "STRING"),
+    Field("plan_id", "activity.planDetails.id", "STRING"),
+    Field("week_of_plan", "activity.weekOfPlan", "INTEGER"),
+    Field("run_type", "activity.plannedWorkoutMetadata.runType", "STRING"),
+    Field("planned_workout_date", "activity.plannedWorkoutMetadata.plannedWorkoutDate", "DATE"),
+    Field("lap_count", "item.lap_count", "INTEGER"),
+    Field("total_distance", "item.total_distance", "FLOAT"),
+    Field("total_time", "item.total_time", "INTEGER"),
+    Field("moving_time", "item.moving_time", "INTEGER"),
+    Field("start_timestamp", "item.start_timestamp", "INTEGER"),
+    Field("average_speed_mps", "item.average_speed_mps", "FLOAT"),
+    Field("target_speed_mps", "item.target_speed_mps", "FLOAT"),
+    Field("speed_vs_target_mps", "item.speed_vs_target_mps", "FLOAT"),
+    Field("processing_time", "processing_time", "DATE", mode="REQUIRED"),
+])
+
+# Built by SummaryStore rather than the engine, so they have no per-activity records
+USER_WEEK_SUMMARY = TableSpec('user_week_summary', None, [
+    Field("user_id", "user_id", "STRING"),
+    Field("plan_id", "plan_id", "STRING"),
+    Field("week_of_plan", "week_of_plan", "INTEGER"),
+    Field("activities", "activities", "INTEGER"),
+    Field("total_distance", "total_distance", "FLOAT"),
+    Field("total_time", "total_time", "INTEGER"),
+    Field("previous_week_distance", "previous_week_distance", "FLOAT"),
+    Field("distance_change", "distance_change", "FLOAT"),
+    Field("average_speed_vs_target_mps", "average_speed_vs_target_mps", "FLOAT"),
+    Field("processing_time", "processing_time", "DATE", mode="REQUIRED"),
+], cluster_fields=('user_id',))
+
+WORKOUT_LEADERBOARD = TableSpec('workout_leaderboard', None, [
+    Field("workout_id", "workout_id", "STRING", mode="REQUIRED"),
+    Field("rank", "rank", "INTEGER", mode="REQUIRED"),
+    Field("user_id", "user_id", "STRING"),
+    Field("activity_id", "activity_id", "STRING", mode="REQUIRED"),
+    Field("total_distance", "total_distance", "FLOAT"),
+    Field("total_time", "total_time", "INTEGER"),
+    Field("average_speed_mps", "average_speed_mps", "FLOAT"),
+    Field("speed_vs_target_mps", "speed_vs_target_mps", "FLOAT"),
+    Field("processing_time", "processing_time", "DATE", mode="REQUIRED"),
+], cluster_fields=('workout_id',))
+
+# Rebuilt whole from the store every run, so loads replace rather than append
+SNAPSHOT_TABLES = [USER_WEEK_SUMMARY, WORKOUT_LEADERBOARD]
+SUMMARY_TABLES = [ACTIVITY_SUMMARY] + SNAPSHOT_TABLES
+
+
+def _week_order(item):
+    user_id, plan_id, week_of_plan = item[0]
+    return user_id or '', plan_id or '', week_of_plan if week_of_plan is not None else -1
+
+
+class SummaryStore:
+    """The activity_summary rows of every imported activity, keyed by activity id, from which
+    the snapshot tables are built. Saved as JSON next to the manifest for incremental runs;
+    a re-delivered activity replaces its earlier row."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.activities = {}
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as store_file:
+                self.activities = json.load(store_file)
+
+    def add(self, row):
+        self.activities[row["activity_id"]] = {name: value for name, value in row.items()
+                                               if name not in ('processing_time', 'planned_workout_date')}
+
+    def observe(self, rows):
+        """Passes activity_summary rows through, keeping each one"""
+        for row in rows:
+            self.add(row)
+            yield row
+
+    def observe_records(self, names, records):
+        """Passes activity_summary records (tuples in field order) through, keeping each one"""
+        for record in records:
+            self.add(dict(zip(names, record)))
+            yield record
+
+    def user_weeks(self, processing_time):
+        weeks = {}
+        for row in self.activities.values():
+            key = (row["user_id"], row["plan_id"], row["week_of_plan"])
+            week = weeks.setdefault(key, {"activities": 0, "total_distance": 0.0, "total_time": 0, "diffs": []})
+            week["activities"] += 1
+            week["total_distance"] += row["total_distance"] or 0
+            week["total_time"] += row["total_time"] or 0
+            if row["speed_vs_target_mps"] is not None:
+                week["diffs"].append(row["speed_vs_target_mps"])
+
+        rows = []
+        for (user_id, plan_id, week_of_plan), week in sorted(weeks.items(), key=_week_order):
+            previous = weeks.get((user_id, plan_id, week_of_plan - 1)) if week_of_plan is not None else None
+            previous_distance = previous["total_distance"] if previous else None
+            diffs = week["diffs"]
+            rows.append({
+                "user_id": user_id,
+                "plan_id": plan_id,
+                "week_of_plan": week_of_plan,
+                "activities": week["activities"],
+                "total_distance": week["total_distance"],
+                "total_time": week["total_time"],
+                "previous_week_distance": previous_distance,
+                "distance_change": week["total_distance"] - previous_distance if previous else None,
+                "average_speed_vs_target_mps": sum(diffs) / len(diffs) if diffs else None,
+                "processing_time": processing_time,
+            })
+        return rows
+
+    def leaderboard(self, processing_time):
+        """Every activity of each workout ranked by average speed, fastest first"""
+        workouts = {}
+        for row in self.activities.values():
+            if row["workout_id"] is not None:
+                workouts.setdefault(row["workout_id"], []).append(row)
+
+        rows = []
+        for workout_id in sorted(workouts):
+            ranked = sorted(workouts[workout_id], key=lambda row: (row["average_speed_mps"] is None,
+                                                                   -(row["average_speed_mps"] or 0),
+                                                                   row["activity_id"]))
+            for rank, row in enumerate(ranked, 1):
+                rows.append({
+                    "workout_id": workout_id,
+                    "rank": rank,
+                    "user_id": row["user_id"],
+                    "activity_id": row["activity_id"],
+                    "total_distance": row["total_distance"],
+                    "total_time": row["total_time"],
+                    "average_speed_mps": row["average_speed_mps"],
+                    "speed_vs_target_mps": row["speed_vs_target_mps"],
+                    "processing_time": processing_time,
+                })
+        return rows
+
+    def snapshot_rows(self, spec_name, processing_time):
+        if spec_name == 'user_week_summary':
+            return self.user_weeks(processing_time)
+        if spec_name == 'workout_leaderboard':
+            return self.leaderboard(processing_time)
+        raise KeyError(spec_name)
+
+    def update(self, activities):
+        """Adds the summaries kept by another store, e.g. a worker process's"""
+        self.activities.update(activities)
+
+    def save(self):
+        """Writes the store atomically, like the manifest"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as store_file:
+            json.dump(self.activities, store_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+class RecordingWriter:
+    """Wraps the activity_summary writer so every row it writes is also kept in a store"""
+
+    def __init__(self, writer, store):
+        self.writer = writer
+        self.store = store
+
+    def writerows(self, rows):
+        self.writer.writerows(self.store.observe(rows))
+
+    def writerecords(self, records):
+        self.writer.writerecords(self.store.observe_records(field_names(self.writer.spec), records))
+
+    def close(self):
+        self.writer.close()
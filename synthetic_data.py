@@ -0,0 +1,129 @@
+import json
+import random
+from pathlib import Path
+
+
+WORKOUTS = ["200m-Repeats", "5km-Long-Run", "Tempo-Intervals", "Easy-Run"]
+PLANS = [("HILLY_HALF", 10), ("TEN_K_V2", 8), ("MARATHON", 16)]
+
+
+def _pace(rng, seconds_per_km):
+    minutes, seconds = divmod(int(seconds_per_km), 60)
+    return {"text": f"{minutes}:{seconds:02d}", "mps": 1000 / seconds_per_km}
+
+
+def _workout_step(rng, intensity, distance_km, paced=True):
+    step = {
+        "type": "WorkoutStep",
+        "intensity": intensity,
+        "durationType": "DISTANCE",
+        "durationValue": distance_km,
+        "durationValueType": "KILOMETER",
+        "targetType": None,
+        "paces": None,
+    }
+    if paced:
+        average = rng.uniform(240, 420)
+        step["targetType"] = "PACE"
+        step["paces"] = {"slow": _pace(rng, average + 10), "average": _pace(rng, average),
+                         "fast": _pace(rng, average - 10)}
+    return step
+
+
+def _waypoint(rng, record_type, timestamp, moving_time, distance, lap_index):
+    if record_type == "GARMIN":
+        return {"cadence": rng.randint(150, 195), "distance": round(distance, 2),
+                "elevation": rng.uniform(20, 80), "heartRate": rng.randint(100, 180),
+                "movingTime": moving_time, "speed": round(rng.uniform(2, 4), 3),
+                "timestamp": timestamp, "power": rng.randint(0, 400),
+                "strideLength": round(rng.uniform(0.8, 1.4), 2)}
+    return {"timestamp": timestamp, "movingTime": moving_time, "distance": distance,
+            "speed": rng.uniform(1, 5), "elevation": rng.uniform(20, 40), "stepIndex": lap_index,
+            "lapIndex": lap_index, "rawSpeed": round(rng.uniform(1, 5), 2),
+            "accuracy": round(rng.uniform(2, 10), 1), "elevationAccuracy": round(rng.uniform(1, 5), 1)}
+
+
+def _repeat_step(rng, depth):
+    """A WorkoutRepeatStep nested depth levels deep, innermost holding the paced steps"""
+    steps = [_workout_step(rng, "ACTIVE", 0.2), _workout_step(rng, "RECOVERY", 0.2)]
+    if depth > 1:
+        steps.append(_repeat_step(rng, depth - 1))
+    return {"type": "WorkoutRepeatStep", "repeatValue": rng.randint(2, 8), "steps": steps}
+
+
+def generate_activity(index, waypoints=2000, laps=10, record_type=None, seed=0, repeat_depth=1, garmin_share=0.5,
+                      step_plans=None):
+    """Builds a deterministic activity shaped like the files in ./data. garmin_share is the
+    chance of a GARMIN record, and repeat_depth how deeply WorkoutRepeatSteps nest. With
+    step_plans, the stepsV2 tree is one of that many, as when users share workouts"""
+    rng = random.Random(seed * 1_000_003 + index)
+    record_type = record_type or ("GARMIN" if rng.random() < garmin_share else "PHONE")
+    plan_id, plan_length = rng.choice(PLANS)
+    start = 1707150113000 + index * 86_400_000
+    interval = 1000 if record_type == "GARMIN" else 1018
+
+    activity = {
+        "userId": f"user-{index % 50}",
+        "activityId": f"activity-{index}",
+        "workoutId": rng.choice(WORKOUTS),
+        "recordType": record_type,
+        "laps": [],
+        "waypoints": [],
+        "planDetails": {"id": plan_id, "planLength": plan_length},
+        "weekOfPlan": rng.randint(1, plan_length),
+        "unitOfMeasure": "METRIC",
+    }
+    if record_type == "GARMIN":
+        activity["createdOn"] = start
+
+    per_lap = max(1, waypoints // max(1, laps))
+    for lap in range(laps):
+        activity["laps"].append({
+            "averageCadence": rng.randint(160, 190), "averageHeartRate": rng.uniform(130, 170),
+            "averageSpeed": rng.uniform(2, 4), "distance": 200 * rng.randint(1, 10),
+            "elevationGain": rng.randint(0, 10), "maxCadence": 195, "maxElevation": 64.4,
+            "minElevation": 36.6, "maxHeartRate": 175, "minHeartRate": 120, "maxSpeed": 4.1,
+            "movingTime": per_lap * interval, "startTimestamp": start + lap * per_lap * interval,
+            "totalTime": per_lap * interval, "wktStepIndex": lap % 3,
+        })
+
+    distance = 0.0
+    for point in range(waypoints):
+        distance += rng.uniform(2, 4)
+        waypoint = _waypoint(rng, record_type, start + point * interval, point * interval,
+                             distance, min(point // per_lap, laps - 1))
+        if record_type == "PHONE" and point == 0:
+            waypoint["type"] = "start"
+        activity["waypoints"].append(waypoint)
+
+    step_rng = rng if step_plans is None else random.Random(seed * 1_000_003 - 1 - index % step_plans)
+    steps = [_workout_step(step_rng, "WARMUP", 2, paced=False)]
+    if repeat_depth > 0:
+        steps.append(_repeat_step(step_rng, repeat_depth))
+    steps.append(_workout_step(step_rng, "COOLDOWN", 1, paced=False))
+    activity["plannedWorkoutMetadata"] = {
+        "workoutType": "RUN",
+        "runType": rng.choice(["TEMPO", "INTERVALS", "EASY_RUN", "LONG_RUN"]),
+        "distance": round(rng.uniform(3, 21), 1),
+        "currentEst5kTimeInSecs": rng.randint(1200, 2100),
+        "plannedWorkoutDate": "2024-02-05",
+        "stepsV2": steps,
+    }
+    return activity
+
+
+def write_corpus(directory, activities, waypoints=2000, laps=10, seed=0, repeat_depth=1, garmin_share=0.5,
+                 step_plans=None):
+    """Writes a synthetic corpus of activity JSON files into directory. waypoints and laps
+    may be a (low, high) range, drawn per activity from the seed"""
+    path = Path(directory)
+    path.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+    for index in range(activities):
+        activity_waypoints = rng.randint(*waypoints) if isinstance(waypoints, tuple) else waypoints
+        activity_laps = rng.randint(*laps) if isinstance(laps, tuple) else laps
+        activity = generate_activity(index, activity_waypoints, activity_laps, seed=seed,
+                                     repeat_depth=repeat_depth, garmin_share=garmin_share, step_plans=step_plans)
+        with open(path / f"activity-{index:06d}.json", 'w') as json_file:
+            json.dump(activity, json_file)
+    return path
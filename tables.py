@@ -0,0 +1,399 @@
+"""Schema registry for the tables flattened out of the activity JSON.
+
+Shared by workout_importer.py, which extracts and coerces rows with it, and
+load_multiple_csv.py, which builds explicit BigQuery schemas, partitioning and
+clustering from it.
+"""
+import math
+from collections import namedtuple
+from datetime import date
+from functools import lru_cache
+from time import perf_counter, process_time
+
+
+# A column of an output table: `source` is a dotted path into the extraction scope
+# ("activity.planDetails.id", "item.averageCadence", "parent.repeatValue", "index"
+# or "processing_time"), `type` is its BigQuery type (STRING, INTEGER, FLOAT or DATE),
+# `transform` is applied to the value found there and `mode` is its BigQuery nullability.
+Field = namedtuple('Field', ['name', 'source', 'type', 'transform', 'mode'], defaults=[None, 'NULLABLE'])
+
+# An output table: `records` yields (item, index, parent) for every row of one activity.
+# Tables are partitioned by day on `partition_field` and clustered on `cluster_fields`.
+TableSpec = namedtuple('TableSpec', ['name', 'records', 'fields', 'partition_field', 'cluster_fields'],
+                       defaults=['processing_time', ('activity_id',)])
+
+
+def _to_int(value):
+    return value if type(value) is int else int(value)
+
+
+def _to_float(value):
+    return value if type(value) is float else float(value)
+
+
+def _to_str(value):
+    return value if type(value) is str else str(value)
+
+
+def _to_date(value):
+    return value if isinstance(value, date) else date.fromisoformat(value)
+
+
+COERCERS = {'INTEGER': _to_int, 'FLOAT': _to_float, 'STRING': _to_str, 'DATE': _to_date}
+
+
+def coerce(field_type, value):
+    """Converts a raw JSON value to the Python type of its column; None stays None"""
+    return None if value is None else COERCERS[field_type](value)
+
+
+def pace_text(text):
+    """Replaces the (:) in the pace text so it can be converted to a float; None when it still can't be"""
+    if text is None:
+        return None
+    try:
+        text = text.replace(":", ".")
+        float(text)
+    except (AttributeError, ValueError):
+        return None
+    return text
+
+
+@lru_cache(maxsize=4096)
+def pace_seconds(text):
+    """Pace text such as "4:45" (minutes:seconds per km, or hours:minutes:seconds) as whole seconds,
+    or None when it is malformed. Plans repeat the same few paces, so each text is parsed once"""
+    if text is None:
+        return None
+    seconds = 0.0
+    try:
+        for part in text.split(":"):
+            seconds = seconds * 60 + float(part)
+    except (AttributeError, ValueError):
+        #A bad pace leaves its column empty instead of failing the activity's steps
+        return None
+    return round(seconds) if math.isfinite(seconds) else None
+
+
+def _activity_records(activity):
+    yield activity, 0, None
+
+
+def _lap_records(activity):
+    for index, lap in enumerate(activity.get('laps') or ()):
+        yield lap, index, None
+
+
+def _waypoint_records(activity):
+    for waypoint in activity.get('waypoints') or ():
+        yield waypoint, None, None
+
+
+def _metadata_records(activity):
+    metadata = activity.get('plannedWorkoutMetadata')
+    if metadata:
+        yield metadata, 0, None
+
+
+def _step_records(activity):
+    #Get steps data and pace data by checking step['type'] if it is equal to RepeatStep
+    metadata = activity.get('plannedWorkoutMetadata') or {}
+    for index, step in enumerate(metadata.get('stepsV2') or ()):
+        if step['type'] == 'WorkoutStep':
+            yield step, index, step
+        elif step['type'] == 'WorkoutRepeatStep':
+            for sub_step in step['steps']:
+                yield sub_step, index, step
+
+
+ACTIVITY_DATA = TableSpec('activity_data', _activity_records, [
+    Field("activity_id", "activity.activityId", "STRING", mode="REQUIRED"),
+    Field("user_id", "activity.userId", "STRING"),
+    Field("plan_id", "activity.planDetails.id", "STRING"),
+    Field("plan_length", "activity.planDetails.planLength", "INTEGER"),
+    Field("workout_id", "activity.workoutId", "STRING"),
+    Field("record_type", "activity.recordType", "STRING"),
+    Field("week_of_plan", "activity.weekOfPlan", "INTEGER"),
+    Field("unit_of_measure", "activity.unitOfMeasure", "STRING"),
+    Field("processing_time", "processing_time", "DATE", mode="REQUIRED"),
+])
+
+LAP_DATA = TableSpec('lap_data', _lap_records, [
+    Field("activity_id", "activity.activityId", "STRING", mode="REQUIRED"),
+    Field("lap_order", "index", "INTEGER", mode="REQUIRED"),
+    Field("average_cadence", "item.averageCadence", "FLOAT"),
+    Field("average_heart_rate", "item.averageHeartRate", "FLOAT"),
+    Field("average_speed", "item.averageSpeed", "FLOAT"),
+    Field("distance", "item.distance", "FLOAT"),
+    Field("elevation_gain", "item.elevationGain", "FLOAT"),
+    Field("max_cadence", "item.maxCadence", "FLOAT"),
+    Field("max_elevation", "item.maxElevation", "FLOAT"),
+    Field("min_elevation", "item.minElevation", "FLOAT"),
+    Field("max_heart_rate", "item.maxHeartRate", "FLOAT"),
+    Field("min_heart_rate", "item.minHeartRate", "FLOAT"),
+    Field("max_speed", "item.maxSpeed", "FLOAT"),
+    Field("moving_time", "item.movingTime", "INTEGER"),
+    Field("start_timestamp", "item.startTimestamp", "INTEGER"),
+    Field("total_time", "item.totalTime", "INTEGER"),
+    Field("wkt_step_index", "item.wktStepIndex", "INTEGER"),
+    Field("processing_time", "processing_time", "DATE", mode="REQUIRED"),
+])
+
+WORKOUT_METADATA = TableSpec('workout_metadata', _metadata_records, [
+    Field("activity_id", "activity.activityId", "STRING", mode="REQUIRED"),
+    Field("workout_type", "item.workoutType", "STRING"),
+    Field("run_type", "item.runType", "STRING"),
+    Field("distance", "item.distance", "FLOAT"),
+    Field("current_est_5k_time_secs", "item.currentEst5kTimeInSecs", "INTEGER"),
+    Field("planned_workout_date", "item.plannedWorkoutDate", "DATE"),
+    Field("processing_time", "processing_time", "DATE", mode="REQUIRED"),
+])
+
+WAYPOINT_DATA = TableSpec('waypoint_data', _waypoint_records, [
+    Field("activity_id", "activity.activityId", "STRING", mode="REQUIRED"),
+    Field("cadence", "item.cadence", "FLOAT"),
+    Field("distance", "item.distance", "FLOAT"),
+    Field("elevation", "item.elevation", "FLOAT"),
+    Field("heart_rate", "item.heartRate", "FLOAT"),
+    Field("moving_time", "item.movingTime", "INTEGER"),
+    Field("speed", "item.speed", "FLOAT"),
+    Field("timestamp", "item.timestamp", "INTEGER"),
+    Field("power", "item.power", "FLOAT"),
+    Field("stride_length", "item.strideLength", "FLOAT"),
+    Field("step_index", "item.stepIndex", "INTEGER"),
+    Field("lap_index", "item.lapIndex", "INTEGER"),
+    Field("raw_speed", "item.rawSpeed", "FLOAT"),
+    Field("accuracy", "item.accuracy", "FLOAT"),
+    Field("elevation_accuracy", "item.elevationAccuracy", "FLOAT"),
+    Field("type", "item.type", "STRING"),
+    Field("processing_time", "processing_time", "DATE", mode="REQUIRED"),
+])
+
+STEP_DATA = TableSpec('step_data', _step_records, [
+    Field("activity_id", "activity.activityId", "STRING", mode="REQUIRED"),
+    Field("processing_time", "processing_time", "DATE", mode="REQUIRED"),
+    Field("lap_order", "index", "INTEGER", mode="REQUIRED"),
+    Field("step_type", "item.type", "STRING"),
+    Field("step_order", "item.stepOrder", "INTEGER"),
+    Field("repeat_value", "parent.repeatValue", "INTEGER"),
+    Field("intensity", "item.intensity", "STRING"),
+    Field("duration_type", "item.durationType", "STRING"),
+    Field("duration_value", "item.durationValue", "FLOAT"),
+    Field("duration_value_type", "item.durationValueType", "STRING"),
+    Field("target_type", "item.targetType", "STRING"),
+    Field("pace_slow_text", "item.paces.slow.text", "FLOAT", pace_text),
+    Field("pace_slow_mps", "item.paces.slow.mps", "FLOAT"),
+    Field("pace_average_text", "item.paces.average.text", "FLOAT", pace_text),
+    Field("pace_average_mps", "item.paces.average.mps", "FLOAT"),
+    Field("pace_fast_text", "item.paces.fast.text", "FLOAT", pace_text),
+    Field("pace_fast_mps", "item.paces.fast.mps", "FLOAT"),
+    Field("pace_slow_s_per_km", "item.paces.slow.text", "INTEGER", pace_seconds),
+    Field("pace_average_s_per_km", "item.paces.average.text", "INTEGER", pace_seconds),
+    Field("pace_fast_s_per_km", "item.paces.fast.text", "INTEGER", pace_seconds),
+])
+
+# Tables in the order import_data writes and uploads them
+TABLES = [ACTIVITY_DATA, LAP_DATA, WORKOUT_METADATA, WAYPOINT_DATA, STEP_DATA]
+
+
+def field_names(spec):
+    return [field.name for field in spec.fields]
+
+
+def compile_getter(source, processing_time):
+    """Turns a dotted source path into a getter over (activity, item, index, parent)"""
+    root, *keys = source.split('.')
+    if root == 'processing_time':
+        return lambda activity, item, index, parent: processing_time
+    if root == 'index':
+        return lambda activity, item, index, parent: index
+    if root == 'activity':
+        scope = lambda activity, item, index, parent: activity
+    elif root == 'item':
+        scope = lambda activity, item, index, parent: item
+    elif root == 'parent':
+        scope = lambda activity, item, index, parent: parent
+    else:
+        raise ValueError(f"Unknown source {source}")
+
+    if len(keys) == 1:
+        key = keys[0]
+        if root == 'item':
+            return lambda activity, item, index, parent: item.get(key)
+        def get(activity, item, index, parent):
+            value = scope(activity, item, index, parent)
+            return value.get(key) if value is not None else None
+        return get
+
+    def get_nested(activity, item, index, parent):
+        value = scope(activity, item, index, parent)
+        for key in keys:
+            if not value:
+                return None
+            value = value.get(key)
+        return value
+    return get_nested
+
+
+def compile_field(field, processing_time):
+    """Getter for one column that applies the field's transform, then coerces to its type once"""
+    if field.source == 'processing_time':
+        #Constant for the whole run, so it is coerced here rather than per row
+        value = coerce(field.type, processing_time)
+        return field.name, lambda activity, item, index, parent: value
+    getter = compile_getter(field.source, processing_time)
+    convert = COERCERS[field.type]
+    transform = field.transform
+    if transform is None:
+        def get(activity, item, index, parent):
+            value = getter(activity, item, index, parent)
+            return None if value is None else convert(value)
+    else:
+        def get(activity, item, index, parent):
+            value = transform(getter(activity, item, index, parent))
+            return None if value is None else convert(value)
+    return field.name, get
+
+
+def compile_value(field):
+    """Applies the field's transform to a value already read from its source, then coerces it"""
+    convert = COERCERS[field.type]
+    transform = field.transform
+    if transform is None:
+        return lambda value: None if value is None else convert(value)
+    def value_of(value):
+        value = transform(value)
+        return None if value is None else convert(value)
+    return value_of
+
+
+class ExtractionEngine:
+    """Visits every activity once and sends the rows of all tables to their sinks.
+
+    Sinks with writerecords() get each row as a plain tuple in field order, which needs under
+    half the memory of a dict with the same values and that csv.writer writes as it is.
+    Constant columns such as processing_time are coerced once per engine, so every record
+    refers to the same value. Other sinks get dict rows through writerows()"""
+
+    def __init__(self, processing_time, specs=TABLES, column_builders=None, record_builders=None, preparers=()):
+        self.specs = list(specs)
+        self._compiled = [
+            (spec, [compile_field(field, processing_time) for field in spec.fields])
+            for spec in self.specs
+        ]
+        self._record_getters = {spec.name: [get for _, get in getters] for spec, getters in self._compiled}
+        # Tables built as column arrays instead of dict rows, e.g. {'waypoint_data': WaypointArrays}
+        self.column_builders = column_builders or {}
+        # Tables whose records come from another builder, e.g. {'step_data': StepTemplates}
+        self.record_builders = record_builders or {}
+        # (table name, prepare) pairs run over each activity in turn before its rows are built, such
+        # as a waypoint reducer's reduce; a failure counts against that table
+        self.preparers = list(preparers)
+        # Per-table rows out, failures and time spent flattening plus writing, across runs
+        self.stats = {spec.name: {"rows_out": 0, "failures": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0}
+                      for spec in self.specs}
+        # activityIds that failed in at least one table, across runs
+        self.failed_activities = set()
+
+    def rows(self, spec_name, activity):
+        """Yields the rows of a single table for a single activity"""
+        for spec, getters in self._compiled:
+            if spec.name == spec_name:
+                return self._rows(spec, getters, activity)
+        raise KeyError(spec_name)
+
+    def records(self, spec_name, activity):
+        """Yields the rows of a single table for a single activity as tuples in field order"""
+        for spec in self.specs:
+            if spec.name == spec_name:
+                return self._records(spec, activity)
+        raise KeyError(spec_name)
+
+    def _rows(self, spec, getters, activity):
+        if spec.name in self.record_builders:
+            names = [name for name, _ in getters]
+            for record in self._records(spec, activity):
+                yield dict(zip(names, record))
+            return
+        for item, index, parent in spec.records(activity):
+            yield {name: get(activity, item, index, parent) for name, get in getters}
+
+    def _records(self, spec, activity):
+        builder = self.record_builders.get(spec.name)
+        if builder is not None:
+            yield from builder.records(activity)
+            return
+        getters = self._record_getters[spec.name]
+        for item, index, parent in spec.records(activity):
+            yield tuple([get(activity, item, index, parent) for get in getters])
+
+    def _build(self, spec, getters, sink, activity):
+        """(write, rows) for one table of one activity, with every row already built"""
+        builder = self.column_builders.get(spec.name)
+        if builder is None and hasattr(sink, 'writerecords'):
+            return sink.writerecords, list(self._records(spec, activity))
+        if builder is None:
+            return sink.writerows, list(self._rows(spec, getters, activity))
+        batch = builder.build(activity)
+        if hasattr(sink, 'write_columns'):
+            return sink.write_columns, batch
+        return lambda batch: sink.writerows(batch.rows()), batch
+
+    def _prepare(self, activity):
+        """The activity after every preparer, or None when one of them failed on it"""
+        for name, prepare in self.preparers:
+            stats = self.stats[name]
+            wall, cpu = perf_counter(), process_time()
+            try:
+                activity = prepare(activity)
+            except Exception as e:
+                stats["failures"] += 1
+                self.failed_activities.add(activity.get('activityId'))
+                print(f"Failed to prepare {name} for {activity.get('activityId')} :{e}")
+                return None
+            finally:
+                stats["wall_seconds"] += perf_counter() - wall
+                stats["cpu_seconds"] += process_time() - cpu
+        return activity
+
+    def run(self, activities, sinks):
+        """Single pass over activities; `sinks` maps table name to an object with writerecords() or writerows().
+        Each activity goes through the preparers first. All of its rows are built before any is
+        written, so an activity that fails to prepare, or fails in one table, is left out of every table"""
+        visited = 0
+        for activity in activities:
+            visited += 1
+            activity = self._prepare(activity)
+            if activity is None:
+                continue
+            built = []
+            failed = False
+            for spec, getters in self._compiled:
+                sink = sinks.get(spec.name)
+                if sink is None:
+                    continue
+                stats = self.stats[spec.name]
+                wall, cpu = perf_counter(), process_time()
+                try:
+                    built.append((spec, stats) + self._build(spec, getters, sink, activity))
+                except Exception as e:
+                    failed = True
+                    stats["failures"] += 1
+                    self.failed_activities.add(activity.get('activityId'))
+                    print(f"Failed to process {spec.name} for {activity.get('activityId')} :{e}")
+                stats["wall_seconds"] += perf_counter() - wall
+                stats["cpu_seconds"] += process_time() - cpu
+            if failed:
+                continue
+            for spec, stats, write, rows in built:
+                wall, cpu = perf_counter(), process_time()
+                try:
+                    write(rows)
+                    stats["rows_out"] += len(rows)
+                except Exception as e:
+                    stats["failures"] += 1
+                    self.failed_activities.add(activity.get('activityId'))
+                    print(f"Failed to write {spec.name} for {activity.get('activityId')} :{e}")
+                stats["wall_seconds"] += perf_counter() - wall
+                stats["cpu_seconds"] += process_time() - cpu
+        return visited
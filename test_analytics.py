@@ -0,0 +1,134 @@
+import math
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from analytics import (QUESTIONS, PythonWarehouse, answer_questions, duckdb, get_warehouse, load_table,
+                       table_files)
+from synthetic_data import write_corpus
+from workout_importer import WorkoutImporter
+
+
+def _import(data_dir, output_dir, **options):
+    with patch('workout_importer.WorkoutImporter.upload_to_gcs'):
+        importer = WorkoutImporter(data_directory=data_dir, streaming=True, **options)
+        importer.output_directory = output_dir
+        return importer.import_data()
+
+
+def _assert_rows_equal(test, rows, expected):
+    test.assertEqual(len(rows), len(expected))
+    for row, expected_row in zip(rows, expected):
+        test.assertEqual(row.keys(), expected_row.keys())
+        for name, value in row.items():
+            if isinstance(value, float) or isinstance(expected_row[name], float):
+                test.assertTrue(math.isclose(value, expected_row[name], rel_tol=1e-9), (name, value, expected_row))
+            else:
+                test.assertEqual(value, expected_row[name])
+
+
+class TestAnalytics(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.output_dir = tempfile.TemporaryDirectory()
+        write_corpus(self.data_dir.name, activities=120, waypoints=5, laps=3)
+
+    def tearDown(self):
+        self.data_dir.cleanup()
+        self.output_dir.cleanup()
+
+    def test_python_warehouse_answers(self):
+        _import('./data', self.output_dir.name)
+        warehouse = PythonWarehouse(self.output_dir.name)
+
+        pace = warehouse.pace_target_delta()
+        self.assertEqual([row["user_id"] for row in pace], ["user-1", "user-2"])
+        self.assertAlmostEqual(pace[0]["avg_pace_diff"], -2.2548, places=4)
+        weeks = warehouse.weekly_distance()
+        self.assertEqual([(row["user_id"], row["week_of_plan"]) for row in weeks], [("user-1", 6), ("user-2", 7)])
+        self.assertAlmostEqual(weeks[0]["total_distance"], 5458.82)
+        comparison = warehouse.workout_comparison()
+        self.assertEqual([(row["workout_id"], row["rank"]) for row in comparison],
+                         [("200m-Repeats", 1), ("5km-Long-Run", 1)])
+
+    def test_previous_week_and_ranks(self):
+        _import(self.data_dir.name, self.output_dir.name)
+        warehouse = PythonWarehouse(self.output_dir.name)
+
+        weeks = {(row["user_id"], row["week_of_plan"]): row for row in warehouse.weekly_distance()}
+        compared = [row for row in weeks.values() if row["previous_week_distance"] is not None]
+        self.assertTrue(compared)
+        for row in compared:
+            previous = weeks[(row["user_id"], row["week_of_plan"] - 1)]
+            self.assertEqual(row["previous_week_distance"], previous["total_distance"])
+        for row in warehouse.workout_comparison():
+            faster = [other for other in warehouse.workout_comparison()
+                      if other["workout_id"] == row["workout_id"] and other["rank"] < row["rank"]]
+            self.assertTrue(all(other["average_speed_mps"] >= row["average_speed_mps"] for other in faster))
+
+    def test_incremental_deltas_replace_redelivered_activities(self):
+        with patch('workout_importer.WorkoutImporter.upload_to_gcs'):
+            importer = WorkoutImporter(data_directory=self.data_dir.name, incremental=True)
+            importer.output_directory = self.output_dir.name
+            importer.import_data()
+            with open(f"{self.data_dir.name}/activity-000000.json", 'a') as json_file:
+                json_file.write(" ")
+            importer.import_data()
+
+        paths, deltas = table_files(self.output_dir.name, 'lap_data')
+        self.assertTrue(deltas)
+        self.assertEqual(len(paths), 2)
+        laps = load_table(self.output_dir.name, 'lap_data')
+        self.assertEqual(len(laps), 120 * 3)
+
+    def test_sharded_output_reads_the_latest_run(self):
+        _import(self.data_dir.name, self.output_dir.name, shard_rows=100, compression='gzip')
+        _import(self.data_dir.name, self.output_dir.name, shard_rows=100, compression='gzip')
+        self.assertEqual(len(load_table(self.output_dir.name, 'activity_data')), 120)
+
+    def test_sharded_incremental_runs_are_read_as_deltas(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            write_corpus(data_dir, activities=3, waypoints=5, laps=3)
+            _import(data_dir, self.output_dir.name, incremental=True, shard_rows=2)
+            write_corpus(data_dir, activities=5, waypoints=5, laps=3)
+            with open(f"{data_dir}/activity-000000.json", 'a') as json_file:
+                json_file.write(" ")
+            _import(data_dir, self.output_dir.name, incremental=True, shard_rows=2)
+
+        paths, runs = table_files(self.output_dir.name, 'lap_data')
+        self.assertEqual(len(set(runs)), 2)
+        warehouse = PythonWarehouse(self.output_dir.name)
+        self.assertEqual(sorted(warehouse.activities), [f"activity-{index}" for index in range(5)])
+        self.assertEqual([len(laps) for laps in warehouse.laps.values()], [3] * 5)
+        if duckdb is not None:
+            duckdb_warehouse = get_warehouse('duckdb', self.output_dir.name)
+            self.assertEqual(duckdb_warehouse.connection.execute("SELECT count(*) FROM lap_data").fetchone(), (15,))
+            duckdb_answers = answer_questions(duckdb_warehouse)
+            python_answers = answer_questions(warehouse)
+            for question in QUESTIONS:
+                _assert_rows_equal(self, duckdb_answers[question]["rows"], python_answers[question]["rows"])
+
+        #A later full run replaces every run before it
+        _import(self.data_dir.name, self.output_dir.name, shard_rows=100)
+        self.assertEqual(table_files(self.output_dir.name, 'lap_data')[1], None)
+        self.assertEqual(len(load_table(self.output_dir.name, 'activity_data')), 120)
+
+    def test_missing_table(self):
+        with self.assertRaises(FileNotFoundError):
+            PythonWarehouse(self.output_dir.name)
+        with self.assertRaises(ValueError):
+            get_warehouse('sqlite', self.output_dir.name)
+
+    @unittest.skipIf(duckdb is None, "duckdb is not installed")
+    def test_duckdb_matches_python(self):
+        for options in ({}, {"output_format": "parquet"}, {"shard_rows": 100, "compression": "gzip"}):
+            with self.subTest(**options), tempfile.TemporaryDirectory() as output_dir:
+                _import(self.data_dir.name, output_dir, **options)
+                python_answers = answer_questions(get_warehouse('python', output_dir))
+                duckdb_answers = answer_questions(get_warehouse('duckdb', output_dir))
+                for question in QUESTIONS:
+                    _assert_rows_equal(self, duckdb_answers[question]["rows"], python_answers[question]["rows"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import gzip
+import shutil
+import tempfile
+import time
+import unittest
+from concurrent.futures import Future
+from pathlib import Path
+from unittest.mock import patch
+
+import async_pipeline
+from async_pipeline import AsyncPipeline
+from local_gcs import LocalStorageClient
+from synthetic_data import write_corpus
+from tables import ACTIVITY_DATA
+from workout_importer import WorkoutImporter
+
+
+def _done(value=None):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+class RecordingWriter:
+    def __init__(self, delay=0.0):
+        self.rows = []
+        self.delay = delay
+        self.closed = False
+
+    def writerows(self, rows):
+        time.sleep(self.delay)
+        self.rows.extend(rows)
+
+    def close(self):
+        self.closed = True
+
+
+def _bucket_rows(gcs_dir):
+    rows = {}
+    for blob in sorted(Path(gcs_dir, "runna").rglob("*.csv*")):
+        opener = gzip.open if blob.suffix == '.gz' else open
+        with opener(blob, 'rt') as blob_file:
+            rows.setdefault(blob.relative_to(Path(gcs_dir, "runna")).parts[0], []).extend(
+                blob_file.read().splitlines()[1:])
+    return rows
+
+
+class TestAsyncPipeline(unittest.TestCase):
+    def _import(self, data_dir, **options):
+        output_dir = tempfile.mkdtemp()
+        gcs_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        self.addCleanup(shutil.rmtree, gcs_dir)
+        importer = WorkoutImporter(data_directory=data_dir, storage_client=LocalStorageClient(gcs_dir), **options)
+        importer.output_directory = output_dir
+        importer.import_data()
+        return importer, output_dir, gcs_dir
+
+    def test_matches_streaming_output(self):
+        for extract_workers in (0, 1):
+            with self.subTest(extract_workers=extract_workers):
+                serial, serial_dir, _ = self._import('./data', streaming=True)
+                pipelined, pipelined_dir, gcs_dir = self._import('./data', asynchronous=True, queue_size=1,
+                                                                 extract_workers=extract_workers)
+                for spec in serial.tables():
+                    with open(f"{serial_dir}/{spec.name}.csv") as expected, \
+                            open(f"{pipelined_dir}/{spec.name}.csv") as actual:
+                        self.assertEqual(actual.read(), expected.read())
+                self.assertEqual(sorted(path.name for path in Path(gcs_dir, "runna").iterdir()),
+                                 sorted(spec.name for spec in serial.tables()))
+                self.assertEqual(pipelined.metrics.tables[('extract', 'waypoint_data')]["rows_out"], 2063 + 648)
+
+    def test_sharded_run_with_summaries_and_downsampling(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            write_corpus(data_dir, activities=12, waypoints=(50, 400), laps=3)
+            options = dict(shard_rows=500, compression='gzip', summaries=True, downsample='distance:5')
+            serial, _, serial_gcs = self._import(data_dir, streaming=True, **options)
+            pipelined, _, pipelined_gcs = self._import(data_dir, asynchronous=True, queue_size=2, extract_workers=1,
+                                                       **options)
+            self.assertEqual(_bucket_rows(pipelined_gcs), _bucket_rows(serial_gcs))
+            self.assertEqual(pipelined.metrics.tables[('downsample', 'waypoint_data')]["rows_out"],
+                             serial.metrics.tables[('downsample', 'waypoint_data')]["rows_out"])
+            self.assertTrue(Path(pipelined_gcs, "runna", "workout_leaderboard").is_dir())
+
+    def test_queues_bound_how_far_reading_runs_ahead(self):
+        read, lead = [], []
+        writer = RecordingWriter(delay=0.005)
+
+        def read_bytes(path):
+            read.append(path)
+            return path
+
+        def flatten_file(content):
+            return {'activity_data': [[{"activity_id": content}]]}, {}, None
+
+        def writerows(rows):
+            lead.append(len(read) - len(writer.rows))
+            RecordingWriter.writerows(writer, rows)
+        writer.writerows = writerows
+
+        pipeline = AsyncPipeline(flatten_file, [ACTIVITY_DATA], {'activity_data': 'unused'},
+                                 lambda path, spec: writer, lambda path: _done(), queue_size=2, extract_workers=0)
+        with patch.object(async_pipeline, '_read_bytes', read_bytes):
+            visited = pipeline.run([f"activity-{index}" for index in range(40)])
+
+        self.assertEqual(visited, 40)
+        self.assertEqual([row["activity_id"] for row in writer.rows], [f"activity-{index}" for index in range(40)])
+        self.assertLessEqual(max(lead), 2 * 2 + 3)
+        self.assertTrue(writer.closed)
+
+    def test_failures_propagate_and_close_writers(self):
+        writer = RecordingWriter()
+
+        def flatten_file(content):
+            raise ValueError("bad file")
+
+        pipeline = AsyncPipeline(flatten_file, [ACTIVITY_DATA], {'activity_data': 'unused'},
+                                 lambda path, spec: writer, lambda path: _done(), extract_workers=0)
+        with patch.object(async_pipeline, '_read_bytes', lambda path: b"{}"):
+            with self.assertRaises(ValueError):
+                pipeline.run(["activity-0"])
+        self.assertTrue(writer.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
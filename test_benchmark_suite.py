@@ -0,0 +1,39 @@
+import unittest
+
+from benchmark_suite import compare, parse_sizes, run_size
+
+
+def _results(seconds):
+    return {"runs": [{"size": "2x100", "stages": [{"stage": stage, "wall_seconds": value}
+                                                  for stage, value in seconds.items()]}]}
+
+
+class TestBenchmarkSuite(unittest.TestCase):
+    def test_parse_sizes(self):
+        self.assertEqual(parse_sizes("20x1000,2x100000"), [(20, 1000), (2, 100000)])
+
+    def test_run_size_reports_every_stage(self):
+        report = run_size(2, 50, laps=2, trace_memory=False)
+        stages = {stage["stage"]: stage for stage in report["stages"]}
+        for mode in ('write_tables', 'write_tables_parallel', 'write_tables_async'):
+            with self.subTest(mode):
+                self.assertEqual(stages[mode]["rows_in"], 2)
+                self.assertEqual(stages[mode]["rows_out"], stages[f"{mode}/extract"]["rows_out"])
+                self.assertIn(f"{mode}/upload", stages)
+                extract = {record["table"]: record for record in report["tables"]
+                           if record["stage"] == f"{mode}/extract"}
+                self.assertEqual(extract["waypoint_data"]["rows_out"], 100)
+        self.assertIn('write_tables/load', stages)
+        self.assertIn('write_tables_parallel/merge', stages)
+        self.assertEqual(report["failures"], 0)
+        self.assertEqual(report["corpus"]["activities"], 2)
+
+    def test_compare_flags_slower_stages(self):
+        baseline = _results({"write_tables/load": 1.0, "write_tables/upload": 0.001})
+        results = _results({"write_tables/load": 1.5, "write_tables/upload": 0.004})
+        self.assertEqual([regression["stage"] for regression in compare(baseline, results)], ["write_tables/load"])
+        self.assertEqual(compare(baseline, _results({"write_tables/load": 1.1})), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import csv
+import inspect
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import cli
+from local_gcs import LocalStorageClient
+from synthetic_data import write_corpus
+from workout_importer import WorkoutImporter, importer_from_args
+
+
+class TestCli(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.data_dir = os.path.join(self.directory.name, 'data')
+        self.output_dir = os.path.join(self.directory.name, 'processed_data')
+        write_corpus(self.data_dir, activities=4, waypoints=5, laps=2)
+
+    def test_extract_stages_locally_without_the_sdks(self):
+        script = ("import sys, cli, cloud; "
+                  f"status = cli.main(['extract', '--data-directory', {self.data_dir!r}, "
+                  f"'--output-directory', {self.output_dir!r}, '--bucket', 'test-bucket']); "
+                  "print(status, cloud.storage.loaded, 'google.cloud' in sys.modules)")
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.split()[-3:], ['0', 'False', 'False'])
+
+        staged = LocalStorageClient(os.path.join(self.output_dir, 'staged')).bucket('test-bucket')
+        self.assertIn('activity_data', [blob.name for blob in staged.list_blobs()])
+        with open(os.path.join(self.output_dir, 'activity_data.csv')) as csv_file:
+            self.assertEqual(len(list(csv.DictReader(csv_file))), 4)
+
+    def test_upload_keeps_blob_names_and_clears_staging(self):
+        self.assertEqual(cli.main(['extract', '--data-directory', self.data_dir, '--output-directory',
+                                   self.output_dir, '--shard-rows', '10']), 0)
+        staging = LocalStorageClient(os.path.join(self.output_dir, 'staged')).bucket('runna')
+        names = [blob.name for blob in staging.list_blobs()]
+        self.assertTrue(any(name.startswith('waypoint_data/') for name in names))
+
+        gcs = LocalStorageClient(os.path.join(self.directory.name, 'gcs'))
+        args = cli.build_parser().parse_args(['upload', '--output-directory', self.output_dir])
+        self.assertEqual(cli.upload(args, storage_client=gcs), len(names))
+        self.assertEqual([blob.name for blob in gcs.bucket('runna').list_blobs()], names)
+        self.assertEqual(staging.list_blobs(), [])
+
+    def test_run_all_loads_the_imported_run(self):
+        gcs = LocalStorageClient(os.path.join(self.directory.name, 'gcs'))
+        report = os.path.join(self.directory.name, 'report.json')
+        with patch('uploader.storage_client', return_value=gcs), \
+                patch('load_multiple_csv.load_csv_files_to_bigquery', return_value=[]) as load:
+            status = cli.main(['run-all', '--data-directory', self.data_dir, '--output-directory', self.output_dir,
+                               '--bucket', 'test-bucket', '--dataset', 'test-dataset', '--shard-rows', '10',
+                               '--enrich', '--report', report])
+        self.assertEqual(status, 0)
+        (bucket_name, dataset_id, run_id, max_concurrent_jobs), options = load.call_args
+        self.assertEqual((bucket_name, dataset_id, max_concurrent_jobs), ('test-bucket', 'test-dataset', 5))
+        self.assertTrue(options["enriched"])
+        self.assertIn(f"runs/{run_id}.json", [blob.name for blob in gcs.bucket('test-bucket').list_blobs()])
+        self.assertTrue(os.path.exists(report))
+
+    def test_every_importer_option_is_on_the_command_line(self):
+        args = cli.build_parser().parse_args(['extract', '--incremental', '--workers', '2', '--decoder', 'json',
+                                              '--project', '--queue-size', '3', '--upload-workers', '2'])
+        with patch('workout_importer.WorkoutImporter') as importer_class:
+            importer_from_args(args)
+        options = importer_class.call_args.kwargs
+        self.assertEqual(set(options), set(inspect.signature(WorkoutImporter).parameters))
+        self.assertEqual({name: options[name] for name in ('incremental', 'workers', 'decoder', 'project',
+                                                           'queue_size', 'upload_workers', 'streaming')},
+                         {"incremental": True, "workers": 2, "decoder": 'json', "project": True, "queue_size": 3,
+                          "upload_workers": 2, "streaming": False})
+
+    def test_incremental_run_all_loads_its_deltas(self):
+        gcs = LocalStorageClient(os.path.join(self.directory.name, 'gcs'))
+        argv = ['run-all', '--incremental', '--data-directory', self.data_dir, '--output-directory', self.output_dir]
+        with patch('uploader.storage_client', return_value=gcs), \
+                patch('load_multiple_csv.load_csv_files_to_bigquery', return_value=[]) as load:
+            self.assertEqual(cli.main(argv), 0)
+        run_id = load.call_args.args[2]
+        self.assertIsNotNone(run_id)
+        self.assertIn(f"activity_data/{run_id}.csv", [blob.name for blob in gcs.bucket('runna').list_blobs()])
+
+    def test_incremental_run_all_without_new_files_loads_nothing(self):
+        gcs = LocalStorageClient(os.path.join(self.directory.name, 'gcs'))
+        argv = ['run-all', '--incremental', '--data-directory', self.data_dir, '--output-directory', self.output_dir]
+        with patch('uploader.storage_client', return_value=gcs), \
+                patch('load_multiple_csv.load_csv_files_to_bigquery', return_value=[]) as load:
+            self.assertEqual(cli.main(argv), 0)
+            with patch('builtins.print') as printed:
+                self.assertEqual(cli.main(argv), 0)
+        self.assertEqual(load.call_count, 1)
+        printed.assert_called_with("Nothing to load")
+
+    def test_failures_exit_non_zero(self):
+        with patch('builtins.print') as printed:
+            self.assertEqual(cli.main(['load', '--bucket', '', '--dataset', 'runna']), 1)
+        printed.assert_called_once_with("load failed: Bucket name and dataset ID must be provided")
+
+
+if __name__ == '__main__':
+    unittest.main()
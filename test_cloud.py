@@ -0,0 +1,40 @@
+import subprocess
+import sys
+import unittest
+from unittest.mock import patch
+
+import cloud
+from cloud import LazyModule
+
+
+class TestLazyModule(unittest.TestCase):
+    def test_imports_on_first_attribute(self):
+        module = LazyModule('colorsys')
+        self.assertFalse(module.loaded)
+        self.assertEqual(module.rgb_to_hsv(0, 0, 0), (0, 0, 0))
+        self.assertTrue(module.loaded)
+        with self.assertRaises(AttributeError):
+            module.__wrapped__
+        with self.assertRaises(AttributeError):
+            module.no_such_function
+
+    def test_importer_and_loader_do_not_load_the_sdks(self):
+        script = ("import sys, workout_importer, load_multiple_csv, cloud; "
+                  "print(cloud.storage.loaded, cloud.bigquery.loaded, 'google.cloud.storage' in sys.modules, "
+                  "'google.cloud.bigquery' in sys.modules)")
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.split(), ['False'] * 4)
+
+
+class TestSharedClients(unittest.TestCase):
+    def test_one_client_per_process(self):
+        with patch.object(cloud, '_clients', {}), patch('cloud.storage.Client') as storage_class, \
+                patch('cloud.bigquery.Client') as bigquery_class:
+            self.assertIs(cloud.storage_client(), cloud.storage_client())
+            self.assertIs(cloud.bigquery_client(), cloud.bigquery_client())
+        storage_class.assert_called_once_with()
+        bigquery_class.assert_called_once_with()
+
+
+if __name__ == '__main__':
+    unittest.main()
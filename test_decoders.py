@@ -0,0 +1,65 @@
+import json
+import os
+import tempfile
+import unittest
+
+from decoders import (IjsonDecoder, JsonDecoder, OrjsonDecoder, get_decoder, ijson, orjson, project,
+                      projection)
+from tables import LAP_DATA, TABLES
+
+
+ACTIVITY = {
+    "activityId": "activity1",
+    "laps": [{"distance": 200, "wktStepIndex": 0, "deviceLapId": 7}],
+    "waypoints": [{"distance": 1.5, "heartRate": 120, "gps": {"lat": 51.5, "lon": -0.1}},
+                  {"distance": 2.5, "type": "start", "raw": [1, 2, {"x": None}]}],
+    "plannedWorkoutMetadata": {"stepsV2": [{"type": "WorkoutStep", "paces": None}]},
+    "createdOn": 1707150113000,
+    "flag": True,
+}
+
+
+class TestDecoders(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'activity.json')
+        with open(self.path, 'w') as json_file:
+            json.dump(ACTIVITY, json_file)
+        self.decoders = [JsonDecoder] + [decoder for decoder, module in
+                                         [(OrjsonDecoder, orjson), (IjsonDecoder, ijson)] if module is not None]
+
+    def test_projection_lists_keys_read_by_tables(self):
+        keep = projection(TABLES)
+        self.assertEqual(set(keep), {'laps', 'waypoints'})
+        self.assertIn('heartRate', keep['waypoints'])
+        self.assertNotIn('gps', keep['waypoints'])
+        self.assertEqual(projection([LAP_DATA]), {'laps': keep['laps']})
+
+    def test_decoders_match_stdlib(self):
+        for decoder_class in self.decoders:
+            with self.subTest(decoder=decoder_class.name):
+                self.assertEqual(decoder_class().load(self.path), ACTIVITY)
+                with open(self.path, 'rb') as json_file:
+                    self.assertEqual(decoder_class().loads(json_file.read()), ACTIVITY)
+
+    def test_projected_decoders_drop_unread_keys(self):
+        keep = projection(TABLES)
+        expected = project(json.loads(json.dumps(ACTIVITY)), keep)
+        self.assertEqual(expected["waypoints"], [{"distance": 1.5, "heartRate": 120},
+                                                 {"distance": 2.5, "type": "start"}])
+        self.assertEqual(expected["laps"], [{"distance": 200, "wktStepIndex": 0}])
+        self.assertEqual(expected["createdOn"], 1707150113000)
+        for decoder_class in self.decoders:
+            with self.subTest(decoder=decoder_class.name):
+                self.assertEqual(decoder_class(keep).load(self.path), expected)
+
+    def test_get_decoder(self):
+        self.assertEqual(get_decoder('auto').name, 'orjson' if orjson is not None else 'json')
+        self.assertIsInstance(get_decoder('json'), JsonDecoder)
+        with self.assertRaises(ValueError):
+            get_decoder('yaml')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import csv
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from dimensions import KEYED_COLUMNS, DimensionStore, key_column, keyed_spec
+from local_gcs import LocalStorageClient
+from synthetic_data import write_corpus
+from tables import LAP_DATA, STEP_DATA, TABLES, field_names
+from waypoints import np
+from workout_importer import WorkoutImporter
+
+
+def _read_csv(path):
+    with open(path, newline='') as csv_file:
+        return list(csv.DictReader(csv_file))
+
+
+def _decoded(output_dir, table_name):
+    """A keyed table's rows with every key replaced by the value it stands for"""
+    values = {}
+    for dimension in ('activity', 'user', 'plan', 'workout'):
+        for row in _read_csv(f"{output_dir}/dim_{dimension}.csv"):
+            values[(dimension, row[key_column(dimension)])] = row[f"{dimension}_id"]
+    for row in _read_csv(f"{output_dir}/dim_enum.csv"):
+        values[('enum', row["enum_key"])] = row["value"]
+    rows = []
+    for row in _read_csv(f"{output_dir}/{table_name}.csv"):
+        for name, dimension in KEYED_COLUMNS[table_name].items():
+            key = row.pop(key_column(name))
+            row[name] = values[(dimension, key)] if key else ''
+        rows.append(row)
+    return rows
+
+
+def _import(data_dir, output_dir, **options):
+    with tempfile.TemporaryDirectory() as gcs_dir:
+        importer = WorkoutImporter(data_directory=data_dir, streaming=True, storage_client=LocalStorageClient(gcs_dir),
+                                   **options)
+        importer.output_directory = output_dir
+        return importer.import_data()
+
+
+class TestDimensionStore(unittest.TestCase):
+    def test_keys_are_stable_across_saves(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'dimensions.json')
+            store = DimensionStore(path)
+            user = store.interner('user')
+            self.assertEqual([user("user-2"), user("user-1"), user("user-2"), user(None)], [1, 2, 1, None])
+            self.assertEqual(store.interner('enum', 'intensity')("ACTIVE"), 1)
+            self.assertEqual(store.interner('enum', 'target_type')("PACE"), 2)
+            store.save()
+
+            reloaded = DimensionStore(path)
+            self.assertEqual(reloaded.interner('user')("user-1"), 2)
+            self.assertEqual(reloaded.interner('user')("user-3"), 3)
+            self.assertEqual(reloaded.interner('enum', 'intensity')("REST"), 3)
+            self.assertEqual(reloaded.keys('user', ["user-3", "unknown", "user-2"]), [3, 1])
+
+    def test_keyed_spec_replaces_columns_in_place(self):
+        spec = keyed_spec(STEP_DATA)
+        self.assertEqual(field_names(spec)[:4], ["activity_key", "processing_time", "lap_order", "step_type_key"])
+        self.assertEqual({field.type for field in spec.fields if field.name.endswith('_key')}, {"INTEGER"})
+        self.assertEqual(spec.cluster_fields, ("activity_key",))
+        self.assertEqual(len(spec.fields), len(STEP_DATA.fields))
+        self.assertIs(keyed_spec(LAP_DATA._replace(name='unregistered')).fields, LAP_DATA.fields)
+
+
+class TestSurrogateKeys(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.TemporaryDirectory()
+        write_corpus(self.data_dir.name, activities=12, waypoints=20, laps=3)
+
+    def tearDown(self):
+        self.data_dir.cleanup()
+
+    def test_keyed_tables_decode_to_the_plain_ones(self):
+        modes = [{}, {"asynchronous": True, "extract_workers": 0}]
+        if np is not None:
+            modes.append({"vectorized": True})
+        with tempfile.TemporaryDirectory() as plain_dir:
+            _import(self.data_dir.name, plain_dir)
+            for options in modes:
+                with self.subTest(**options), tempfile.TemporaryDirectory() as keyed_dir:
+                    _import(self.data_dir.name, keyed_dir, surrogate_keys=True, **options)
+                    for spec in TABLES:
+                        self.assertEqual(_decoded(keyed_dir, spec.name), _read_csv(f"{plain_dir}/{spec.name}.csv"))
+                        keyed_size = os.path.getsize(f"{keyed_dir}/{spec.name}.csv")
+                        self.assertLess(keyed_size, os.path.getsize(f"{plain_dir}/{spec.name}.csv"))
+
+    def test_incremental_runs_keep_their_keys(self):
+        with tempfile.TemporaryDirectory() as data_dir, tempfile.TemporaryDirectory() as output_dir:
+            files = sorted(os.listdir(self.data_dir.name))
+            for name in files[:6]:
+                shutil.copy(os.path.join(self.data_dir.name, name), data_dir)
+            with patch('workout_importer.WorkoutImporter.upload_to_gcs'):
+                importer = WorkoutImporter(data_directory=data_dir, incremental=True, surrogate_keys=True)
+                importer.output_directory = output_dir
+                first_run = importer.import_data()
+                first = DimensionStore(f"{output_dir}/dimensions.json")
+                for name in files[5:]:
+                    shutil.copy(os.path.join(self.data_dir.name, name), data_dir)
+                with open(os.path.join(data_dir, files[5]), 'a') as json_file:
+                    json_file.write(" ")
+                second_run = importer.import_data()
+            second = DimensionStore(f"{output_dir}/dimensions.json")
+
+            for dimension, keys in first.ids.items():
+                self.assertEqual({value: second.ids[dimension][value] for value in keys}, keys)
+            for enum_type, keys in first.enums.items():
+                self.assertEqual({value: second.enums[enum_type][value] for value in keys}, keys)
+            self.assertEqual(len(second.ids['activity']), 12)
+            dim_activity = _read_csv(f"{output_dir}/dim_activity-{second_run}.csv")
+            self.assertEqual(len(dim_activity), 12)
+            laps = _read_csv(f"{output_dir}/lap_data-{second_run}.csv")
+            with open(os.path.join(data_dir, files[5])) as json_file:
+                redelivered_id = json.load(json_file)["activityId"]
+            self.assertEqual(int(laps[0]["activity_key"]), first.ids['activity'][redelivered_id])
+            self.assertTrue(os.path.exists(f"{output_dir}/run-{first_run}.json"))
+
+    def test_parallel_workers_are_refused(self):
+        with self.assertRaises(ValueError):
+            WorkoutImporter(data_directory=self.data_dir.name, workers=2, surrogate_keys=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
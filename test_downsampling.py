@@ -0,0 +1,81 @@
+import unittest
+
+from downsampling import DistanceThinning, LineSimplification, TimeBuckets, WaypointReducer, make_reducer
+
+
+def _waypoints(count, lap_every=None, **overrides):
+    waypoints = []
+    for index in range(count):
+        waypoint = {"timestamp": 1000 * index, "distance": 3.0 * index, "speed": 3.0,
+                    "heartRate": 140 + index % 5, "cadence": 170, "elevation": 10.0}
+        if lap_every:
+            waypoint["lapIndex"] = index // lap_every
+            waypoint["stepIndex"] = index // lap_every
+        waypoints.append(waypoint)
+    for index, changes in overrides.items():
+        waypoints[int(index[1:])].update(changes)
+    return waypoints
+
+
+class TestDownsampling(unittest.TestCase):
+    def test_time_buckets_keep_first_point_of_each_bucket(self):
+        reducer = TimeBuckets(10)
+        activity = {"activityId": "a1", "waypoints": _waypoints(25)}
+        reduced = reducer.reduce(activity)
+
+        self.assertEqual([waypoint["timestamp"] for waypoint in reduced["waypoints"]], [0, 10000, 20000, 24000])
+        self.assertEqual(len(activity["waypoints"]), 25)
+        buckets = reduced["waypointBuckets"]
+        self.assertEqual([bucket["point_count"] for bucket in buckets], [10, 10, 4, 1])
+        self.assertEqual(buckets[0]["heart_rate_mean"], 142.0)
+        self.assertEqual(buckets[0]["heart_rate_max"], 144)
+        self.assertEqual(buckets[0]["end_timestamp"], 9000)
+        self.assertEqual(reducer.stats, {"activities": 1, "points_in": 25, "points_out": 4})
+        self.assertAlmostEqual(reducer.ratio(), 4 / 25)
+
+    def test_lap_boundaries_and_markers_are_kept(self):
+        waypoints = _waypoints(30, lap_every=7, p12={"type": "start"})
+        reduced = TimeBuckets(60).reduce({"waypoints": waypoints})
+        kept = [waypoint["timestamp"] // 1000 for waypoint in reduced["waypoints"]]
+
+        for lap_start in (0, 7, 14, 21, 28):
+            self.assertIn(lap_start, kept)
+            self.assertIn(lap_start - 1 if lap_start else 29, kept)
+        self.assertIn(12, kept)
+
+    def test_lap_start_timestamps_split_untagged_waypoints(self):
+        activity = {"waypoints": _waypoints(20), "laps": [{"startTimestamp": 0}, {"startTimestamp": 12500}]}
+        kept = [waypoint["timestamp"] for waypoint in TimeBuckets(60).reduce(activity)["waypoints"]]
+        self.assertEqual(kept, [0, 12000, 13000, 19000])
+
+    def test_distance_thinning(self):
+        reduced = DistanceThinning(10).reduce({"waypoints": _waypoints(12)})
+        self.assertEqual([waypoint["distance"] for waypoint in reduced["waypoints"]], [0.0, 12.0, 24.0, 33.0])
+
+    def test_simplification_keeps_only_points_off_the_line(self):
+        waypoints = _waypoints(50)
+        for waypoint in waypoints:
+            waypoint["heartRate"] = 140
+        waypoints[20]["speed"] = 5.0
+        reduced = LineSimplification(1).reduce({"waypoints": waypoints})
+        self.assertEqual([waypoint["timestamp"] // 1000 for waypoint in reduced["waypoints"]], [0, 19, 20, 21, 49])
+
+    def test_simplification_handles_long_segments(self):
+        reduced = LineSimplification(1).reduce({"waypoints": _waypoints(5000)})
+        self.assertEqual(sum(bucket["point_count"] for bucket in reduced["waypointBuckets"]), 5000)
+
+    def test_make_reducer(self):
+        self.assertIsInstance(make_reducer('time:5'), TimeBuckets)
+        self.assertEqual(make_reducer('distance:25').meters, 25.0)
+        self.assertIsInstance(make_reducer('simplify'), LineSimplification)
+        with self.assertRaises(ValueError):
+            make_reducer('median:3')
+        for spec in ('time', 'distance:', 'time:0', 'distance:-10', 'simplify:0', 'time:fast', 'time:inf'):
+            with self.subTest(spec), self.assertRaisesRegex(ValueError, spec):
+                make_reducer(spec)
+        with self.assertRaises(TypeError):
+            WaypointReducer()
+
+
+if __name__ == '__main__':
+    unittest.main()
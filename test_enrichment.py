@@ -0,0 +1,147 @@
+import csv
+import json
+import math
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from enrichment import (ENRICHED_WAYPOINT_DATA, LAP_SPLITS, EnrichedWaypointArrays, WaypointEnricher, np,
+                        workout_steps)
+from local_gcs import LocalStorageClient
+from synthetic_data import write_corpus
+from tables import ExtractionEngine, field_names
+from workout_importer import WorkoutImporter
+
+
+def _waypoint(second, distance, elevation=10.0, heart_rate=150):
+    return {"timestamp": 1_700_000_000_000 + second * 1000, "distance": distance, "elevation": elevation,
+            "heartRate": heart_rate}
+
+
+ACTIVITY = {
+    "activityId": "activity1",
+    "laps": [{"startTimestamp": 1_700_000_000_000, "wktStepIndex": 0},
+             {"startTimestamp": 1_700_000_004_000, "wktStepIndex": 1},
+             {"startTimestamp": 1_700_000_006_000, "wktStepIndex": 2}],
+    "waypoints": [_waypoint(0, 0.0, heart_rate=100), _waypoint(1, 4.0, heart_rate=None),
+                  _waypoint(2, 8.0, 10.5, 125), _waypoint(3, 12.0, 11.0, 150),
+                  _waypoint(4, 16.0, 11.0, 160), _waypoint(5, 20.0, 11.0, 175),
+                  _waypoint(6, 20.0, 11.0, 180), _waypoint(20, 25.0, 11.0, 180)],
+    "plannedWorkoutMetadata": {"stepsV2": [
+        {"type": "WorkoutStep", "intensity": "WARMUP"},
+        {"type": "WorkoutRepeatStep", "repeatValue": 2, "steps": [
+            {"type": "WorkoutStep", "intensity": "ACTIVE", "paces": {"average": {"mps": 4.0}}},
+        ]},
+        {"type": "WorkoutStep", "intensity": "COOLDOWN"},
+    ]},
+}
+
+
+def _close(test, values, expected):
+    test.assertEqual(len(values), len(expected))
+    for value, expected_value in zip(values, expected):
+        if expected_value is None:
+            test.assertTrue(value is None or math.isnan(value), (values, expected))
+        else:
+            test.assertAlmostEqual(value, expected_value)
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestWaypointEnricher(unittest.TestCase):
+    def setUp(self):
+        self.enricher = WaypointEnricher(max_heart_rate=200, window_seconds=2, grade_meters=8)
+        self.activity = self.enricher.enrich(ACTIVITY)
+
+    def test_waypoint_metrics(self):
+        metrics = self.activity['waypointMetrics']
+        #4 m a second is 250 s/km; standing still has no pace
+        _close(self, metrics['pace_s_per_km'], [None, 250, 250, 250, 250, 250, None, 2800])
+        #No other point falls in the window of the last one, 14 s after its predecessor
+        _close(self, metrics['rolling_pace_s_per_km'], [None, 250, 250, 250, 250, 250, 500, None])
+        _close(self, metrics['grade_percent'], [None, 0, 6.25, 12.5, 6.25, 0, 0, 0])
+        _close(self, metrics['hr_zone'], [1, None, 2, 3, 4, 4, 5, 5])
+
+    def test_lap_splits_match_workout_steps(self):
+        self.assertEqual([step.get('intensity') for step in workout_steps(ACTIVITY)],
+                         ["WARMUP", "ACTIVE", None, "COOLDOWN"])
+        warmup, active, repeat = self.activity['lapSplits']
+        self.assertEqual((warmup["point_count"], warmup["distance"], warmup["elapsed_seconds"]), (4, 16.0, 4.0))
+        self.assertEqual(warmup["step_intensity"], "WARMUP")
+        self.assertEqual(warmup["zone_1_seconds"], 1.0)
+        self.assertEqual(warmup["zone_3_seconds"], 1.0)
+        self.assertEqual(active["step_intensity"], "ACTIVE")
+        self.assertEqual(active["pace_s_per_km"], 500.0)
+        self.assertEqual(active["target_pace_s_per_km"], 250.0)
+        self.assertEqual(active["pace_vs_target_s_per_km"], 250.0)
+        #The 14 s pause before the last point is not counted as time in zone
+        self.assertEqual(repeat["zone_5_seconds"], 0.0)
+        self.assertIsNone(repeat["target_pace_s_per_km"])
+
+    def test_vectorized_columns_match_rows(self):
+        rows = list(ExtractionEngine("2024-01-01", [ENRICHED_WAYPOINT_DATA]).rows('waypoint_data', self.activity))
+        batch = EnrichedWaypointArrays("2024-01-01").build(self.activity)
+        self.assertEqual(list(rows[0]), field_names(ENRICHED_WAYPOINT_DATA))
+        for name in field_names(ENRICHED_WAYPOINT_DATA):
+            self.assertEqual(batch.column(name), [row[name] for row in rows], name)
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestEnrichedImport(unittest.TestCase):
+    def test_import_writes_derived_columns_and_splits(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            write_corpus(data_dir, activities=4, waypoints=200, laps=5)
+            outputs = []
+            for options in ({"streaming": True}, {"asynchronous": True, "extract_workers": 0, "vectorized": True}):
+                output_dir, gcs_dir = tempfile.TemporaryDirectory(), tempfile.TemporaryDirectory()
+                self.addCleanup(output_dir.cleanup)
+                self.addCleanup(gcs_dir.cleanup)
+                importer = WorkoutImporter(data_directory=data_dir, enrich=True, shard_rows=10_000,
+                                           storage_client=LocalStorageClient(gcs_dir.name), **options)
+                importer.output_directory = output_dir.name
+                importer.import_data()
+                outputs.append(output_dir.name)
+
+            for output_dir in outputs:
+                with open(os.path.join(output_dir, "lap_splits", os.listdir(f"{output_dir}/lap_splits")[0])) as f:
+                    splits = list(csv.DictReader(f))
+                self.assertEqual(len(splits), 4 * 5)
+                self.assertEqual(list(splits[0]), field_names(LAP_SPLITS))
+            shards = [sorted(os.listdir(f"{output_dir}/waypoint_data")) for output_dir in outputs]
+            with open(f"{outputs[0]}/waypoint_data/{shards[0][0]}") as serial, \
+                    open(f"{outputs[1]}/waypoint_data/{shards[1][0]}") as pipelined:
+                serial_rows, pipelined_rows = list(csv.DictReader(serial)), list(csv.DictReader(pipelined))
+            self.assertEqual(len(serial_rows), 800)
+            self.assertIn("rolling_pace_s_per_km", serial_rows[0])
+            self.assertEqual(serial_rows, pipelined_rows)
+
+    def test_activity_that_fails_to_enrich_is_skipped(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            write_corpus(data_dir, activities=3, waypoints=20, laps=2)
+            with open(f"{data_dir}/activity-000001.json") as json_file:
+                activity = json.load(json_file)
+            activity["laps"][0]["startTimestamp"] = "yesterday"
+            with open(f"{data_dir}/activity-000001.json", 'w') as json_file:
+                json.dump(activity, json_file)
+
+            for options in ({"streaming": True}, {"workers": 2}, {"asynchronous": True, "extract_workers": 0}):
+                with self.subTest(**options), tempfile.TemporaryDirectory() as output_dir, \
+                        tempfile.TemporaryDirectory() as gcs_dir:
+                    importer = WorkoutImporter(data_directory=data_dir, enrich=True,
+                                               report_path=f"{output_dir}/report.json",
+                                               storage_client=LocalStorageClient(gcs_dir), **options)
+                    importer.output_directory = output_dir
+                    with patch('builtins.print'):
+                        importer.import_data()
+                    with open(f"{output_dir}/activity_data.csv") as csv_file:
+                        self.assertEqual([row["activity_id"] for row in csv.DictReader(csv_file)],
+                                         ["activity-0", "activity-2"])
+                    with open(f"{output_dir}/report.json") as report_file:
+                        report = json.load(report_file)
+                    self.assertEqual(report["failures"], 1)
+                    self.assertEqual([record["table"] for record in report["tables"] if record["failures"]],
+                                     ["lap_splits"])
+
+
+if __name__ == '__main__':
+    unittest.main()
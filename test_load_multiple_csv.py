@@ -1,7 +1,9 @@
+import json
 import unittest
 from unittest.mock import Mock, patch, MagicMock
 from google.cloud import bigquery, storage
-from load_multiple_csv import load_csv_files_to_bigquery
+from load_multiple_csv import group_blobs, load_csv_files_to_bigquery
+from metrics import PipelineMetrics
 
 class TestLoadCSVToBigQuery(unittest.TestCase):
     def setUp(self):
@@ -40,6 +42,235 @@ class TestLoadCSVToBigQuery(unittest.TestCase):
         self.assertEqual(mock_storage_client.return_value.bucket.call_count, 1)
         self.assertEqual(mock_bigquery_client.return_value.load_table_from_uri.call_count, 2)
 
+    @patch('load_multiple_csv.bigquery.Client')
+    @patch('load_multiple_csv.storage.Client')
+    def test_parquet_files_use_parquet_format(self, mock_storage_client, mock_bigquery_client):
+        """Test that Parquet blobs are loaded as Parquet into the table named after the file"""
+        mock_blob = Mock()
+        mock_blob.name = "waypoint_data.parquet"
+        mock_storage_client.return_value.bucket.return_value.list_blobs.return_value = [mock_blob]
+
+        load_csv_files_to_bigquery(self.bucket_name, self.dataset_id)
+
+        mock_bigquery_client.return_value.dataset.return_value.table.assert_called_with("waypoint_data")
+        job_config = mock_bigquery_client.return_value.load_table_from_uri.call_args.kwargs['job_config']
+        self.assertEqual(job_config.source_format, bigquery.SourceFormat.PARQUET)
+        self.assertFalse(job_config.autodetect)
+
+    @patch('load_multiple_csv.bigquery.Client')
+    @patch('load_multiple_csv.storage.Client')
+    def test_registered_tables_use_explicit_schema(self, mock_storage_client, mock_bigquery_client):
+        """Test that known tables skip autodetect and are created partitioned and clustered"""
+        self._mock_blobs(mock_storage_client, ["lap_data", "unknown_table.csv"])
+
+        load_csv_files_to_bigquery(self.bucket_name, self.dataset_id)
+
+        client = mock_bigquery_client.return_value
+        configs = {call.args[0][0].rsplit('/', 1)[1]: call.kwargs['job_config']
+                   for call in client.load_table_from_uri.call_args_list}
+        lap_config = configs["lap_data"]
+        self.assertFalse(lap_config.autodetect)
+        self.assertEqual(lap_config.schema[14].name, "start_timestamp")
+        self.assertEqual(lap_config.schema[14].field_type, "INTEGER")
+        self.assertEqual(lap_config.schema[0].mode, "REQUIRED")
+        self.assertEqual(lap_config.time_partitioning.field, "processing_time")
+        self.assertEqual(lap_config.clustering_fields, ["activity_id"])
+        self.assertTrue(configs["unknown_table.csv"].autodetect)
+
+        created = client.create_table.call_args.args[0]
+        self.assertEqual(created.time_partitioning.field, "processing_time")
+        self.assertEqual(created.clustering_fields, ["activity_id"])
+        self.assertEqual(client.create_table.call_count, 1)
+
+    @patch('load_multiple_csv.bigquery.Client')
+    @patch('load_multiple_csv.storage.Client')
+    def test_incremental_run_appends_and_merges(self, mock_storage_client, mock_bigquery_client):
+        """Test that a run id only appends that run's deltas after deleting re-delivered activities"""
+        mock_bucket = mock_storage_client.return_value.bucket.return_value
+        mock_bucket.blob.return_value.download_as_text.return_value = '{"redelivered_activity_ids": ["activity1"]}'
+        names = ["activity_data", "activity_data/run1.csv", "activity_data/run0.csv", "runs/run1.json"]
+        blobs = []
+        for name in names:
+            blob = Mock()
+            blob.name = name
+            blobs.append(blob)
+        mock_bucket.list_blobs.return_value = blobs
+
+        load_csv_files_to_bigquery(self.bucket_name, self.dataset_id, run_id="run1")
+
+        mock_bucket.blob.assert_called_once_with("runs/run1.json")
+        client = mock_bigquery_client.return_value
+        self.assertEqual(client.load_table_from_uri.call_count, 1)
+        uris = client.load_table_from_uri.call_args.args[0]
+        self.assertEqual(uris, [f"gs://{self.bucket_name}/activity_data/run1.csv"])
+        job_config = client.load_table_from_uri.call_args.kwargs['job_config']
+        self.assertEqual(job_config.write_disposition, bigquery.WriteDisposition.WRITE_APPEND)
+        self.assertEqual(job_config.schema_update_options, [bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION])
+        self.assertIn("DELETE FROM `test-dataset.activity_data`", client.query.call_args.args[0])
+
+    def _mock_blobs(self, mock_storage_client, names):
+        blobs = []
+        for name in names:
+            blob = Mock()
+            blob.name = name
+            blobs.append(blob)
+        mock_storage_client.return_value.bucket.return_value.list_blobs.return_value = blobs
+
+    @patch('load_multiple_csv.bigquery.Client')
+    @patch('load_multiple_csv.storage.Client')
+    def test_run_shards_are_batched_into_one_job(self, mock_storage_client, mock_bigquery_client):
+        """Test that every shard of a table in a run goes into a single wildcard load job"""
+        mock_bucket = mock_storage_client.return_value.bucket.return_value
+        mock_bucket.blob.return_value.download_as_text.return_value = '{"redelivered_activity_ids": []}'
+        self._mock_blobs(mock_storage_client, ["lap_data/run1-00000.csv", "lap_data/run1-00001.csv",
+                                               "step_data/run1-00000.csv", "lap_data/run10-00000.csv"])
+
+        reports = load_csv_files_to_bigquery(self.bucket_name, self.dataset_id, run_id="run1")
+
+        client = mock_bigquery_client.return_value
+        self.assertEqual(client.load_table_from_uri.call_count, 2)
+        self.assertFalse(client.query.called)
+        jobs = {call.args[0][0].split('/')[3]: call.args[0] for call in client.load_table_from_uri.call_args_list}
+        self.assertEqual(jobs["lap_data"], [f"gs://{self.bucket_name}/lap_data/run1-*.csv"])
+        self.assertEqual(jobs["step_data"], [f"gs://{self.bucket_name}/step_data/run1-00000.csv"])
+        self.assertEqual(sorted(report.table_name for report in reports), ["lap_data", "step_data"])
+        self.assertTrue(all(report.status == 'SUCCESS' for report in reports))
+
+    @patch('load_multiple_csv.bigquery.Client')
+    @patch('load_multiple_csv.storage.Client')
+    def test_load_metrics_per_table(self, mock_storage_client, mock_bigquery_client):
+        """Test that each load job is recorded in the bigquery_load stage"""
+        self._mock_blobs(mock_storage_client, ["activity_data", "lap_data"])
+        mock_bigquery_client.return_value.load_table_from_uri.return_value.output_rows = 7
+        metrics = PipelineMetrics()
+
+        load_csv_files_to_bigquery(self.bucket_name, self.dataset_id, metrics=metrics)
+
+        report = metrics.report()
+        self.assertEqual([stage["stage"] for stage in report["stages"]], ['bigquery_load'])
+        self.assertEqual(sorted(record["table"] for record in report["tables"]), ["activity_data", "lap_data"])
+        self.assertTrue(all(record["rows_out"] == 7 for record in report["tables"]))
+
+    @patch('load_multiple_csv.bigquery.Client')
+    @patch('load_multiple_csv.storage.Client')
+    def test_summary_snapshots_replace_their_tables(self, mock_storage_client, mock_bigquery_client):
+        """Test that an incremental run appends activity_summary but replaces the snapshot tables"""
+        mock_bucket = mock_storage_client.return_value.bucket.return_value
+        mock_bucket.blob.return_value.download_as_text.return_value = '{"redelivered_activity_ids": ["a1"]}'
+        self._mock_blobs(mock_storage_client, ["activity_summary/run3.csv", "workout_leaderboard/run3.csv"])
+
+        load_csv_files_to_bigquery(self.bucket_name, self.dataset_id, run_id="run3")
+
+        client = mock_bigquery_client.return_value
+        dispositions = {call.args[0][0].split('/')[3]: call.kwargs['job_config'].write_disposition
+                        for call in client.load_table_from_uri.call_args_list}
+        self.assertEqual(dispositions, {"activity_summary": bigquery.WriteDisposition.WRITE_APPEND,
+                                        "workout_leaderboard": bigquery.WriteDisposition.WRITE_TRUNCATE})
+        self.assertEqual(client.query.call_count, 1)
+        self.assertIn("activity_summary", client.query.call_args.args[0])
+
+    @patch('load_multiple_csv.bigquery.Client')
+    @patch('load_multiple_csv.storage.Client')
+    def test_keyed_run_loads_keyed_schemas_and_dimensions(self, mock_storage_client, mock_bigquery_client):
+        """Test that a run written with surrogate keys deletes by activity_key and replaces the dimensions"""
+        mock_bucket = mock_storage_client.return_value.bucket.return_value
+        mock_bucket.blob.return_value.download_as_text.return_value = json.dumps(
+            {"surrogate_keys": True, "redelivered_activity_ids": ["a1"], "redelivered_activity_keys": [7]})
+        self._mock_blobs(mock_storage_client, ["lap_data/run4.csv", "dim_activity/run4.csv"])
+
+        load_csv_files_to_bigquery(self.bucket_name, self.dataset_id, run_id="run4")
+
+        client = mock_bigquery_client.return_value
+        configs = {call.args[0][0].split('/')[3]: call.kwargs['job_config']
+                   for call in client.load_table_from_uri.call_args_list}
+        self.assertEqual(configs["lap_data"].write_disposition, bigquery.WriteDisposition.WRITE_APPEND)
+        self.assertEqual(configs["lap_data"].schema[0].name, "activity_key")
+        self.assertEqual(configs["lap_data"].clustering_fields, ["activity_key"])
+        self.assertEqual(configs["dim_activity"].write_disposition, bigquery.WriteDisposition.WRITE_TRUNCATE)
+        self.assertEqual(client.query.call_count, 1)
+        self.assertIn("WHERE activity_key IN", client.query.call_args.args[0])
+        parameter = client.query.call_args.kwargs['job_config'].query_parameters[0]
+        self.assertEqual((parameter.array_type, parameter.values), ("INT64", [7]))
+
+    @patch('load_multiple_csv.bigquery.Client')
+    @patch('load_multiple_csv.storage.Client')
+    def test_enriched_run_loads_derived_columns(self, mock_storage_client, mock_bigquery_client):
+        """Test that an enriched run loads waypoint_data with the derived columns and lap_splits"""
+        mock_bucket = mock_storage_client.return_value.bucket.return_value
+        mock_bucket.blob.return_value.download_as_text.return_value = json.dumps({"enriched": True})
+        self._mock_blobs(mock_storage_client, ["waypoint_data/run5.csv", "lap_splits/run5.csv"])
+
+        load_csv_files_to_bigquery(self.bucket_name, self.dataset_id, run_id="run5")
+
+        client = mock_bigquery_client.return_value
+        configs = {call.args[0][0].split('/')[3]: call.kwargs['job_config']
+                   for call in client.load_table_from_uri.call_args_list}
+        waypoint_columns = [field.name for field in configs["waypoint_data"].schema]
+        self.assertEqual(waypoint_columns[-2:], ["hr_zone", "processing_time"])
+        self.assertIn("rolling_pace_s_per_km", waypoint_columns)
+        self.assertEqual(configs["lap_splits"].schema[1].name, "lap_order")
+
+    @patch('load_multiple_csv.bigquery.Client')
+    @patch('load_multiple_csv.storage.Client')
+    def test_full_sharded_run_replaces_tables(self, mock_storage_client, mock_bigquery_client):
+        """Test that a full run's gzipped shards truncate their table without deleting first"""
+        mock_bucket = mock_storage_client.return_value.bucket.return_value
+        mock_bucket.blob.return_value.download_as_text.return_value = '{"mode": "full"}'
+        self._mock_blobs(mock_storage_client, ["waypoint_data/run2-00000.csv.gz", "waypoint_data/run2-00001.csv.gz",
+                                               "runs/run2.json"])
+
+        load_csv_files_to_bigquery(self.bucket_name, self.dataset_id, run_id="run2")
+
+        client = mock_bigquery_client.return_value
+        uris, table_ref = client.load_table_from_uri.call_args.args
+        job_config = client.load_table_from_uri.call_args.kwargs['job_config']
+        self.assertEqual(uris, [f"gs://{self.bucket_name}/waypoint_data/run2-*.csv.gz"])
+        self.assertEqual(job_config.write_disposition, bigquery.WriteDisposition.WRITE_TRUNCATE)
+        self.assertEqual(job_config.source_format, bigquery.SourceFormat.CSV)
+        self.assertFalse(client.query.called)
+
+    @patch('load_multiple_csv.bigquery.Client')
+    @patch('load_multiple_csv.storage.Client')
+    def test_failed_tables_are_reported_after_all_jobs(self, mock_storage_client, mock_bigquery_client):
+        """Test that one failing job does not stop the others and is raised at the end"""
+        self._mock_blobs(mock_storage_client, ["activity_data", "lap_data", "step_data"])
+        failing_job = Mock()
+        failing_job.result.side_effect = Exception("schema mismatch")
+        client = mock_bigquery_client.return_value
+        client.load_table_from_uri.side_effect = lambda uris, table_ref, job_config: (
+            failing_job if uris[0].endswith("lap_data") else Mock())
+
+        with self.assertRaises(RuntimeError) as error:
+            load_csv_files_to_bigquery(self.bucket_name, self.dataset_id, max_concurrent_jobs=2)
+
+        self.assertIn("lap_data", str(error.exception))
+        self.assertEqual(client.load_table_from_uri.call_count, 3)
+
+    def test_group_blobs_without_run_id_uses_top_level_files(self):
+        groups = group_blobs(["activity_data", "waypoint_data.parquet", "step_data.csv.gz", "lap_data/run1.csv",
+                              "runs/run1.json"])
+        self.assertEqual(groups, {"activity_data": ("", ["activity_data"]),
+                                  "waypoint_data": (".parquet", ["waypoint_data.parquet"]),
+                                  "step_data": (".csv.gz", ["step_data.csv.gz"])})
+
+    @patch('load_multiple_csv.bigquery.Client')
+    @patch('load_multiple_csv.storage.Client')
+    def test_table_staged_in_two_formats_is_not_loaded(self, mock_storage_client, mock_bigquery_client):
+        with self.assertRaisesRegex(ValueError, "activity_data"):
+            group_blobs(["activity_data", "activity_data.parquet", "lap_data"])
+        with self.assertRaisesRegex(ValueError, "lap_data/run1-"):
+            group_blobs(["lap_data/run1-000000.csv.gz", "lap_data/run1-000001.parquet"], "run1")
+
+        blobs = []
+        for name in ("activity_data", "activity_data.parquet"):
+            blob = Mock()
+            blob.name = name
+            blobs.append(blob)
+        mock_storage_client.return_value.bucket.return_value.list_blobs.return_value = blobs
+        with self.assertRaises(ValueError):
+            load_csv_files_to_bigquery(self.bucket_name, self.dataset_id)
+        mock_bigquery_client.return_value.load_table_from_uri.assert_not_called()
+
     
     def test_invalid_bucket_name(self):
         """Test handling of invalid bucket name"""
@@ -0,0 +1,45 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from manifest import Manifest
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.manifest_path = os.path.join(self.directory.name, 'manifest.json')
+        self.json_file = Path(self.directory.name) / 'activity.json'
+        self.json_file.write_bytes(b'{"activityId": "activity1"}')
+
+    def record_and_reload(self):
+        manifest = Manifest(self.manifest_path)
+        manifest.record(self.json_file, self.json_file.read_bytes(), "activity1")
+        manifest.save()
+        return Manifest(self.manifest_path)
+
+    def test_new_file_is_pending(self):
+        manifest = Manifest(self.manifest_path)
+        self.assertEqual(manifest.pending([self.json_file]), [self.json_file])
+
+    def test_recorded_file_is_skipped(self):
+        manifest = self.record_and_reload()
+        self.assertEqual(manifest.pending([self.json_file]), [])
+        self.assertEqual(manifest.known_activity_ids, {"activity1"})
+
+    def test_touched_file_with_same_content_is_skipped(self):
+        manifest = self.record_and_reload()
+        stat = os.stat(self.json_file)
+        os.utime(self.json_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertEqual(manifest.pending([self.json_file]), [])
+
+    def test_changed_content_is_pending(self):
+        manifest = self.record_and_reload()
+        self.json_file.write_bytes(b'{"activityId": "activity1", "laps": []}')
+        self.assertEqual(manifest.pending([self.json_file]), [self.json_file])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import json
+import os
+import pstats
+import tempfile
+import unittest
+
+from metrics import PipelineMetrics, profiled
+
+
+class TestPipelineMetrics(unittest.TestCase):
+    def test_stage_times_and_counts(self):
+        metrics = PipelineMetrics()
+        with metrics.stage('extract') as record:
+            record["rows_in"] += 3
+        metrics.table('extract', 'lap_data', rows_out=6, bytes_written=120)
+        metrics.table('extract', 'lap_data', rows_out=2, failures=None)
+
+        report = metrics.report()
+        self.assertEqual(report["stages"][0]["stage"], 'extract')
+        self.assertEqual(report["stages"][0]["rows_in"], 3)
+        self.assertGreaterEqual(report["stages"][0]["wall_seconds"], 0)
+        self.assertIsNone(report["stages"][0]["peak_memory_bytes"])
+        self.assertEqual(report["tables"][0]["rows_out"], 8)
+        self.assertEqual(report["tables"][0]["bytes_written"], 120)
+
+    def test_failures_are_counted(self):
+        metrics = PipelineMetrics()
+        with self.assertRaises(ValueError):
+            with metrics.stage('load'):
+                raise ValueError("bad json")
+        metrics.failure('extract', 'step_data')
+        self.assertEqual(metrics.report()["failures"], 2)
+
+    def test_trace_memory_records_peak(self):
+        metrics = PipelineMetrics(trace_memory=True)
+        with metrics.stage('load'):
+            data = [0] * 100_000
+        del data
+        self.assertGreater(metrics.stages[0]["peak_memory_bytes"], 100_000 * 8)
+
+    def test_write_report_and_profile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            report_path = os.path.join(directory, 'report.json')
+            profile_path = os.path.join(directory, 'run.prof')
+            metrics = PipelineMetrics()
+            with profiled(profile_path), metrics.stage('extract'):
+                sum(range(1000))
+            metrics.write_report(report_path)
+
+            with open(report_path) as report_file:
+                self.assertEqual(json.load(report_file)["stages"][0]["stage"], 'extract')
+            self.assertGreater(pstats.Stats(profile_path).total_calls, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import csv
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import ordering
+from local_gcs import LocalStorageClient
+from ordering import ActivityOrderer, sort_key, start_time
+from synthetic_data import generate_activity, write_corpus
+from workout_importer import WorkoutImporter
+
+
+def _activity(activity_id, user_id, start, record_type="PHONE", waypoints=1):
+    return {"activityId": activity_id, "userId": user_id, "recordType": record_type,
+            "laps": [{"startTimestamp": start}], "waypoints": [{"timestamp": start}] * waypoints}
+
+
+ACTIVITIES = [
+    _activity("a1", "user-2", 300),
+    _activity("a2", "user-1", 200, waypoints=5),
+    _activity("a3", "user-1", 100),
+    _activity("a2", "user-1", 200, record_type="GARMIN"),
+    _activity("a4", "user-2", 50),
+    _activity("a2", "user-1", 200, waypoints=3),
+]
+
+
+def _copies(activities):
+    """(activity id, record type, waypoint count) of each activity"""
+    return [(activity["activityId"], activity["recordType"], len(activity["waypoints"])) for activity in activities]
+
+
+class TestActivityOrderer(unittest.TestCase):
+    def test_sorted_by_user_and_start(self):
+        orderer = ActivityOrderer()
+        self.assertEqual([activity["activityId"] for activity in orderer.apply(ACTIVITIES)], ["a3", "a2", "a4", "a1"])
+        self.assertEqual(orderer.stats, {"activities_in": 6, "activities_out": 4, "duplicates": 2, "spilled_runs": 0,
+                                         "spilled_bytes": 0})
+
+    def test_precedences(self):
+        expected = {'garmin': ("a2", "GARMIN", 1), 'most_waypoints': ("a2", "PHONE", 5),
+                    'latest': ("a2", "PHONE", 3), 'first': ("a2", "PHONE", 5)}
+        for precedence, copy in expected.items():
+            with self.subTest(precedence):
+                kept = _copies(ActivityOrderer(precedence).apply(ACTIVITIES))
+                self.assertEqual([entry for entry in kept if entry[0] == "a2"], [copy])
+        with self.assertRaises(ValueError):
+            ActivityOrderer('newest')
+
+    def test_spilled_runs_merge_to_the_same_order(self):
+        activities = [generate_activity(index, 3, laps=1) for index in range(40)]
+        activities += [dict(activity, recordType="GARMIN") for activity in activities[::3]]
+        expected = _copies(ActivityOrderer().apply(activities))
+        with tempfile.TemporaryDirectory() as spill_directory, patch.object(ordering, 'MERGE_FAN_IN', 3):
+            orderer = ActivityOrderer(buffer_size=4, spill_directory=spill_directory)
+            merged = list(orderer.apply(activities))
+            self.assertEqual(os.listdir(spill_directory), [])
+        self.assertEqual(_copies(merged), expected)
+        #Every GARMIN copy wins or ties, so none is dropped on arrival: 54 activities make 13 runs
+        #of 4, which 5 merges of 3 runs bring down to the last 3, merged with the 2 left in memory
+        self.assertEqual(orderer.stats["spilled_runs"], 13 + 5)
+        self.assertEqual(orderer.stats["duplicates"], 14)
+        self.assertEqual(len(expected), 40)
+        keys = [sort_key(activity, 0)[:4] for activity in merged]
+        self.assertEqual(keys, sorted(keys))
+
+    def test_start_time_fallbacks(self):
+        self.assertEqual(start_time({"createdOn": 5, "laps": [{"startTimestamp": 7}]}), 5)
+        self.assertEqual(start_time({"laps": [], "waypoints": [{"timestamp": 9}]}), 9)
+        self.assertIsNone(start_time({"createdOn": "2024-02-05"}))
+        last = [activity["activityId"] for activity in ActivityOrderer().apply(
+            [{"activityId": "undated", "userId": "u"}, _activity("dated", "u", 10_000)])]
+        self.assertEqual(last, ["dated", "undated"])
+
+
+class TestDedupedImport(unittest.TestCase):
+    def test_duplicates_are_dropped_from_every_table(self):
+        with tempfile.TemporaryDirectory() as data_dir, tempfile.TemporaryDirectory() as output_dir, \
+                tempfile.TemporaryDirectory() as gcs_dir:
+            write_corpus(data_dir, activities=8, waypoints=10, laps=2)
+            with open(f"{data_dir}/activity-000003.json") as json_file:
+                activity = json.load(json_file)
+            activity["recordType"] = "PHONE" if activity["recordType"] == "GARMIN" else "GARMIN"
+            with open(f"{data_dir}/activity-resync.json", 'w') as json_file:
+                json.dump(activity, json_file)
+
+            importer = WorkoutImporter(data_directory=data_dir, streaming=True, dedupe='garmin', sort_buffer=3,
+                                       storage_client=LocalStorageClient(gcs_dir),
+                                       report_path=f"{output_dir}/report.json")
+            importer.output_directory = output_dir
+            importer.import_data()
+
+            with open(f"{output_dir}/activity_data.csv") as csv_file:
+                rows = list(csv.DictReader(csv_file))
+            self.assertEqual(len({row["activity_id"] for row in rows}), 8)
+            self.assertEqual([row["record_type"] for row in rows if row["activity_id"] == "activity-3"], ["GARMIN"])
+            users = [row["user_id"] for row in rows]
+            self.assertEqual(users, sorted(users))
+            with open(f"{output_dir}/lap_data.csv") as csv_file:
+                self.assertEqual(len(list(csv.DictReader(csv_file))), 8 * 2)
+            with open(f"{output_dir}/report.json") as report_file:
+                report = json.load(report_file)
+            #activity-3 was a GARMIN copy, so the PHONE re-sync read after it is dropped on arrival
+            self.assertEqual(report["counters"]["order"], {"duplicates": 1, "spilled_runs": 2})
+
+    def test_needs_a_single_reader(self):
+        for options in ({"workers": 2}, {"asynchronous": True}):
+            with self.subTest(**options), self.assertRaises(ValueError):
+                WorkoutImporter(data_directory='./data', dedupe='latest', **options)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import copy
+import json
+import tempfile
+import unittest
+
+from local_gcs import LocalStorageClient
+from step_templates import DEFAULT_CACHE_SIZE, StepTemplates
+from synthetic_data import generate_activity, write_corpus
+from tables import STEP_DATA, ExtractionEngine
+from test_tables import ACTIVITY, ListSink, RecordSink
+from workout_importer import WorkoutImporter
+
+
+def _activity(activity_id, steps):
+    return {"activityId": activity_id, "plannedWorkoutMetadata": {"stepsV2": steps}}
+
+
+class TestStepTemplates(unittest.TestCase):
+    def setUp(self):
+        self.plain = ExtractionEngine("2024-01-01", [STEP_DATA])
+        self.templates = StepTemplates("2024-01-01")
+        self.engine = ExtractionEngine("2024-01-01", [STEP_DATA], record_builders={'step_data': self.templates})
+
+    def test_records_match_the_engine(self):
+        activities = [ACTIVITY] + [generate_activity(index, 5, laps=1, repeat_depth=2, step_plans=3)
+                                   for index in range(12)]
+        for activity in activities:
+            self.assertEqual(list(self.engine.records('step_data', activity)),
+                             list(self.plain.records('step_data', activity)))
+            self.assertEqual(list(self.engine.rows('step_data', activity)),
+                             list(self.plain.rows('step_data', activity)))
+        #Both records and rows look the template up
+        self.assertEqual(self.templates.stats, {"hits": 22, "misses": 4, "evictions": 0})
+
+    def test_run_stamps_each_activity(self):
+        steps = ACTIVITY["plannedWorkoutMetadata"]["stepsV2"]
+        records, rows = RecordSink(), ListSink()
+        self.engine.run([_activity("a1", steps), _activity("a2", copy.deepcopy(steps))],
+                        {'step_data': records})
+        self.engine.run([_activity("a3", steps)], {'step_data': rows})
+        self.assertEqual([record[0] for record in records], ["a1"] * 3 + ["a2"] * 3)
+        self.assertEqual(records[:3], [("a1",) + record[1:] for record in records[3:]])
+        self.assertEqual([row["activity_id"] for row in rows], ["a3"] * 3)
+        self.assertEqual(self.engine.stats['step_data']["rows_out"], 9)
+        self.assertEqual(self.templates.stats["hits"], 2)
+
+    def test_key_only_holds_the_values_read(self):
+        steps = ACTIVITY["plannedWorkoutMetadata"]["stepsV2"]
+        key = self.templates.structure_key(_activity("a1", steps))
+        reordered = [dict(reversed(list(step.items())), __typename="WorkoutStepV2") for step in steps]
+        self.assertEqual(self.templates.structure_key(_activity("a2", reordered)), key)
+        changed = copy.deepcopy(steps)
+        changed[1]["repeatValue"] = 4
+        self.assertNotEqual(self.templates.structure_key(_activity("a1", changed)), key)
+        self.assertEqual(self.templates.maxsize, DEFAULT_CACHE_SIZE)
+
+    def test_unhashable_values_are_built_uncached(self):
+        activity = _activity("a1", [{"type": "WorkoutStep", "intensity": ["ACTIVE"]}])
+        self.assertEqual(list(self.engine.records('step_data', activity)),
+                         list(self.plain.records('step_data', activity)))
+        self.assertEqual(len(self.templates), 0)
+        self.assertEqual(self.templates.stats["misses"], 1)
+
+    def test_least_recently_used_template_is_evicted(self):
+        templates = StepTemplates("2024-01-01", maxsize=2)
+        plans = [[{"type": "WorkoutStep", "intensity": intensity}] for intensity in ("WARMUP", "ACTIVE", "COOLDOWN")]
+        for plan in (0, 1, 0, 2, 0, 1):
+            templates.records(_activity("a", plans[plan]))
+        #Plan 1 was evicted by plan 2, and then plan 2 by plan 1, while plan 0 stayed in use
+        self.assertEqual(templates.stats, {"hits": 2, "misses": 4, "evictions": 2})
+        self.assertEqual(len(templates), 2)
+        self.assertEqual(list(templates.records(_activity("a", []))), [])
+
+
+class TestCachedImport(unittest.TestCase):
+    def test_cache_counts_reach_the_report(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            write_corpus(data_dir, activities=12, waypoints=10, laps=2, step_plans=3)
+            outputs = {}
+            for name, options in (("uncached", {"streaming": True, "step_cache_size": 0}),
+                                  ("streaming", {"streaming": True, "step_cache_size": 16}),
+                                  ("async", {"asynchronous": True, "extract_workers": 0, "step_cache_size": 16}),
+                                  ("parallel", {"workers": 2, "step_cache_size": 16})):
+                with self.subTest(name), tempfile.TemporaryDirectory() as output_dir, \
+                        tempfile.TemporaryDirectory() as gcs_dir:
+                    importer = WorkoutImporter(data_directory=data_dir, storage_client=LocalStorageClient(gcs_dir),
+                                               report_path=f"{output_dir}/report.json", **options)
+                    importer.output_directory = output_dir
+                    importer.import_data()
+                    with open(f"{output_dir}/step_data.csv") as step_file:
+                        outputs[name] = step_file.read()
+                    with open(f"{output_dir}/report.json") as report_file:
+                        counters = json.load(report_file)["counters"]
+                    if name == "uncached":
+                        self.assertEqual(counters, {})
+                    elif name == "parallel":
+                        #Every worker process keeps its own cache
+                        step_templates = counters["step_templates"]
+                        self.assertEqual(step_templates["hits"] + step_templates["misses"], 12)
+                    else:
+                        self.assertEqual(counters["step_templates"], {"hits": 9, "misses": 3, "evictions": 0})
+            self.assertEqual(len(set(outputs.values())), 1)
+            self.assertIn("pace_average_s_per_km", outputs["streaming"].splitlines()[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import tempfile
+import unittest
+from datetime import date
+
+from summaries import ACTIVITY_SUMMARY, SummaryStore, summarize_activity
+from tables import ExtractionEngine
+
+
+ACTIVITY = {
+    "activityId": "activity1",
+    "userId": "user1",
+    "workoutId": "workout1",
+    "planDetails": {"id": "plan1"},
+    "weekOfPlan": 2,
+    "laps": [{"distance": 1000, "movingTime": 300000, "totalTime": 310000, "startTimestamp": 1707150113000},
+             {"distance": 200, "movingTime": 60000, "totalTime": 60000}],
+    "plannedWorkoutMetadata": {"stepsV2": [
+        {"type": "WorkoutStep", "targetType": None, "paces": None},
+        {"type": "WorkoutRepeatStep", "steps": [
+            {"type": "WorkoutStep", "targetType": "PACE", "paces": {"average": {"mps": 3.0}}},
+            {"type": "WorkoutStep", "targetType": "PACE", "paces": {"average": {"mps": 4.0}}},
+        ]},
+    ]},
+}
+
+
+def _summary(activity_id, user_id, week_of_plan, total_distance, speed, workout_id="workout1"):
+    return {"activity_id": activity_id, "user_id": user_id, "workout_id": workout_id, "plan_id": "plan1",
+            "week_of_plan": week_of_plan, "run_type": None, "lap_count": 1, "total_distance": total_distance,
+            "total_time": 1000, "moving_time": 1000, "start_timestamp": None, "average_speed_mps": speed,
+            "target_speed_mps": None, "speed_vs_target_mps": None}
+
+
+class TestSummaries(unittest.TestCase):
+    def test_summarize_activity(self):
+        summary = summarize_activity(ACTIVITY)
+        self.assertEqual(summary["total_distance"], 1200)
+        self.assertEqual(summary["total_time"], 370000)
+        self.assertAlmostEqual(summary["average_speed_mps"], 1200 / 360)
+        self.assertEqual(summary["target_speed_mps"], 3.5)
+        self.assertAlmostEqual(summary["speed_vs_target_mps"], 1200 / 360 - 3.5)
+        self.assertEqual(summary["start_timestamp"], 1707150113000)
+
+    def test_activity_summary_is_an_engine_table(self):
+        engine = ExtractionEngine("2024-01-01", specs=[ACTIVITY_SUMMARY])
+        row = next(engine.rows('activity_summary', ACTIVITY))
+        self.assertEqual(row["user_id"], "user1")
+        self.assertEqual(row["total_distance"], 1200.0)
+        self.assertEqual(row["processing_time"], date(2024, 1, 1))
+
+    def test_user_weeks_compare_with_previous_week(self):
+        store = SummaryStore()
+        for row in [_summary("a1", "user1", 1, 5000.0, 3.0), _summary("a2", "user1", 2, 4000.0, 3.1),
+                    _summary("a3", "user1", 2, 3000.0, 2.9), _summary("a4", "user2", 2, 6000.0, 3.5)]:
+            store.add(row)
+
+        weeks = store.user_weeks(date(2024, 1, 1))
+        self.assertEqual([(week["user_id"], week["week_of_plan"]) for week in weeks],
+                         [("user1", 1), ("user1", 2), ("user2", 2)])
+        self.assertEqual(weeks[1]["activities"], 2)
+        self.assertEqual(weeks[1]["distance_change"], 2000.0)
+        self.assertIsNone(weeks[2]["previous_week_distance"])
+
+    def test_leaderboard_ranks_by_speed(self):
+        store = SummaryStore()
+        for row in [_summary("a1", "user1", 1, 5000.0, 3.0), _summary("a2", "user2", 1, 5000.0, 3.4),
+                    _summary("a3", "user3", 1, 5000.0, None), _summary("a4", "user1", 1, 10.0, 9.0, None)]:
+            store.add(row)
+
+        board = store.leaderboard(date(2024, 1, 1))
+        self.assertEqual([(row["rank"], row["user_id"]) for row in board], [(1, "user2"), (2, "user1"), (3, "user3")])
+
+    def test_store_round_trip_replaces_redelivered_activities(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'summaries.json')
+            store = SummaryStore(path)
+            store.add(dict(_summary("a1", "user1", 1, 5000.0, 3.0), processing_time=date(2024, 1, 1)))
+            store.save()
+
+            store = SummaryStore(path)
+            store.add(_summary("a1", "user1", 1, 5500.0, 3.0))
+            self.assertEqual(store.user_weeks(date(2024, 1, 1))[0]["total_distance"], 5500.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
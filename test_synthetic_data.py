@@ -0,0 +1,45 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from synthetic_data import generate_activity, write_corpus
+from tables import ExtractionEngine
+
+
+def _repeat_depth(steps):
+    return max((1 + _repeat_depth(step["steps"]) for step in steps if step["type"] == "WorkoutRepeatStep"), default=0)
+
+
+class TestSyntheticData(unittest.TestCase):
+    def test_activities_are_deterministic(self):
+        self.assertEqual(generate_activity(3, waypoints=20, seed=1), generate_activity(3, waypoints=20, seed=1))
+        self.assertNotEqual(generate_activity(3, waypoints=20, seed=1), generate_activity(3, waypoints=20, seed=2))
+
+    def test_repeat_steps_nest_to_depth(self):
+        activity = generate_activity(0, waypoints=10, laps=2, repeat_depth=3)
+        self.assertEqual(_repeat_depth(activity["plannedWorkoutMetadata"]["stepsV2"]), 3)
+        #step_data flattens one level, so the nested repeat is a row of its own
+        steps = list(ExtractionEngine("2024-01-01").rows('step_data', activity))
+        self.assertEqual([step["step_type"] for step in steps],
+                         ["WorkoutStep"] * 3 + ["WorkoutRepeatStep", "WorkoutStep"])
+
+    def test_garmin_share(self):
+        types = {generate_activity(index, waypoints=1, laps=1, garmin_share=1.0)["recordType"] for index in range(10)}
+        self.assertEqual(types, {"GARMIN"})
+        types = {generate_activity(index, waypoints=1, laps=1, garmin_share=0.0)["recordType"] for index in range(10)}
+        self.assertEqual(types, {"PHONE"})
+
+    def test_corpus_draws_waypoint_counts_from_range(self):
+        with tempfile.TemporaryDirectory() as directory:
+            write_corpus(directory, activities=5, waypoints=(10, 30), laps=(1, 3))
+            counts = []
+            for path in sorted(Path(directory).iterdir()):
+                with open(path) as json_file:
+                    counts.append(len(json.load(json_file)["waypoints"]))
+            self.assertTrue(all(10 <= count <= 30 for count in counts))
+            self.assertGreater(len(set(counts)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import unittest
+from datetime import date
+from unittest.mock import patch
+from tables import TABLES, ExtractionEngine, coerce, field_names, pace_seconds, pace_text
+
+
+ACTIVITY = {
+    "activityId": "activity1",
+    "userId": "user1",
+    "planDetails": {"id": "plan1", "planLength": 4},
+    "workoutId": "workout1",
+    "recordType": "GARMIN",
+    "weekOfPlan": 1,
+    "unitOfMeasure": "metric",
+    "laps": [{"distance": 200, "wktStepIndex": 0}, {"distance": 400, "wktStepIndex": 1}],
+    "waypoints": [{"distance": 1, "heartRate": 120}, {"distance": 2, "type": "start"}],
+    "plannedWorkoutMetadata": {
+        "runType": "TEMPO",
+        "stepsV2": [
+            {"type": "WorkoutStep", "intensity": "WARMUP", "paces": None},
+            {"type": "WorkoutRepeatStep", "repeatValue": 8, "steps": [
+                {"type": "WorkoutStep", "intensity": "ACTIVE",
+                 "paces": {"average": {"text": "4:45", "mps": 3.5}}},
+                {"type": "WorkoutStep", "intensity": "RECOVERY", "paces": None},
+            ]},
+        ]
+    }
+}
+
+
+class ListSink(list):
+    def writerows(self, rows):
+        self.extend(rows)
+
+
+class RecordSink(list):
+    def writerecords(self, records):
+        self.extend(records)
+
+
+class TestExtractionEngine(unittest.TestCase):
+    def setUp(self):
+        self.engine = ExtractionEngine("2024-01-01")
+
+    def test_rows_follow_field_order(self):
+        for spec in TABLES:
+            for row in self.engine.rows(spec.name, ACTIVITY):
+                self.assertEqual(list(row), field_names(spec))
+
+    def test_activity_and_lap_rows(self):
+        activity = list(self.engine.rows('activity_data', ACTIVITY))
+        self.assertEqual(activity[0]["plan_id"], "plan1")
+        self.assertEqual(activity[0]["processing_time"], date(2024, 1, 1))
+
+        laps = list(self.engine.rows('lap_data', ACTIVITY))
+        self.assertEqual([lap["lap_order"] for lap in laps], [0, 1])
+        self.assertEqual(laps[1]["distance"], 400)
+        self.assertIsNone(laps[1]["average_cadence"])
+
+    def test_step_rows_flatten_repeat_steps(self):
+        steps = list(self.engine.rows('step_data', ACTIVITY))
+        self.assertEqual([step["lap_order"] for step in steps], [0, 1, 1])
+        self.assertEqual([step["repeat_value"] for step in steps], [None, 8, 8])
+        self.assertEqual(steps[1]["pace_average_text"], 4.45)
+        self.assertEqual(steps[1]["pace_average_mps"], 3.5)
+        self.assertIsNone(steps[2]["pace_slow_text"])
+
+    def test_run_visits_each_activity_once(self):
+        sinks = {spec.name: ListSink() for spec in TABLES}
+        visited = self.engine.run(iter([ACTIVITY, ACTIVITY]), sinks)
+
+        self.assertEqual(visited, 2)
+        self.assertEqual(len(sinks['activity_data']), 2)
+        self.assertEqual(len(sinks['waypoint_data']), 4)
+        self.assertEqual(len(sinks['workout_metadata']), 2)
+
+    def test_records_match_rows(self):
+        for spec in TABLES:
+            records = list(self.engine.records(spec.name, ACTIVITY))
+            self.assertEqual(records, [tuple(row.values()) for row in self.engine.rows(spec.name, ACTIVITY)])
+            self.assertTrue(all(type(record) is tuple for record in records))
+
+    def test_run_prefers_records_and_shares_constants(self):
+        sinks = {'waypoint_data': RecordSink(), 'lap_data': ListSink()}
+        self.engine.run([ACTIVITY, ACTIVITY], sinks)
+
+        self.assertEqual(len(sinks['waypoint_data']), 4)
+        self.assertIsInstance(sinks['lap_data'][0], dict)
+        self.assertEqual(self.engine.stats['waypoint_data']["rows_out"], 4)
+        processing_times = {id(record[-1]) for record in sinks['waypoint_data']}
+        self.assertEqual(len(processing_times), 1)
+
+    def test_failed_activity_writes_no_partial_rows(self):
+        broken = dict(ACTIVITY, activityId="broken", laps=[{"distance": 200}, {"startTimestamp": "yesterday"}])
+        sinks = {'lap_data': RecordSink(), 'activity_data': ListSink()}
+        with patch('builtins.print'):
+            self.engine.run([broken, ACTIVITY], sinks)
+
+        self.assertEqual([record[0] for record in sinks['lap_data']], ["activity1", "activity1"])
+        self.assertEqual(self.engine.stats['lap_data']["rows_out"], 2)
+        self.assertEqual(self.engine.stats['lap_data']["failures"], 1)
+        self.assertEqual([row["activity_id"] for row in sinks['activity_data']], ["activity1"])
+        self.assertEqual(self.engine.stats['activity_data']["failures"], 0)
+
+    def test_run_skips_tables_without_sink(self):
+        sinks = {'lap_data': ListSink()}
+        self.engine.run([ACTIVITY], sinks)
+        self.assertEqual(len(sinks['lap_data']), 2)
+
+    def test_values_are_coerced_to_column_types(self):
+        activity = dict(ACTIVITY, weekOfPlan="3", laps=[{"startTimestamp": "1723368932948", "distance": 200}])
+        row = next(self.engine.rows('activity_data', activity))
+        self.assertEqual(row["week_of_plan"], 3)
+        lap = next(self.engine.rows('lap_data', activity))
+        self.assertEqual(lap["start_timestamp"], 1723368932948)
+        self.assertIsInstance(lap["distance"], float)
+
+    def test_coerce(self):
+        self.assertIsNone(coerce('INTEGER', None))
+        self.assertEqual(coerce('DATE', "2024-02-05"), date(2024, 2, 5))
+        self.assertEqual(coerce('STRING', 10), "10")
+
+    def test_every_table_is_partitioned_and_clustered(self):
+        for spec in TABLES:
+            fields = {field.name: field for field in spec.fields}
+            self.assertEqual(fields[spec.partition_field].type, 'DATE')
+            self.assertEqual(fields['activity_id'].mode, 'REQUIRED')
+            self.assertEqual(spec.cluster_fields, ('activity_id',))
+
+    def test_pace_text(self):
+        self.assertEqual(pace_text("6:05"), "6.05")
+        self.assertIsNone(pace_text(None))
+
+    def test_pace_seconds(self):
+        self.assertEqual(pace_seconds("4:45"), 285)
+        self.assertEqual(pace_seconds("1:02:03"), 3723)
+        self.assertIsNone(pace_seconds(None))
+        self.assertEqual(pace_seconds("4:45.6"), 286)
+        self.assertEqual(pace_seconds(" 4: 45"), 285)
+        for malformed in ("4:4a", "", "4::45", "nan", 4.45):
+            with self.subTest(malformed):
+                self.assertIsNone(pace_seconds(malformed))
+        activity = dict(ACTIVITY, plannedWorkoutMetadata={"stepsV2": [{"type": "WorkoutStep", "paces": {
+            "slow": {"text": "5:1O"}, "average": {"text": "4:45.6"}, "fast": {"text": "4:15"}}}]})
+        step = next(self.engine.rows('step_data', activity))
+        self.assertEqual((step["pace_slow_s_per_km"], step["pace_average_s_per_km"], step["pace_fast_s_per_km"]),
+                         (None, 286, 255))
+        self.assertEqual((step["pace_slow_text"], step["pace_average_text"], step["pace_fast_text"]),
+                         (None, None, 4.15))
+        steps = list(self.engine.rows('step_data', ACTIVITY))
+        self.assertEqual(steps[1]["pace_average_s_per_km"], 285)
+        self.assertIsNone(steps[1]["pace_fast_s_per_km"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from local_gcs import LocalStorageClient
+from uploader import GcsUploader, bytes_per_second
+
+
+class TestGcsUploader(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.source = os.path.join(self.directory.name, 'lap_data.csv')
+        with open(self.source, 'w') as source_file:
+            source_file.write("activity_id,lap_order\nactivity1,0\n")
+
+    def test_uploads_to_local_fake_gcs(self):
+        client = LocalStorageClient(os.path.join(self.directory.name, 'gcs'))
+        with GcsUploader(client=client, max_workers=2) as uploader:
+            uploader.submit('runna', self.source, 'activity_data')
+            uploader.submit('runna', self.source, 'lap_data/run1.csv')
+            results = uploader.wait()
+
+        self.assertEqual([result.blob_name for result in results], ['activity_data', 'lap_data/run1.csv'])
+        self.assertEqual(results[0].bytes, os.path.getsize(self.source))
+        self.assertGreater(bytes_per_second(results[0]), 0)
+        blobs = client.bucket('runna').list_blobs()
+        self.assertEqual([blob.name for blob in blobs], ['activity_data', 'lap_data/run1.csv'])
+        self.assertEqual(blobs[0].download_as_text(), "activity_id,lap_order\nactivity1,0\n")
+
+    def test_shares_one_client_and_bucket(self):
+        client = MagicMock()
+        with GcsUploader(client=client) as uploader:
+            for name in ('activity_data', 'lap_data', 'step_data'):
+                uploader.submit('runna', self.source, name)
+        client.bucket.assert_called_once_with('runna')
+
+    def test_large_files_use_chunked_transfer(self):
+        client = MagicMock()
+        with GcsUploader(client=client, chunk_size=256 * 1024, resumable_threshold=10) as uploader:
+            uploader.submit('runna', self.source, 'waypoint_data')
+        client.bucket.return_value.blob.assert_called_once_with('waypoint_data', chunk_size=256 * 1024)
+
+    def test_retries_with_exponential_backoff(self):
+        client = MagicMock()
+        blob = client.bucket.return_value.blob.return_value
+        blob.upload_from_filename.side_effect = [ConnectionError("reset"), ConnectionError("reset"), None]
+        delays = []
+        with GcsUploader(client=client, retries=3, backoff=0.5, sleep=delays.append) as uploader:
+            uploader.submit('runna', self.source, 'lap_data')
+            results = uploader.wait()
+
+        self.assertEqual(delays, [0.5, 1.0])
+        self.assertEqual(results[0].attempts, 3)
+
+    def test_raises_after_retries_are_exhausted(self):
+        client = MagicMock()
+        client.bucket.return_value.blob.return_value.upload_from_filename.side_effect = ConnectionError("down")
+        uploader = GcsUploader(client=client, retries=1, sleep=lambda delay: None)
+        uploader.submit('runna', self.source, 'lap_data')
+        with self.assertRaises(ConnectionError):
+            uploader.wait()
+
+
+if __name__ == '__main__':
+    unittest.main()
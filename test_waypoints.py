@@ -0,0 +1,75 @@
+import csv
+import os
+import tempfile
+import unittest
+
+from tables import WAYPOINT_DATA, ExtractionEngine
+from waypoints import WaypointArrays, np
+from writers import CsvTableWriter, ParquetTableWriter, pa
+
+if pa is not None:
+    import pyarrow.parquet as pq
+
+
+ACTIVITY = {
+    "activityId": "activity2",
+    "waypoints": [
+        {"timestamp": 1723368932948, "movingTime": 0, "distance": 0, "speed": 1.53, "stepIndex": 0,
+         "lapIndex": 0, "accuracy": 4.8, "type": "start"},
+        {"timestamp": 1723368933966, "movingTime": 99, "distance": 2.23, "speed": 22.5, "power": None},
+        {"cadence": 177, "timestamp": 1723368934966, "heartRate": 150, "power": 210, "strideLength": 1.1},
+    ]
+}
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestWaypointArrays(unittest.TestCase):
+    def setUp(self):
+        self.batch = WaypointArrays("2024-11-04").build(ACTIVITY)
+
+    def test_typed_columns_with_missing_values(self):
+        self.assertEqual(len(self.batch), 3)
+        self.assertEqual(self.batch.values["timestamp"].dtype, np.int64)
+        self.assertTrue(np.isnan(self.batch.values["cadence"][0]))
+        self.assertEqual(self.batch.mask("step_index").tolist(), [False, True, True])
+        self.assertEqual(self.batch.column("step_index"), [0, None, None])
+        self.assertEqual(self.batch.column("power"), [None, None, 210.0])
+        self.assertEqual(self.batch.column("type"), ["start", None, None])
+        self.assertEqual(self.batch.column("activity_id"), ["activity2"] * 3)
+
+    def test_rows_match_dict_path(self):
+        expected = list(ExtractionEngine("2024-11-04").rows('waypoint_data', ACTIVITY))
+        self.assertEqual(list(self.batch.rows()), expected)
+
+    def test_empty_activity(self):
+        batch = WaypointArrays("2024-11-04").build({"activityId": "activity3"})
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(list(batch.rows()), [])
+
+    def test_csv_write_columns(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'waypoint_data.csv')
+            writer = CsvTableWriter(path, WAYPOINT_DATA)
+            writer.write_columns(self.batch)
+            writer.close()
+            with open(path) as csv_file:
+                rows = list(csv.DictReader(csv_file))
+        self.assertEqual([row["step_index"] for row in rows], ["0", "", ""])
+        self.assertEqual(rows[2]["heart_rate"], "150.0")
+
+    @unittest.skipIf(pa is None, "pyarrow is not installed")
+    def test_parquet_write_columns_matches_rows(self):
+        with tempfile.TemporaryDirectory() as directory:
+            tables = []
+            for name, write in [("rows", lambda writer: writer.writerows(self.batch.rows())),
+                                ("columns", lambda writer: writer.write_columns(self.batch))]:
+                path = os.path.join(directory, f'{name}.parquet')
+                writer = ParquetTableWriter(path, WAYPOINT_DATA)
+                write(writer)
+                writer.close()
+                tables.append(pq.read_table(path))
+        self.assertTrue(tables[0].equals(tables[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,8 +3,15 @@ from unittest.mock import patch, mock_open, MagicMock
 from pathlib import Path
 import json
 import csv
+import gzip
+import os
+import tempfile
 from datetime import date
+from local_gcs import LocalStorageClient
+from synthetic_data import write_corpus
+import workout_importer
 from workout_importer import WorkoutImporter 
+from writers import pa
 
 class TestWorkoutImporter(unittest.TestCase):
     def setUp(self):
@@ -169,54 +176,318 @@ class TestWorkoutImporter(unittest.TestCase):
         self.assertEqual(self.importer.combined_data, expected_data)
         mock_open.assert_called_once_with(mock_json_file, 'r')
 
-    @patch('builtins.open', new_callable=mock_open)
-    @patch('csv.DictWriter')
-    def test_to_csv(self, mock_dict_writer, mock_open):
-        mock_writer_instance = mock_dict_writer.return_value
-        field_names = ["field1", "field2"]
-        rows = [{"field1": "value1", "field2": "value2"}]
-
-        self.importer.to_csv('dummy.csv', field_names, rows)
-
-        mock_open.assert_called_with('dummy.csv', 'w', newline='', encoding='utf-8')
-        mock_dict_writer.assert_called_once_with(mock_open(), fieldnames=field_names)
-        mock_writer_instance.writeheader.assert_called_once()
-        mock_writer_instance.writerows.assert_called_once_with(rows)
-
-    @patch('workout_importer.WorkoutImporter.to_csv')
-    @patch('workout_importer.WorkoutImporter.upload_to_gcs')  
-    def test_process_activity_data(self, mock_upload_to_gcs, mock_to_csv):
-        self.importer.process_activity_data()
-        mock_to_csv.assert_called_once()
-        mock_upload_to_gcs.assert_called_once_with(self.importer.bucket_name, './processed_data/activity_data.csv', 'activity_data')
-
-    @patch('workout_importer.WorkoutImporter.to_csv')
-    @patch('workout_importer.WorkoutImporter.upload_to_gcs')  
-    def test_process_lap_data(self, mock_upload_to_gcs, mock_to_csv):
-        self.importer.process_lap_data()
-        mock_to_csv.assert_called_once()
-        mock_upload_to_gcs.assert_called_once_with(self.importer.bucket_name, './processed_data/lap_data.csv', 'lap_data')
-
-    @patch('workout_importer.WorkoutImporter.to_csv')
-    @patch('workout_importer.WorkoutImporter.upload_to_gcs')  
-    def test_process_waypoint_data(self, mock_upload_to_gcs, mock_to_csv):
-        self.importer.process_waypoint_data()
-        mock_to_csv.assert_called_once()
-        mock_upload_to_gcs.assert_called_once_with(self.importer.bucket_name, './processed_data/waypoint_data.csv', 'waypoint_data')
-
-    @patch('workout_importer.WorkoutImporter.to_csv')
-    @patch('workout_importer.WorkoutImporter.upload_to_gcs')  
-    def test_process_metadata_data(self, mock_upload_to_gcs, mock_to_csv):
-        self.importer.process_metadata_data()
-        mock_to_csv.assert_called_once()
-        mock_upload_to_gcs.assert_called_once_with(self.importer.bucket_name, './processed_data/workout_metadata.csv', 'workout_metadata')
-
-    @patch('workout_importer.WorkoutImporter.to_csv')
-    @patch('workout_importer.WorkoutImporter.upload_to_gcs')  
-    def test_process_step_data(self, mock_upload_to_gcs, mock_to_csv):
-        self.importer.process_step_data()
-        mock_to_csv.assert_called_once()
-        mock_upload_to_gcs.assert_called_once_with(self.importer.bucket_name, './processed_data/step_data.csv', 'step_data')
+    @patch('workout_importer.WorkoutImporter.upload_to_gcs')
+    def test_write_tables(self, mock_upload_to_gcs):
+        with tempfile.TemporaryDirectory() as output_dir:
+            self.importer.output_directory = output_dir
+            self.importer.write_tables(self.importer.combined_data)
+            for table_name in ('activity_data', 'lap_data', 'waypoint_data', 'workout_metadata', 'step_data'):
+                with self.subTest(table_name):
+                    with open(f"{output_dir}/{table_name}.csv") as csv_file:
+                        rows = list(csv.DictReader(csv_file))
+                    self.assertEqual([row["activity_id"] for row in rows], ["activity1"])
+                    mock_upload_to_gcs.assert_any_call(self.importer.bucket_name, f"{output_dir}/{table_name}.csv",
+                                                       table_name)
+
+    @patch('workout_importer.WorkoutImporter.upload_to_gcs')
+    def test_streaming_matches_batch_output(self, mock_upload_to_gcs):
+        with tempfile.TemporaryDirectory() as batch_dir, tempfile.TemporaryDirectory() as stream_dir:
+            batch = WorkoutImporter(data_directory='./data')
+            batch.output_directory = batch_dir
+            batch.import_data()
+
+            streaming = WorkoutImporter(data_directory='./data', streaming=True)
+            streaming.output_directory = stream_dir
+            self.assertEqual(streaming.combined_data, [])
+            streaming.import_data()
+
+            for spec in streaming.tables():
+                with open(f"{batch_dir}/{spec.name}.csv") as expected, open(f"{stream_dir}/{spec.name}.csv") as actual:
+                    self.assertEqual(actual.read(), expected.read())
+            self.assertEqual(mock_upload_to_gcs.call_count, 10)
+    @patch('workout_importer.WorkoutImporter.upload_to_gcs')
+    def test_parallel_matches_serial_output(self, mock_upload_to_gcs):
+        with tempfile.TemporaryDirectory() as data_dir, tempfile.TemporaryDirectory() as serial_dir, \
+                tempfile.TemporaryDirectory() as parallel_dir:
+            write_corpus(data_dir, activities=9, waypoints=50, laps=3)
+
+            serial = WorkoutImporter(data_directory=data_dir, streaming=True)
+            serial.output_directory = serial_dir
+            serial.import_data()
+
+            parallel = WorkoutImporter(data_directory=data_dir, workers=2)
+            parallel.output_directory = parallel_dir
+            self.assertEqual(parallel.combined_data, [])
+            parallel.import_data()
+
+            for spec in parallel.tables():
+                with open(f"{serial_dir}/{spec.name}.csv") as expected, open(f"{parallel_dir}/{spec.name}.csv") as actual:
+                    self.assertEqual(actual.read(), expected.read())
+    @unittest.skipIf(pa is None, "pyarrow is not installed")
+    @patch('workout_importer.WorkoutImporter.upload_to_gcs')
+    def test_parquet_output(self, mock_upload_to_gcs):
+        import pyarrow.parquet as pq
+        with tempfile.TemporaryDirectory() as output_dir:
+            importer = WorkoutImporter(data_directory='./data', output_format='parquet')
+            importer.output_directory = output_dir
+            importer.import_data()
+
+            waypoints = pq.read_table(f"{output_dir}/waypoint_data.parquet")
+            self.assertEqual(waypoints.num_rows, 2063 + 648)
+            mock_upload_to_gcs.assert_any_call(importer.bucket_name, f"{output_dir}/waypoint_data.parquet",
+                                               'waypoint_data.parquet')
+    @patch('workout_importer.WorkoutImporter.upload_to_gcs')
+    def test_incremental_only_imports_new_or_changed_files(self, mock_upload_to_gcs):
+        with tempfile.TemporaryDirectory() as data_dir, tempfile.TemporaryDirectory() as output_dir:
+            write_corpus(data_dir, activities=3, waypoints=10, laps=2)
+
+            importer = WorkoutImporter(data_directory=data_dir, incremental=True)
+            importer.output_directory = output_dir
+            first_run = importer.import_data()
+            with open(f"{output_dir}/activity_data-{first_run}.csv") as csv_file:
+                self.assertEqual(len(list(csv.DictReader(csv_file))), 3)
+            mock_upload_to_gcs.assert_any_call(importer.bucket_name, f"{output_dir}/lap_data-{first_run}.csv",
+                                               f"lap_data/{first_run}.csv")
+
+            self.assertIsNone(importer.import_data())
+
+            #Add a new activity, and re-deliver one with new content
+            write_corpus(data_dir, activities=4, waypoints=10, laps=2)
+            with open(f"{data_dir}/activity-000001.json") as json_file:
+                activity = json.load(json_file)
+            activity['weekOfPlan'] += 1
+            with open(f"{data_dir}/activity-000001.json", 'w') as json_file:
+                json.dump(activity, json_file)
+
+            second_run = importer.import_data()
+            with open(f"{output_dir}/activity_data-{second_run}.csv") as csv_file:
+                self.assertEqual([row["activity_id"] for row in csv.DictReader(csv_file)],
+                                 ["activity-1", "activity-3"])
+            with open(f"{output_dir}/run-{second_run}.json") as run_file:
+                self.assertEqual(json.load(run_file)["redelivered_activity_ids"], ["activity-1"])
+
+    @patch('workout_importer.WorkoutImporter.upload_to_gcs')
+    def test_incremental_retries_files_that_failed(self, mock_upload_to_gcs):
+        with tempfile.TemporaryDirectory() as data_dir, tempfile.TemporaryDirectory() as output_dir:
+            write_corpus(data_dir, activities=3, waypoints=10, laps=2)
+            broken_path = f"{data_dir}/activity-000001.json"
+            with open(broken_path) as json_file:
+                activity = json.load(json_file)
+            with open(broken_path, 'w') as json_file:
+                json.dump(dict(activity, laps=[{"startTimestamp": "yesterday"}]), json_file)
+
+            importer = WorkoutImporter(data_directory=data_dir, incremental=True)
+            importer.output_directory = output_dir
+            with patch('builtins.print'):
+                first_run = importer.import_data()
+            with open(f"{output_dir}/activity_data-{first_run}.csv") as csv_file:
+                self.assertEqual([row["activity_id"] for row in csv.DictReader(csv_file)], ["activity-0", "activity-2"])
+            with open(f"{output_dir}/manifest.json") as manifest_file:
+                self.assertNotIn(broken_path, json.load(manifest_file))
+
+            with open(broken_path, 'w') as json_file:
+                json.dump(activity, json_file)
+            retry_run = importer.import_data()
+            with open(f"{output_dir}/lap_data-{retry_run}.csv") as csv_file:
+                self.assertEqual({row["activity_id"] for row in csv.DictReader(csv_file)}, {"activity-1"})
+            with open(f"{output_dir}/run-{retry_run}.json") as run_file:
+                self.assertEqual(json.load(run_file)["redelivered_activity_ids"], [])
+            self.assertIsNone(importer.import_data())
+
+            #A broken re-delivery leaves the rows already loaded in place
+            with open(broken_path, 'w') as json_file:
+                json.dump(dict(activity, laps=[{"startTimestamp": "yesterday"}]), json_file)
+            with patch('builtins.print'):
+                broken_run = importer.import_data()
+            with open(f"{output_dir}/activity_data-{broken_run}.csv") as csv_file:
+                self.assertEqual(list(csv.DictReader(csv_file)), [])
+            with open(f"{output_dir}/run-{broken_run}.json") as run_file:
+                self.assertEqual(json.load(run_file)["redelivered_activity_ids"], [])
+            with patch('builtins.print'):
+                self.assertIsNotNone(importer.import_data())
+
+    def test_incremental_refuses_workers_and_async(self):
+        for options in ({"workers": 2}, {"asynchronous": True}):
+            with self.subTest(**options), self.assertRaises(ValueError):
+                WorkoutImporter(data_directory='./data', incremental=True, **options)
+
+    @patch('workout_importer.WorkoutImporter.upload_to_gcs')
+    def test_main_incremental_flag(self, mock_upload_to_gcs):
+        with tempfile.TemporaryDirectory() as data_dir, tempfile.TemporaryDirectory() as output_dir:
+            write_corpus(data_dir, activities=2, waypoints=10, laps=2)
+            argv = ['--incremental', '--data-directory', data_dir, '--output-directory', output_dir]
+            workout_importer.main(argv)
+            self.assertTrue(os.path.exists(f"{output_dir}/manifest.json"))
+            runs = [name for name in os.listdir(output_dir) if name.startswith('run-')]
+            self.assertEqual(len(runs), 1)
+            workout_importer.main(argv)
+            self.assertEqual([name for name in os.listdir(output_dir) if name.startswith('run-')], runs)
+
+    @unittest.skipIf(pa is None, "pyarrow is not installed")
+    @patch('workout_importer.WorkoutImporter.upload_to_gcs')
+    def test_vectorized_waypoints_match_row_path(self, mock_upload_to_gcs):
+        import pyarrow.parquet as pq
+        with tempfile.TemporaryDirectory() as row_dir, tempfile.TemporaryDirectory() as vector_dir:
+            for output_dir, vectorized in [(row_dir, False), (vector_dir, True)]:
+                importer = WorkoutImporter(data_directory='./data', output_format='parquet', vectorized=vectorized)
+                importer.output_directory = output_dir
+                importer.import_data()
+
+            expected = pq.read_table(f"{row_dir}/waypoint_data.parquet")
+            self.assertTrue(pq.read_table(f"{vector_dir}/waypoint_data.parquet").equals(expected))
+    def test_uploads_every_table_through_shared_uploader(self):
+        with tempfile.TemporaryDirectory() as output_dir, tempfile.TemporaryDirectory() as gcs_dir:
+            importer = WorkoutImporter(data_directory='./data', storage_client=LocalStorageClient(gcs_dir))
+            importer.output_directory = output_dir
+            importer.import_data()
+
+            blobs = importer.uploader.client.bucket(importer.bucket_name).list_blobs()
+            self.assertEqual(sorted(blob.name for blob in blobs), sorted(spec.name for spec in importer.tables()))
+            self.assertEqual(len(importer.uploader.results), 5)
+    @patch('workout_importer.WorkoutImporter.upload_to_gcs')
+    def test_decoders_match_stdlib_output(self, mock_upload_to_gcs):
+        with tempfile.TemporaryDirectory() as stdlib_dir, tempfile.TemporaryDirectory() as fast_dir:
+            stdlib = WorkoutImporter(data_directory='./data', streaming=True, decoder='json')
+            stdlib.output_directory = stdlib_dir
+            stdlib.import_data()
+
+            fast = WorkoutImporter(data_directory='./data', streaming=True, decoder='auto', project=True)
+            fast.output_directory = fast_dir
+            fast.import_data()
+
+            for spec in fast.tables():
+                with open(f"{stdlib_dir}/{spec.name}.csv") as expected, open(f"{fast_dir}/{spec.name}.csv") as actual:
+                    self.assertEqual(actual.read(), expected.read())
+    @patch('workout_importer.WorkoutImporter.upload_to_gcs')
+    def test_sharded_run_matches_unsharded_rows(self, mock_upload_to_gcs):
+        with tempfile.TemporaryDirectory() as single_dir, tempfile.TemporaryDirectory() as shard_dir:
+            single = WorkoutImporter(data_directory='./data', streaming=True)
+            single.output_directory = single_dir
+            single.import_data()
+
+            sharded = WorkoutImporter(data_directory='./data', streaming=True, shard_rows=1000, compression='gzip')
+            sharded.output_directory = shard_dir
+            run_id = sharded.import_data()
+
+            shards = sorted(Path(shard_dir, 'waypoint_data').iterdir())
+            self.assertEqual([shard.name for shard in shards], [f"{run_id}-{index:05d}.csv.gz" for index in range(3)])
+            rows = []
+            for shard in shards:
+                with gzip.open(shard, 'rt') as csv_file:
+                    rows.extend(csv.DictReader(csv_file))
+            with open(f"{single_dir}/waypoint_data.csv") as csv_file:
+                self.assertEqual(rows, list(csv.DictReader(csv_file)))
+            mock_upload_to_gcs.assert_any_call(sharded.bucket_name, str(shards[0]),
+                                               f"waypoint_data/{run_id}-00000.csv.gz")
+            with open(f"{shard_dir}/run-{run_id}.json") as run_file:
+                self.assertEqual(json.load(run_file)["mode"], "full")
+    @patch('workout_importer.WorkoutImporter.upload_to_gcs')
+    def test_summaries_are_updated_incrementally(self, mock_upload_to_gcs):
+        with tempfile.TemporaryDirectory() as data_dir, tempfile.TemporaryDirectory() as output_dir:
+            write_corpus(data_dir, activities=2, waypoints=10, laps=2)
+            importer = WorkoutImporter(data_directory=data_dir, incremental=True, summaries=True)
+            importer.output_directory = output_dir
+            first_run = importer.import_data()
+
+            write_corpus(data_dir, activities=3, waypoints=10, laps=2)
+            second_run = importer.import_data()
+
+            with open(f"{output_dir}/activity_summary-{second_run}.csv") as csv_file:
+                self.assertEqual([row["activity_id"] for row in csv.DictReader(csv_file)], ["activity-2"])
+            with open(f"{output_dir}/workout_leaderboard-{second_run}.csv") as csv_file:
+                self.assertEqual(sorted(row["activity_id"] for row in csv.DictReader(csv_file)),
+                                 ["activity-0", "activity-1", "activity-2"])
+            mock_upload_to_gcs.assert_any_call(importer.bucket_name, f"{output_dir}/user_week_summary-{first_run}.csv",
+                                               f"user_week_summary/{first_run}.csv")
+    @patch('workout_importer.WorkoutImporter.upload_to_gcs')
+    def test_downsampled_waypoints_and_buckets(self, mock_upload_to_gcs):
+        with tempfile.TemporaryDirectory() as serial_dir, tempfile.TemporaryDirectory() as parallel_dir:
+            serial = WorkoutImporter(data_directory='./data', streaming=True, downsample='time:5')
+            serial.output_directory = serial_dir
+            serial.import_data()
+            parallel = WorkoutImporter(data_directory='./data', workers=2, downsample='time:5')
+            parallel.output_directory = parallel_dir
+            parallel.import_data()
+
+            for table in ('waypoint_data', 'waypoint_buckets'):
+                with open(f"{serial_dir}/{table}.csv") as serial_file, open(f"{parallel_dir}/{table}.csv") as parallel_file:
+                    self.assertEqual(serial_file.read(), parallel_file.read())
+            with open(f"{serial_dir}/waypoint_buckets.csv") as csv_file:
+                buckets = list(csv.DictReader(csv_file))
+            with open(f"{serial_dir}/waypoint_data.csv") as csv_file:
+                self.assertEqual(len(list(csv.DictReader(csv_file))), len(buckets))
+            self.assertEqual(sum(int(bucket["point_count"]) for bucket in buckets), 2063 + 648)
+            for importer in (serial, parallel):
+                downsample = importer.metrics.tables[('downsample', 'waypoint_data')]
+                self.assertEqual(downsample["rows_in"], 2063 + 648)
+                self.assertEqual(downsample["rows_out"], len(buckets))
+
+    @patch('workout_importer.WorkoutImporter.upload_to_gcs')
+    def test_run_report(self, mock_upload_to_gcs):
+        with tempfile.TemporaryDirectory() as output_dir:
+            report_path = f"{output_dir}/report.json"
+            importer = WorkoutImporter(data_directory='./data', streaming=True, report_path=report_path)
+            importer.output_directory = output_dir
+            importer.import_data()
+
+            with open(report_path) as report_file:
+                report = json.load(report_file)
+            extract = next(stage for stage in report["stages"] if stage["stage"] == 'extract')
+            self.assertEqual(extract["rows_in"], 2)
+            tables = {record["table"]: record for record in report["tables"] if record["stage"] == 'extract'}
+            self.assertEqual(tables["waypoint_data"]["rows_out"], 2063 + 648)
+            self.assertEqual(tables["lap_data"]["bytes_written"], os.path.getsize(f"{output_dir}/lap_data.csv"))
+            self.assertEqual(report["failures"], 0)
+
+    def test_failed_activity_is_counted_once(self):
+        with tempfile.TemporaryDirectory() as data_dir, tempfile.TemporaryDirectory() as output_dir, \
+                tempfile.TemporaryDirectory() as gcs_dir:
+            write_corpus(data_dir, activities=4, waypoints=5, laps=2)
+            with open(f"{data_dir}/activity-000002.json") as json_file:
+                activity = json.load(json_file)
+            activity["laps"][0]["startTimestamp"] = "yesterday"
+            with open(f"{data_dir}/activity-000002.json", 'w') as json_file:
+                json.dump(activity, json_file)
+
+            for options in ({"streaming": True}, {"workers": 2}):
+                with self.subTest(**options):
+                    report_path = f"{output_dir}/report.json"
+                    importer = WorkoutImporter(data_directory=data_dir, report_path=report_path,
+                                               storage_client=LocalStorageClient(gcs_dir), **options)
+                    importer.output_directory = output_dir
+                    importer.import_data()
+                    with open(report_path) as report_file:
+                        report = json.load(report_file)
+                    self.assertEqual(report["failures"], 1)
+                    failed = [record["table"] for record in report["tables"] if record["failures"]]
+                    self.assertEqual(failed, ["lap_data"])
+
+    def test_activity_that_fails_to_downsample_is_skipped(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            write_corpus(data_dir, activities=3, waypoints=20, laps=2)
+            with open(f"{data_dir}/activity-000001.json") as json_file:
+                activity = json.load(json_file)
+            activity["laps"][0]["startTimestamp"] = "yesterday"
+            with open(f"{data_dir}/activity-000001.json", 'w') as json_file:
+                json.dump(activity, json_file)
+
+            for options in ({"streaming": True}, {"workers": 2}, {"asynchronous": True, "extract_workers": 0}):
+                with self.subTest(**options), tempfile.TemporaryDirectory() as output_dir, \
+                        tempfile.TemporaryDirectory() as gcs_dir:
+                    importer = WorkoutImporter(data_directory=data_dir, downsample='time:5',
+                                               report_path=f"{output_dir}/report.json",
+                                               storage_client=LocalStorageClient(gcs_dir), **options)
+                    importer.output_directory = output_dir
+                    with patch('builtins.print'):
+                        importer.import_data()
+                    with open(f"{output_dir}/waypoint_buckets.csv") as csv_file:
+                        self.assertEqual({row["activity_id"] for row in csv.DictReader(csv_file)},
+                                         {"activity-0", "activity-2"})
+                    with open(f"{output_dir}/report.json") as report_file:
+                        report = json.load(report_file)
+                    self.assertEqual(report["failures"], 1)
+                    self.assertEqual([record["table"] for record in report["tables"] if record["failures"]],
+                                     ["waypoint_buckets"])
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
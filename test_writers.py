@@ -0,0 +1,204 @@
+import csv
+import gzip
+import os
+import tempfile
+import unittest
+from datetime import date
+
+from tables import LAP_DATA, WAYPOINT_DATA, field_names
+from writers import CsvTableWriter, ParquetTableWriter, ShardedWriter, get_writer, pa
+
+if pa is not None:
+    import pyarrow.parquet as pq
+
+
+LAP_ROWS = [
+    {"activity_id": "activity1", "lap_order": 0, "average_cadence": 177.0, "average_heart_rate": 143.5,
+     "average_speed": 2.772, "distance": 2000.0, "elevation_gain": 9.0, "max_cadence": 190.0,
+     "max_elevation": 64.4, "min_elevation": 60.2, "max_heart_rate": 155.0, "min_heart_rate": 136.0,
+     "max_speed": 3.088, "moving_time": 721401, "start_timestamp": 1707150113000,
+     "total_time": 721401, "wkt_step_index": 0, "processing_time": date(2024, 11, 4)},
+    {"activity_id": "activity1", "lap_order": 1, "average_cadence": None, "average_heart_rate": None,
+     "average_speed": None, "distance": 200.0, "elevation_gain": None, "max_cadence": None,
+     "max_elevation": None, "min_elevation": None, "max_heart_rate": None, "min_heart_rate": None,
+     "max_speed": None, "moving_time": None, "start_timestamp": 1707150835000,
+     "total_time": None, "wkt_step_index": 1, "processing_time": date(2024, 11, 4)},
+]
+
+
+class TestCsvTableWriter(unittest.TestCase):
+    def test_writes_header_and_rows(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'lap_data.csv')
+            writer = CsvTableWriter(path, LAP_DATA)
+            writer.writerows(LAP_ROWS)
+            writer.close()
+
+            with open(path) as csv_file:
+                rows = list(csv.DictReader(csv_file))
+            self.assertEqual(list(rows[0]), field_names(LAP_DATA))
+            self.assertEqual(rows[1]["distance"], "200.0")
+
+    def test_records_write_the_same_csv_as_rows(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name, write in (('rows', lambda writer: writer.writerows(LAP_ROWS)),
+                                ('records', lambda writer: writer.writerecords(tuple(row.values()) for row in LAP_ROWS))):
+                writer = CsvTableWriter(os.path.join(directory, f'{name}.csv'), LAP_DATA)
+                write(writer)
+                writer.close()
+
+            with open(os.path.join(directory, 'rows.csv')) as rows, open(os.path.join(directory, 'records.csv')) as records:
+                self.assertEqual(records.read(), rows.read())
+
+    def test_merge_keeps_part_order(self):
+        with tempfile.TemporaryDirectory() as directory:
+            parts = []
+            for index, row in enumerate(LAP_ROWS):
+                part = os.path.join(directory, f'part-{index}.csv')
+                writer = CsvTableWriter(part, LAP_DATA, header=False)
+                writer.writerows([row])
+                writer.close()
+                parts.append(part)
+
+            path = os.path.join(directory, 'lap_data.csv')
+            CsvTableWriter.merge(parts, path, LAP_DATA)
+            with open(path) as csv_file:
+                rows = list(csv.DictReader(csv_file))
+            self.assertEqual([row["lap_order"] for row in rows], ["0", "1"])
+
+
+class TestShardedWriter(unittest.TestCase):
+    def test_rolls_over_at_max_rows(self):
+        with tempfile.TemporaryDirectory() as directory:
+            closed = []
+            writer = ShardedWriter(os.path.join(directory, 'lap_data'), 'run1', LAP_DATA, max_rows=3,
+                                   on_close=closed.append)
+            writer.writerows(dict(LAP_ROWS[0], lap_order=index) for index in range(4))
+            writer.writerows(iter([]))
+            writer.writerows(dict(LAP_ROWS[0], lap_order=index) for index in range(4, 7))
+            writer.close()
+
+            self.assertEqual([os.path.basename(path) for path in closed],
+                             ['run1-00000.csv', 'run1-00001.csv', 'run1-00002.csv'])
+            shards = []
+            for path in closed:
+                with open(path) as csv_file:
+                    shards.append([row["lap_order"] for row in csv.DictReader(csv_file)])
+            self.assertEqual(shards, [["0", "1", "2"], ["3", "4", "5"], ["6"]])
+
+    def test_records_roll_over_like_rows(self):
+        with tempfile.TemporaryDirectory() as directory:
+            writer = ShardedWriter(directory, 'run1', LAP_DATA, max_rows=2)
+            writer.writerecords(tuple(dict(LAP_ROWS[0], lap_order=index).values()) for index in range(5))
+            writer.close()
+
+            shards = []
+            for path in writer.paths:
+                with open(path) as csv_file:
+                    shards.append([row["lap_order"] for row in csv.DictReader(csv_file)])
+            self.assertEqual(shards, [["0", "1"], ["2", "3"], ["4"]])
+
+    def test_rolls_over_at_max_bytes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            #Sizes are checked between writes, once the file buffer has reached the disk
+            writer = ShardedWriter(directory, 'run1', LAP_DATA, max_bytes=1)
+            writer.writerows([LAP_ROWS[0]] * 200)
+            writer.writerows(LAP_ROWS[1:])
+            writer.close()
+
+            self.assertEqual([os.path.basename(path) for path in writer.paths], ['run1-00000.csv', 'run1-00001.csv'])
+            with open(writer.paths[1]) as csv_file:
+                self.assertEqual([row["lap_order"] for row in csv.DictReader(csv_file)], ["1"])
+
+    def test_gzipped_shards(self):
+        with tempfile.TemporaryDirectory() as directory:
+            writer = ShardedWriter(directory, 'run1', LAP_DATA, max_rows=1, compression='gzip')
+            writer.writerows(LAP_ROWS)
+            writer.close()
+
+            self.assertEqual([os.path.basename(path) for path in writer.paths], ['run1-00000.csv.gz', 'run1-00001.csv.gz'])
+            with gzip.open(writer.paths[1], 'rt') as csv_file:
+                self.assertEqual([row["lap_order"] for row in csv.DictReader(csv_file)], ["1"])
+
+    def test_empty_table_gets_one_shard(self):
+        with tempfile.TemporaryDirectory() as directory:
+            writer = ShardedWriter(directory, 'run1', LAP_DATA, max_rows=10)
+            writer.close()
+            with open(writer.paths[0]) as csv_file:
+                self.assertEqual(list(csv.DictReader(csv_file)), [])
+
+
+class TestCsvCompression(unittest.TestCase):
+    def test_merged_gzip_parts_stay_one_csv(self):
+        with tempfile.TemporaryDirectory() as directory:
+            parts = []
+            for index, row in enumerate(LAP_ROWS):
+                part = os.path.join(directory, f'part-{index}.csv.gz')
+                writer = CsvTableWriter(part, LAP_DATA, header=False, compression='gzip')
+                writer.writerows([row])
+                writer.close()
+                parts.append(part)
+
+            path = os.path.join(directory, 'lap_data.csv.gz')
+            CsvTableWriter.merge(parts, path, LAP_DATA, compression='gzip')
+            with gzip.open(path, 'rt') as csv_file:
+                self.assertEqual([row["lap_order"] for row in csv.DictReader(csv_file)], ["0", "1"])
+
+    def test_only_gzip_is_offered_for_csv(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with self.assertRaises(ValueError):
+                CsvTableWriter(os.path.join(directory, 'lap_data.csv'), LAP_DATA, compression='zstd')
+
+
+@unittest.skipIf(pa is None, "pyarrow is not installed")
+class TestParquetTableWriter(unittest.TestCase):
+    def test_writes_typed_columns(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'lap_data.parquet')
+            writer = ParquetTableWriter(path, LAP_DATA)
+            writer.writerows(LAP_ROWS)
+            writer.close()
+
+            table = pq.read_table(path)
+            self.assertEqual(table.schema.field("start_timestamp").type, pa.int64())
+            self.assertEqual(table.schema.field("distance").type, pa.float64())
+            self.assertEqual(table.column("start_timestamp").to_pylist(), [1707150113000, 1707150835000])
+            self.assertEqual(table.column("processing_time").to_pylist(), [date(2024, 11, 4)] * 2)
+            self.assertIsNone(table.column("average_cadence").to_pylist()[1])
+
+    def test_rows_stream_into_row_groups(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'waypoint_data.parquet')
+            writer = ParquetTableWriter(path, WAYPOINT_DATA, row_group_size=2)
+            row = {name: None for name in field_names(WAYPOINT_DATA)}
+            writer.writerows(dict(row, activity_id="activity1", timestamp=index) for index in range(5))
+            writer.close()
+
+            parquet_file = pq.ParquetFile(path)
+            self.assertEqual(parquet_file.num_row_groups, 3)
+            self.assertEqual(parquet_file.read().column("timestamp").to_pylist(), [0, 1, 2, 3, 4])
+
+    def test_records_stream_into_row_groups(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'lap_data.parquet')
+            writer = ParquetTableWriter(path, LAP_DATA, row_group_size=3)
+            writer.writerecords(tuple(dict(LAP_ROWS[index % 2], lap_order=index).values()) for index in range(5))
+            writer.close()
+
+            parquet_file = pq.ParquetFile(path)
+            self.assertEqual(parquet_file.num_row_groups, 2)
+            table = parquet_file.read()
+            self.assertEqual(table.column("lap_order").to_pylist(), [0, 1, 2, 3, 4])
+            self.assertEqual(table.column("distance").to_pylist(), [2000.0, 200.0, 2000.0, 200.0, 2000.0])
+
+
+class TestGetWriter(unittest.TestCase):
+    def test_known_and_unknown_formats(self):
+        self.assertIs(get_writer('csv'), CsvTableWriter)
+        self.assertIs(get_writer('parquet'), ParquetTableWriter)
+        with self.assertRaises(ValueError):
+            get_writer('xml')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from cloud import storage_client
+
+
+UploadResult = namedtuple('UploadResult', ['source_file_path', 'blob_name', 'bytes', 'seconds', 'attempts'])
+
+
+def bytes_per_second(result):
+    return result.bytes / result.seconds if result.seconds else float('inf')
+
+
+class GcsUploader:
+    """Uploads staged files to Google Cloud Storage on a bounded thread pool.
+
+    One storage client is shared by every upload. Files of at least `resumable_threshold`
+    bytes go through chunked, resumable transfer, and failed uploads are retried with
+    exponential backoff.
+    """
+
+    def __init__(self, client=None, max_workers=4, chunk_size=8 * 2**20, resumable_threshold=8 * 2**20,
+                 retries=3, backoff=1.0, sleep=time.sleep):
+        self._client = client
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='gcs-upload')
+        self._futures = []
+        self.chunk_size = chunk_size
+        self.resumable_threshold = resumable_threshold
+        self.retries = retries
+        self.backoff = backoff
+        self._sleep = sleep
+        self.results = []
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = storage_client()
+            return self._client
+
+    def _bucket(self, bucket_name):
+        client = self.client
+        with self._lock:
+            if bucket_name not in self._buckets:
+                self._buckets[bucket_name] = client.bucket(bucket_name)
+            return self._buckets[bucket_name]
+
+    def submit(self, bucket_name, source_file_path, destination_blob_name):
+        """Queues an upload and returns its future; the caller can keep extracting meanwhile"""
+        future = self._executor.submit(self._upload, bucket_name, source_file_path, destination_blob_name)
+        self._futures.append(future)
+        return future
+
+    def _upload(self, bucket_name, source_file_path, destination_blob_name):
+        size = os.path.getsize(source_file_path)
+        chunk_size = self.chunk_size if size >= self.resumable_threshold else None
+        bucket = self._bucket(bucket_name)
+        started = time.perf_counter()
+        for attempt in range(1, self.retries + 2):
+            try:
+                blob = bucket.blob(destination_blob_name, chunk_size=chunk_size)
+                blob.upload_from_filename(source_file_path)
+                break
+            except Exception as e:
+                if attempt > self.retries:
+                    raise
+                delay = self.backoff * 2 ** (attempt - 1)
+                print(f"Upload of {source_file_path} failed ({e}), retrying in {delay}s")
+                self._sleep(delay)
+        result = UploadResult(source_file_path, destination_blob_name, size,
+                              time.perf_counter() - started, attempt)
+        self.results.append(result)
+        print(f"File {source_file_path} uploaded to {bucket_name} "
+              f"({size} bytes, {bytes_per_second(result) / 2**20:.2f} MB/s)")
+        return result
+
+    def wait(self):
+        """Blocks until every queued upload is done; raises the first failure once all have finished"""
+        futures, self._futures = self._futures, []
+        wait(futures)
+        for future in futures:
+            if future.exception() is not None:
+                raise future.exception()
+        return [future.result() for future in futures]
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,96 @@
+from itertools import repeat
+
+from tables import WAYPOINT_DATA, coerce
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Missing INTEGER values are stored as this sentinel and reported through masks
+MISSING_INT = -2**63
+
+
+def _dtype(field_type):
+    return {'FLOAT': 'f8', 'INTEGER': 'i8'}.get(field_type, 'O')
+
+
+class ColumnBatch:
+    """Typed column arrays holding every row of one table for one activity.
+
+    `values` is a NumPy structured array with one field per per-row column: FLOAT
+    columns use NaN and INTEGER columns use MISSING_INT for missing keys. Columns that
+    are the same for every row (activity_id, processing_time) are kept once in `constants`.
+    """
+
+    def __init__(self, spec, values, constants):
+        self.spec = spec
+        self.values = values
+        self.constants = constants
+
+    def __len__(self):
+        return len(self.values)
+
+    def mask(self, name):
+        """Boolean array that is True where the column is missing"""
+        column = self.values[name]
+        if column.dtype.kind == 'f':
+            return np.isnan(column)
+        if column.dtype.kind == 'i':
+            return column == MISSING_INT
+        return np.array([value is None for value in column], dtype=bool)
+
+    def column(self, name):
+        """Column as a Python list with None for missing values"""
+        if name in self.constants:
+            return list(repeat(self.constants[name], len(self)))
+        column = self.values[name]
+        if column.dtype.kind == 'O':
+            return column.tolist()
+        missing = self.mask(name)
+        values = column.tolist()
+        if missing.any():
+            for index in np.flatnonzero(missing).tolist():
+                values[index] = None
+        return values
+
+    def rows(self):
+        """Yields the batch as dict rows, for sinks that only take rows"""
+        names = [field.name for field in self.spec.fields]
+        columns = [self.column(name) for name in names]
+        for values in zip(*columns):
+            yield dict(zip(names, values))
+
+
+class WaypointArrays:
+    """Builds a ColumnBatch of an activity's waypoints in one pass over the list"""
+
+    def __init__(self, processing_time, spec=WAYPOINT_DATA):
+        if np is None:
+            raise ImportError("numpy is required for the vectorized waypoint path: pip install numpy")
+        self.spec = spec
+        self.processing_time = processing_time
+        item_fields = [field for field in spec.fields if field.source.startswith('item.')]
+        self.keys = [field.source.split('.', 1)[1] for field in item_fields]
+        self.dtype = np.dtype([(field.name, _dtype(field.type)) for field in item_fields])
+        self.defaults = [{'f8': float('nan'), 'i8': MISSING_INT}.get(_dtype(field.type))
+                         for field in item_fields]
+        self.constant_keys = [(field.name, field.type, field.source.split('.', 1)[1]) for field in spec.fields
+                              if field.source.startswith('activity.')]
+        self.processing_time_type = next(field.type for field in spec.fields if field.source == 'processing_time')
+
+    def build(self, activity):
+        waypoints = activity.get('waypoints') or ()
+        keys, defaults = self.keys, self.defaults
+        rows = [tuple(map(waypoint.get, keys, defaults)) for waypoint in waypoints]
+        try:
+            values = np.array(rows, dtype=self.dtype)
+        except (TypeError, ValueError):
+            #Explicit nulls or untyped values: swap nulls for defaults and coerce per value
+            rows = [tuple(default if value is None else value for value, default in zip(row, defaults))
+                    for row in rows]
+            values = np.array(rows, dtype=self.dtype)
+        constants = {name: coerce(field_type, activity.get(key)) for name, field_type, key in self.constant_keys}
+        constants['processing_time'] = coerce(self.processing_time_type, self.processing_time)
+        return ColumnBatch(self.spec, values, constants)
@@ -1,249 +1,700 @@
 from pathlib import Path
-import csv
+import argparse
+from functools import partial
+from async_pipeline import AsyncPipeline, flatten
+from concurrent.futures import ProcessPoolExecutor
 import json
-from datetime import date
-from google.cloud import storage
+import tempfile
+from datetime import date, datetime
 import os
+from decoders import get_decoder, projection
+from dimensions import DIMENSION_TABLES, KEYED_COLUMNS, DimensionStore, KeyingWriter, keyed_spec
+from downsampling import WAYPOINT_BUCKETS, make_reducer
+from enrichment import ENRICHED_WAYPOINT_DATA, LAP_SPLITS, EnrichedWaypointArrays, WaypointEnricher
+from manifest import Manifest
+from step_templates import DEFAULT_CACHE_SIZE, StepTemplates
+from metrics import PipelineMetrics, profiled
+from ordering import make_orderer
+from summaries import ACTIVITY_SUMMARY, SNAPSHOT_TABLES, RecordingWriter, SummaryStore
+from tables import TABLES, ExtractionEngine, coerce
+from uploader import GcsUploader
+from waypoints import WaypointArrays
+from writers import CsvTableWriter, ShardedWriter, get_writer
 
 
 
+def list_json_files(data_directory):
+    """Returns the JSON files in directory in file name order"""
+    return [json_file for json_file in sorted(Path(data_directory).iterdir())
+            if json_file.is_file() and json_file.suffix == '.json']
+
+
+def extract_tables(activities, engine, paths, writer_class=CsvTableWriter, header=True):
+    """Runs the extraction engine over activities once, writing each table to paths[table name].
+    writer_class can be any callable taking (path, spec, header), such as writer_factory's"""
+    writers = {}
+    try:
+        for spec in engine.specs:
+            writers[spec.name] = writer_class(paths[spec.name], spec, header=header)
+        return engine.run(activities, writers)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+def writer_factory(writer_class, compression=None, shards=None, on_close=None, store=None, dimensions=None):
+    """Callable building each table's writer. With shards=(prefix, max_rows, max_bytes) the
+    table path is a directory that gets <prefix>-<index> shards; on_close is called with
+    every finished shard path. activity_summary rows are also kept in store, when given,
+    and the fact tables get surrogate keys from the DimensionStore `dimensions`, when given"""
+    def make_writer(path, spec, header=True):
+        source_spec = spec
+        if dimensions is not None:
+            spec = keyed_spec(spec)
+        if shards is not None:
+            prefix, max_rows, max_bytes = shards
+            writer = ShardedWriter(path, prefix, spec, writer_class, max_rows, max_bytes,
+                                   compression, header, on_close)
+        elif compression:
+            writer = writer_class(path, spec, header=header, compression=compression)
+        else:
+            writer = writer_class(path, spec, header=header)
+        if store is not None and spec.name == ACTIVITY_SUMMARY.name:
+            return RecordingWriter(writer, store)
+        if dimensions is not None and spec.name in KEYED_COLUMNS:
+            return KeyingWriter(writer, source_spec, dimensions)
+        return writer
+    return make_writer
+
+
+def group_shards(shard_paths, specs=TABLES):
+    """{table name: [shard paths]} from paths of the form .../<table>/<prefix>-<index>.<extension>"""
+    files = {spec.name: [] for spec in specs}
+    for path in shard_paths:
+        files[Path(path).parent.name].append(path)
+    return files
+
+
+def _read_json_files(json_files, decoder=None):
+    decoder = decoder or get_decoder('json')
+    for json_file in json_files:
+        yield decoder.load(json_file)
+
+
+def make_decoder(name='auto', project=False, specs=TABLES):
+    """JSON decoder, keeping only the lap and waypoint keys the tables read when project is set"""
+    return get_decoder(name, projection(specs) if project else None)
+
+
+def make_engine(processing_time, vectorized=False, summaries=False, downsample=None, enrich=False,
+                step_cache_size=DEFAULT_CACHE_SIZE, reducer=None, enricher=None):
+    """Extraction engine, building waypoint_data as NumPy column arrays when vectorized,
+    activity_summary alongside the raw tables when summaries is set, waypoint_buckets
+    when the waypoints are downsampled, and the derived waypoint columns and lap_splits
+    when they are enriched. The reducer, then the enricher, run inside the engine, so an
+    activity either fails on is skipped and counted as a waypoint_buckets or lap_splits
+    failure. step_data comes from a cache of that many step templates, unless
+    step_cache_size is 0"""
+    specs = TABLES + [ACTIVITY_SUMMARY] if summaries else list(TABLES)
+    column_builders = None
+    if vectorized:
+        builder = EnrichedWaypointArrays(processing_time) if enrich else WaypointArrays(processing_time)
+        column_builders = {'waypoint_data': builder}
+    if downsample:
+        specs.append(WAYPOINT_BUCKETS)
+    if enrich:
+        specs = [ENRICHED_WAYPOINT_DATA if spec.name == ENRICHED_WAYPOINT_DATA.name else spec for spec in specs]
+        specs.append(LAP_SPLITS)
+    record_builders = None
+    if step_cache_size:
+        record_builders = {'step_data': StepTemplates(processing_time, maxsize=step_cache_size)}
+    preparers = []
+    if reducer is not None:
+        preparers.append((WAYPOINT_BUCKETS.name, reducer.reduce))
+    if enricher is not None:
+        preparers.append((LAP_SPLITS.name, enricher.enrich))
+    return ExtractionEngine(processing_time, specs, column_builders=column_builders, record_builders=record_builders,
+                            preparers=preparers)
+
+
+def step_templates(engine):
+    """The engine's step template cache, or None when it has none"""
+    return engine.record_builders.get('step_data')
+
+
+def ordered(activities, orderer):
+    """The activities sorted by user and start time without duplicates, when orderer is set"""
+    return orderer.apply(activities) if orderer is not None else activities
+
+
+def make_enricher(enrich, max_heart_rate):
+    return WaypointEnricher(max_heart_rate) if enrich else None
+
+
+def _extract_chunk(chunk):
+    """Worker entry point: flattens one chunk of files into partial per-table files, or into
+    finished shards under output_directory/<table>/ when sharding, and returns each table's
+    files with the chunk's per-table stats, activity count, activity summaries, waypoint
+    reduction counts and step template cache counts"""
+    (chunk_index, json_files, processing_time, parts_directory, output_format, vectorized, decoder, project,
+     compression, shards, summaries, downsample, enrich, max_heart_rate, step_cache_size) = chunk
+    reducer = make_reducer(downsample) if downsample else None
+    engine = make_engine(processing_time, vectorized, summaries, downsample, enrich, step_cache_size,
+                         reducer=reducer, enricher=make_enricher(enrich, max_heart_rate))
+    store = SummaryStore() if summaries else None
+    writer_class = get_writer(output_format)
+    closed = []
+    if shards is not None:
+        output_directory, run_id, max_rows, max_bytes = shards
+        paths = {spec.name: f"{output_directory}/{spec.name}" for spec in engine.specs}
+        make_writer = writer_factory(writer_class, compression, (f"{run_id}-{chunk_index:05d}", max_rows, max_bytes),
+                                     closed.append, store)
+    else:
+        extension = writer_class.file_extension(compression)
+        paths = {spec.name: f"{parts_directory}/{spec.name}-{chunk_index:06d}.{extension}" for spec in engine.specs}
+        make_writer = writer_factory(writer_class, compression, store=store)
+    activities = _read_json_files(json_files, make_decoder(decoder, project, engine.specs))
+    visited = extract_tables(activities, engine, paths, make_writer, header=shards is not None)
+    summaries = store.activities if store is not None else {}
+    reduction = reducer.stats if reducer is not None else None
+    templates = step_templates(engine)
+    templates = templates.stats if templates is not None else None
+    if shards is None:
+        return {name: [path] for name, path in paths.items()}, engine.stats, visited, summaries, reduction, templates
+    return group_shards(closed, engine.specs), engine.stats, visited, summaries, reduction, templates
+
+
+# Engine, decoder and reducer of each pipeline configuration, built once per process
+_FLATTENERS = {}
+
+
+def flatten_file(config, content):
+    """Async pipeline worker: decodes one file and flattens it into per-table row batches,
+    returning them with the call's per-table stats, waypoint reduction counts and step
+    template cache counts"""
+    if config not in _FLATTENERS:
+        (processing_time, vectorized, summaries, downsample, enrich, max_heart_rate, step_cache_size, decoder,
+         project) = config
+        reducer = make_reducer(downsample) if downsample else None
+        engine = make_engine(processing_time, vectorized, summaries, downsample, enrich, step_cache_size,
+                             reducer=reducer, enricher=make_enricher(enrich, max_heart_rate))
+        _FLATTENERS[config] = (engine, make_decoder(decoder, project, engine.specs), reducer)
+    engine, decoder, reducer = _FLATTENERS[config]
+    activity = decoder.loads(content)
+    reduced = dict(reducer.stats) if reducer is not None else None
+    cache = step_templates(engine)
+    before = dict(cache.stats) if cache is not None else None
+    tables, stats = flatten(engine, activity)
+    reduction = None
+    if reducer is not None:
+        reduction = {key: reducer.stats[key] - reduced[key] for key in ("points_in", "points_out")}
+    templates = {key: value - before[key] for key, value in cache.stats.items()} if cache is not None else None
+    return tables, stats, reduction, templates
+
+
 class WorkoutImporter:
 
-    def __init__(self, data_directory='./data'):
+    def __init__(self, data_directory='./data', streaming=False, workers=1, output_format='csv',
+                 incremental=False, vectorized=False, upload_workers=4, storage_client=None,
+                 report_path=None, profile_path=None, trace_memory=False, decoder='auto', project=False,
+                 shard_rows=None, shard_bytes=None, compression=None, summaries=False, downsample=None,
+                 asynchronous=False, queue_size=8, extract_workers=None, surrogate_keys=False, enrich=False,
+                 max_heart_rate=190, step_cache_size=DEFAULT_CACHE_SIZE, dedupe=None, sort_buffer=10_000,
+                 bucket_name='runna', output_directory='./processed_data'):
+        if surrogate_keys and workers > 1:
+            raise ValueError("Surrogate keys are handed out by a single writer, so they need workers=1; "
+                             "use streaming or asynchronous mode instead")
+        if incremental and (workers > 1 or asynchronous):
+            raise ValueError("Incremental runs parse the pending files in a single reader that tracks them for the "
+                             "manifest, so they need workers=1 and no asynchronous mode")
+        if dedupe is not None and (workers > 1 or asynchronous):
+            raise ValueError("Ordering and deduplicating sees every activity before any is written, so it "
+                             "needs a single reader; use batch, streaming or incremental mode instead")
         self.combined_data = []
-        self.load_json_files(data_directory)
+        self.decoder_name = decoder
+        self.project = project
+        self.decoder = make_decoder(decoder, project)
+        self.metrics = PipelineMetrics(trace_memory=trace_memory)
+        self.report_path = report_path
+        self.profile_path = profile_path
+        self.data_directory = data_directory
+        self.streaming = streaming
+        self.workers = workers
+        self.incremental = incremental
+        self.asynchronous = asynchronous
+        self.queue_size = queue_size
+        self.extract_workers = extract_workers
+        self.upload_workers = upload_workers
+        if not streaming and workers <= 1 and not incremental and not asynchronous:
+            with self.metrics.stage('load') as record:
+                self.load_json_files(data_directory)
+                record["rows_in"] = len(self.combined_data)
         self.today = date.today().strftime("%Y-%m-%d")
-        self.bucket_name = "runna"
+        self.bucket_name = bucket_name
+        self.uploader = GcsUploader(client=storage_client, max_workers=upload_workers)
+        self.output_directory = output_directory
+        self.vectorized = vectorized
+        self.summaries = summaries
+        self.downsample = downsample
+        self.reducer = make_reducer(downsample) if downsample else None
+        self.enrich = enrich
+        self.max_heart_rate = max_heart_rate
+        self.step_cache_size = step_cache_size
+        self.dedupe = dedupe
+        self.orderer = make_orderer(dedupe, sort_buffer)
+        self.engine = make_engine(self.today, vectorized, summaries, downsample, enrich, step_cache_size,
+                                  reducer=self.reducer, enricher=make_enricher(enrich, max_heart_rate))
+        self.output_format = output_format
+        self.writer_class = get_writer(output_format)
+        self.compression = compression
+        self.extension = self.writer_class.file_extension(compression)
+        self.shard_rows = shard_rows
+        self.shard_bytes = shard_bytes
+        self.sharded = shard_rows is not None or shard_bytes is not None
+        self.surrogate_keys = surrogate_keys
 
 
+    def iter_json_files(self, data_directory):
+        """Yields the JSON files in directory one activity at a time, in file name order"""
+        return _read_json_files(list_json_files(data_directory), self.decoder)
+
     def load_json_files(self, data_directory):
         """Reads given JSON files in directory and combines json and returns a list of dictionary """
         try:
-            path = Path(data_directory)
-            for json_file in path.iterdir():
-                if json_file.is_file() and json_file.suffix == '.json':
-                    with open(json_file, 'r') as json_file:
-                        data = json.load(json_file)
-                        self.combined_data.append(data)
-
+            self.combined_data.extend(self.iter_json_files(data_directory))
             return self.combined_data
         except Exception as e:
             print(f"Failed to parse directory {e}")
             return ""
 
-    def to_csv(self, file_name, field_names, rows):
-        """Writes rows of flatten json data into csv"""
-        with open(file_name, 'w', newline='', encoding='utf-8') as csv_file:
-            writer = csv.DictWriter(csv_file, fieldnames=field_names)
-            writer.writeheader()
-            writer.writerows(rows) 
-
-    def process_activity_data(self):
-        """From the JSON file, the activities records are processed, extracted and save to a cloud storage"""
-        activities_fields = ["activity_id", "user_id", "plan_id","plan_length","workout_id", 
-                             "record_type", "week_of_plan", "unit_of_measure", "processing_time"]
-        rows = []
-        try:
-            for activity_row in self.combined_data:
-                #Extract activity, and plan fields
-                activities_data = {
-                    "activity_id" : activity_row['activityId'], 
-                    "user_id":activity_row['userId'], 
-                    "plan_id": activity_row['planDetails']['id'],
-                    "plan_length":activity_row['planDetails']['planLength'],
-                    "workout_id" : activity_row['workoutId'], 
-                    "record_type" : activity_row['recordType'], 
-                    "week_of_plan":activity_row['weekOfPlan'], 
-                    "unit_of_measure": activity_row['unitOfMeasure'],
-                    "processing_time": self.today
-                }
-                rows.append(activities_data)
-            self.to_csv('./processed_data/activity_data.csv', activities_fields, rows)
-            self.upload_to_gcs(self.bucket_name,'./processed_data/activity_data.csv','activity_data')
-        except Exception as e:
-            print(f"Failed to process activity data :{e}")
+    def tables(self):
+        """Returns the declarative specs of every output table"""
+        return self.engine.specs
 
+    def _output_path(self, table_name):
+        return f"{self.output_directory}/{table_name}.{self.extension}"
 
-    def process_lap_data(self):
-        """From the JSON file, the laps records are processed, extracted and save to a cloud storage"""
-        lap_fields = ["activity_id", "lap_order","average_cadence", "average_heart_rate", "average_speed",
-                        "distance", "elevation_gain", "max_cadence", "max_elevation", "min_elevation",
-                        "max_heart_rate", "min_heart_rate", "max_speed", "moving_time",
-                        "start_timestamp", "total_time", "wkt_step_index", "processing_time"]
-        rows = []
-        try:
-            for lap_row in self.combined_data:
-                if "laps" in lap_row:
-                    #Extract lap fields, and include index to get the lap order
-                    for index, sub_lap in enumerate(lap_row['laps']):
-                        laps_data = {
-                            "activity_id" : lap_row['activityId'],
-                            "lap_order": index,
-                            "average_cadence": sub_lap.get('averageCadence'),
-                            "average_heart_rate": sub_lap.get('averageHeartRate'),
-                            "average_speed": sub_lap.get('averageSpeed'),
-                            "distance": sub_lap.get('distance'),
-                            "elevation_gain": sub_lap.get("elevationGain"),
-                            "max_cadence": sub_lap.get("maxCadence"),
-                            "max_elevation": sub_lap.get("maxElevation"),
-                            "min_elevation": sub_lap.get("minElevation"),
-                            "max_heart_rate": sub_lap.get("maxHeartRate"),
-                            "min_heart_rate": sub_lap.get("minHeartRate"),
-                            "max_speed": sub_lap.get("maxSpeed"),
-                            "moving_time": sub_lap.get("movingTime"),
-                            "start_timestamp": sub_lap.get("startTimestamp"),
-                            "total_time": sub_lap.get("totalTime"),
-                            "wkt_step_index": sub_lap.get("wktStepIndex"),
-                            "processing_time": self.today
-                        }
-                        rows.append(laps_data)
-            self.to_csv('./processed_data/lap_data.csv', lap_fields, rows)
-            self.upload_to_gcs(self.bucket_name,'./processed_data/lap_data.csv','lap_data')
-        except Exception as e:
-            print(f'Failed to process lap data :{e}')
+    def _blob_name(self, table_name):
+        """Plain csv blobs keep the bare table name; other outputs carry their extension for the loader"""
+        if self.extension == 'csv':
+            return table_name
+        return f"{table_name}.{self.extension}"
 
+    def _shard_blob_name(self, path):
+        """Shards keep their <table>/<run id>-<index>.<extension> path in the bucket"""
+        return Path(path).relative_to(self.output_directory).as_posix()
 
-    def process_waypoint_data(self):
-        """From the JSON file, the waypoint records are processed, extracted and save to a cloud storage"""
-        waypoint_fields = ["activity_id", "cadence", "distance", "elevation", "heart_rate",
-                            "moving_time", "speed", "timestamp", "power", "stride_length",
-                            "step_index","lap_index","raw_speed","accuracy","elevation_accuracy",
-                            "type", "processing_time"]
-        rows = []
+    def upload_shard(self, path):
+        return self.upload_to_gcs(self.bucket_name, path, self._shard_blob_name(path))
 
-        try:
-            for wp_row in self.combined_data:
-                if "waypoints" in wp_row:
-                    for wp_lap in wp_row['waypoints']:
-                        #Extract waypoint fields
-                        wp_data = {
-                            "activity_id" : wp_row['activityId'],
-                            "cadence": wp_lap.get('cadence'),
-                            "distance": wp_lap.get('distance'),
-                            "elevation": wp_lap.get("elevation"),
-                            "heart_rate": wp_lap.get("heartRate"),
-                            "moving_time": wp_lap.get("movingTime"),
-                            "speed": wp_lap.get("speed"),
-                            "timestamp": wp_lap.get("timestamp"),
-                            "power": wp_lap.get("power"),
-                            "stride_length": wp_lap.get("strideLength"),
-                            "step_index":wp_lap.get("stepIndex"),
-                            "lap_index":wp_lap.get("lapIndex"),
-                            "raw_speed":wp_lap.get("rawSpeed"),
-                            "accuracy":wp_lap.get("accuracy"),
-                            "elevation_accuracy": wp_lap.get("elevationAccuracy"),
-                            "type": wp_lap.get("type"),
-                            "processing_time": self.today
-                        }
-                        rows.append(wp_data)
-            self.to_csv('./processed_data/waypoint_data.csv', waypoint_fields, rows)
-            self.upload_to_gcs(self.bucket_name,'./processed_data/waypoint_data.csv','waypoint_data')
-        except Exception as e:
-            print(f"Failed to process waypoint data :{e}")
+    def _make_writer(self, run_id=None, closed=None, store=None, upload=True, dimensions=None):
+        """Writer factory for extract_tables. When sharding, shards are named after run_id,
+        and each one is appended to closed, and uploaded unless upload is False, as soon as
+        it is finished"""
+        if not self.sharded:
+            return writer_factory(self.writer_class, self.compression, store=store, dimensions=dimensions)
+        def on_close(path):
+            closed.append(path)
+            if upload:
+                self.upload_shard(path)
+        return writer_factory(self.writer_class, self.compression, (run_id, self.shard_rows, self.shard_bytes),
+                              on_close, store, dimensions)
 
+    def _summary_store(self, path=None):
+        return SummaryStore(path) if self.summaries else None
 
-    def process_metadata_data(self):
-        """From the JSON file, the workout metadata records are processed, extracted and save to a cloud storage"""
-        workout_metadata_fields = ["activity_id","workout_type","run_type","distance",
-                                    "current_est_5k_time_secs","planned_workout_date", "processing_time"]
-        rows = []
-        
-        try:
-            for metadata_row in self.combined_data:
-                if 'plannedWorkoutMetadata' in metadata_row and metadata_row['plannedWorkoutMetadata']:
-                    metadata = {
-                        "activity_id": metadata_row['activityId'],
-                        "workout_type": metadata_row['plannedWorkoutMetadata'].get('workoutType'),
-                        "run_type": metadata_row['plannedWorkoutMetadata'].get('runType'),
-                        "distance": metadata_row['plannedWorkoutMetadata'].get('distance'),
-                        "current_est_5k_time_secs": metadata_row['plannedWorkoutMetadata'].get('currentEst5kTimeInSecs'),
-                        "planned_workout_date": metadata_row['plannedWorkoutMetadata'].get("plannedWorkoutDate"),
-                        "processing_time": self.today
-                    }
-                    rows.append(metadata)
-            self.to_csv('./processed_data/workout_metadata.csv', workout_metadata_fields, rows)
-            self.upload_to_gcs(self.bucket_name,'./processed_data/workout_metadata.csv','workout_metadata')
-        except Exception as e:
-            print(f"Failed to process workout metadata data :{e}")
-
-
-    def _parse_step(self, step, activity_id, repeat_value, lap_order):
-        """Function that extracts the step and pace column fields
-        Return flatten steps data that include paces
-        """
-        step_data = {
-            "activity_id": activity_id,
-            "processing_time": self.today,
-            "lap_order": lap_order,
-            "step_type": step.get('type'),
-            "step_order":step.get('stepOrder'),
-            "repeat_value": repeat_value,
-            "intensity": step.get('intensity'),
-            "duration_type": step.get('durationType'),
-            "duration_value": step.get('durationValue'),
-            "duration_value_type": step.get('durationValueType'),
-            "target_type": step.get('targetType'),
-            "pace_slow_text": None,
-            "pace_slow_mps": None,
-            "pace_average_text": None,
-            "pace_average_mps": None,
-            "pace_fast_text": None,
-            "pace_fast_mps": None
-        }
-        if step.get("paces"):
-            if "slow" in step["paces"]:
-                #Get pace data and replace the (:) in order to convert it from text to appropiate data type
-                step_data["pace_slow_text"] = step["paces"]["slow"].get("text").replace(":",".")
-                step_data["pace_slow_mps"] = step["paces"]["slow"].get("mps")
-            if "average" in step["paces"]:
-                step_data["pace_average_text"] = step["paces"]["average"].get("text").replace(":",".")
-                step_data["pace_average_mps"] = step["paces"]["average"].get("mps")
-            if "fast" in step["paces"]:
-                step_data["pace_fast_text"] = (step["paces"]["fast"].get("text")).replace(":",".")
-                step_data["pace_fast_mps"] = step["paces"]["fast"].get("mps")
-        return step_data
-    
-    def process_step_data(self):
-        """From the JSON file, the step records are processed, extracted and save to a cloud storage"""
-        steps_fields = ["activity_id", "processing_time", "lap_order", "step_type", "step_order", "repeat_value","intensity",
-                "duration_type","duration_value","duration_value_type","target_type",
-                "pace_slow_text","pace_slow_mps","pace_average_text","pace_average_mps",
-                "pace_fast_text","pace_fast_mps"]
-        results = []
-
-        for step_row in self.combined_data:
-            stepdata = step_row['plannedWorkoutMetadata']
-            if 'stepsV2' in stepdata:
-                #Get steps data and pace data by checking step['type'] if it is equal to RepeatStep
-                for index, step in enumerate(stepdata['stepsV2']):
-                    if step['type'] == 'WorkoutStep':
-                        results.append(self._parse_step(step, step_row['activityId'], step.get('repeatValue'), index))
-                    elif step['type'] == 'WorkoutRepeatStep':
-                        parsed_data = [self._parse_step(pace, step_row['activityId'], step.get('repeatValue'), index) for pace in step['steps']]
-                        results.extend(parsed_data)
-
-        self.to_csv('./processed_data/step_data.csv', steps_fields, results)
-        self.upload_to_gcs(self.bucket_name,'./processed_data/step_data.csv','step_data')
+    def _dimension_store(self):
+        """Keys are kept next to the manifest for every run, so they stay the same from run to run"""
+        return DimensionStore(f"{self.output_directory}/dimensions.json") if self.surrogate_keys else None
+
+    def write_snapshots(self, store, run_id=None, incremental=False, closed=None):
+        """Writes and uploads user_week_summary and workout_leaderboard, rebuilt from the
+        activity summaries in store, next to the run's other files"""
+        if store is None:
+            return
+        processing_time = coerce('DATE', self.today)
+        self._write_snapshot_tables([(spec, store.snapshot_rows(spec.name, processing_time))
+                                     for spec in SNAPSHOT_TABLES], run_id, incremental, closed)
+
+    def write_dimensions(self, dimensions, run_id=None, incremental=False, closed=None):
+        """Writes and uploads the dimension tables whole from the keys in dimensions"""
+        if dimensions is None:
+            return
+        processing_time = coerce('DATE', self.today)
+        self._write_snapshot_tables([(spec, dimensions.dimension_rows(spec.name, processing_time))
+                                     for spec in DIMENSION_TABLES], run_id, incremental, closed)
+
+    def _write_snapshot_tables(self, tables, run_id=None, incremental=False, closed=None):
+        make_writer = self._make_writer(run_id, closed if closed is not None else [])
+        for spec, rows in tables:
+            if self.sharded:
+                path = f"{self.output_directory}/{spec.name}"
+            elif incremental:
+                path = f"{self.output_directory}/{spec.name}-{run_id}.{self.extension}"
+            else:
+                path = self._output_path(spec.name)
+            writer = make_writer(path, spec)
+            try:
+                writer.writerows(rows)
+            finally:
+                writer.close()
+            if not self.sharded:
+                blob_name = f"{spec.name}/{run_id}.{self.extension}" if incremental else self._blob_name(spec.name)
+                self.upload_to_gcs(self.bucket_name, path, blob_name)
+
+    def _table_paths(self):
+        if self.sharded:
+            return {spec.name: f"{self.output_directory}/{spec.name}" for spec in self.tables()}
+        return {spec.name: self._output_path(spec.name) for spec in self.tables()}
+
+    def _new_run_id(self):
+        return datetime.now().strftime("%Y%m%dT%H%M%S%f")
+
+    def _stage_run_file(self, run_id, mode, **details):
+        """Writes and uploads runs/<run id>.json, which tells the loader how to load the run"""
+        run_path = f"{self.output_directory}/run-{run_id}.json"
+        if self.surrogate_keys:
+            details["surrogate_keys"] = True
+        if self.enrich:
+            details["enriched"] = True
+        with open(run_path, 'w') as run_file:
+            json.dump(dict(run_id=run_id, mode=mode, **details), run_file, indent=2)
+        self.upload_to_gcs(self.bucket_name, run_path, f"runs/{run_id}.json")
 
     def upload_to_gcs(self, bucket_name, source_file_path, destination_blob_name):
-        """Upload file to Google Cloud Storage for staging"""
-        client = storage.Client()
-        bucket = client.bucket(bucket_name)
-        blob = bucket.blob(destination_blob_name)
-        blob.upload_from_filename(source_file_path)
-        print(f"File {source_file_path} uploaded to {bucket_name}")
+        """Queues a file for upload to Google Cloud Storage for staging and returns its future,
+        so the next table can be extracted while it uploads"""
+        return self.uploader.submit(bucket_name, source_file_path, destination_blob_name)
+
+    def wait_for_uploads(self):
+        """Blocks until every queued upload has finished and returns their UploadResults"""
+        with self.metrics.stage('upload') as record:
+            results = self.uploader.wait()
+            for result in results:
+                table_name = result.blob_name.split('/')[0].split('.')[0]
+                self.metrics.table('upload', table_name, bytes_written=result.bytes, wall_seconds=result.seconds)
+                record["bytes_written"] += result.bytes
+        return results
+
+    def _record_extract(self, record, visited, stats, files):
+        """Adds the engine's per-table counts and the written file sizes to the extract stage.
+        Failed activities are only counted per table, as the report adds stages and tables up"""
+        record["rows_in"] += visited
+        for spec in self.tables():
+            table_stats = stats[spec.name]
+            size = sum(os.path.getsize(path) for path in files[spec.name] if os.path.exists(path))
+            self.metrics.table('extract', spec.name, rows_in=visited, bytes_written=size, **table_stats)
+            record["rows_out"] += table_stats["rows_out"]
+            record["bytes_written"] += size
+
+    def _record_downsampling(self, stats):
+        """Adds the waypoints read and kept by the reducer (or the workers' reducers) to the report"""
+        points_in, points_out = stats["points_in"], stats["points_out"]
+        self.metrics.table('downsample', 'waypoint_data', rows_in=points_in, rows_out=points_out)
+        ratio = points_out / points_in if points_in else 1.0
+        print(f"Downsampled waypoints with {self.downsample}: kept {points_out} of {points_in} ({ratio:.1%})")
+
+    def _record_ordering(self, stats):
+        """Adds the activities read and kept by the dedup-and-order stage to the report"""
+        self.metrics.table('order', 'activities', rows_in=stats["activities_in"], rows_out=stats["activities_out"],
+                           bytes_written=stats["spilled_bytes"])
+        self.metrics.count('order', duplicates=stats["duplicates"], spilled_runs=stats["spilled_runs"])
+        print(f"Ordered {stats['activities_out']} activities by user and start time: dropped "
+              f"{stats['duplicates']} duplicates ({self.dedupe} precedence), spilled {stats['spilled_runs']} runs")
+
+    def _record_step_templates(self, stats):
+        """Adds the step template cache's (or the workers' caches') hits and misses to the report"""
+        if stats is None:
+            return
+        self.metrics.count('step_templates', **stats)
+        looked_up = stats["hits"] + stats["misses"]
+        rate = stats["hits"] / looked_up if looked_up else 0.0
+        print(f"Step templates: {stats['hits']} hits, {stats['misses']} misses ({rate:.1%} hit rate), "
+              f"{stats['evictions']} evictions")
+
+    def _engine_templates(self):
+        templates = step_templates(self.engine)
+        return templates.stats if templates is not None else None
+
+    def _prepared(self, activities):
+        """Orders and deduplicates the activities as configured. The engine downsamples and
+        enriches each one as it extracts it"""
+        return ordered(activities, self.orderer)
+
+    def _record_preparation(self):
+        """Reports the counts of the stages that prepared the engine's activities"""
+        if self.orderer is not None:
+            self._record_ordering(self.orderer.stats)
+        if self.reducer is not None:
+            self._record_downsampling(self.reducer.stats)
+        self._record_step_templates(self._engine_templates())
+
+    def upload_tables(self):
+        for spec in self.tables():
+            self.upload_to_gcs(self.bucket_name, self._output_path(spec.name), self._blob_name(spec.name))
+
+    def write_tables(self, activities):
+        """Runs the extraction engine over activities once, writing every table as it goes.
+        When sharding, each shard uploads as soon as it is full and the run id is returned"""
+        store = self._summary_store()
+        dimensions = self._dimension_store()
+        if not self.sharded:
+            paths = self._table_paths()
+            with self.metrics.stage('extract') as record:
+                visited = extract_tables(self._prepared(activities), self.engine, paths,
+                                         self._make_writer(store=store, dimensions=dimensions))
+                self._record_extract(record, visited, self.engine.stats,
+                                     {name: [path] for name, path in paths.items()})
+            self._record_preparation()
+            self.upload_tables()
+            self.write_snapshots(store)
+            self.write_dimensions(dimensions)
+            self._save_dimensions(dimensions)
+            return None
+
+        run_id = self._new_run_id()
+        closed = []
+        with self.metrics.stage('extract') as record:
+            visited = extract_tables(self._prepared(activities), self.engine, self._table_paths(),
+                                     self._make_writer(run_id, closed, store, dimensions=dimensions))
+            self._record_extract(record, visited, self.engine.stats, group_shards(closed, self.tables()))
+        self._record_preparation()
+        self.write_snapshots(store, run_id, closed=closed)
+        self.write_dimensions(dimensions, run_id, closed=closed)
+        self._save_dimensions(dimensions)
+        self._stage_full_run(run_id, closed)
+        return run_id
+
+    def _save_dimensions(self, dimensions):
+        if dimensions is not None:
+            dimensions.save()
+
+    def _stage_full_run(self, run_id, shard_paths):
+        self._stage_run_file(run_id, 'full', shards=[self._shard_blob_name(path) for path in shard_paths])
+        print(f"Staged run {run_id} ({len(shard_paths)} shards)")
+
+    def write_tables_parallel(self):
+        """Splits the files across worker processes, then merges their partial files
+        in file name order so the output matches the serial path row for row.
+        When sharding, the workers' shards are uploaded as they are, without a merge"""
+        json_files = list_json_files(self.data_directory)
+        chunk_size = max(1, -(-len(json_files) // (self.workers * 4)))
+        run_id = self._new_run_id() if self.sharded else None
+        shards = (self.output_directory, run_id, self.shard_rows, self.shard_bytes) if self.sharded else None
+        with tempfile.TemporaryDirectory() as parts_directory:
+            chunks = [(index, json_files[start:start + chunk_size], self.today, parts_directory,
+                       self.output_format, self.vectorized, self.decoder_name, self.project,
+                       self.compression, shards, self.summaries, self.downsample, self.enrich, self.max_heart_rate,
+                       self.step_cache_size)
+                      for index, start in enumerate(range(0, len(json_files), chunk_size))]
+            parts = []
+            store = self._summary_store()
+            reduction_stats = {"points_in": 0, "points_out": 0}
+            template_stats = None
+            with self.metrics.stage('extract') as record:
+                with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                    results = executor.map(_extract_chunk, chunks)
+                    for files, stats, visited, summaries, reduction, templates in results:
+                        parts.append(files)
+                        if store is not None:
+                            store.update(summaries)
+                        if reduction is not None:
+                            reduction_stats["points_in"] += reduction["points_in"]
+                            reduction_stats["points_out"] += reduction["points_out"]
+                        if templates is not None:
+                            template_stats = template_stats or dict.fromkeys(templates, 0)
+                            for key, value in templates.items():
+                                template_stats[key] += value
+                        record["rows_in"] += visited
+                        for spec in self.tables():
+                            self.metrics.table('extract', spec.name, rows_in=visited, **stats[spec.name])
+                            record["rows_out"] += stats[spec.name]["rows_out"]
+                            if self.sharded:
+                                for path in files[spec.name]:
+                                    self.upload_shard(path)
+            if self.reducer is not None:
+                self._record_downsampling(reduction_stats)
+            self._record_step_templates(template_stats)
+
+            if self.sharded:
+                closed = [path for files in parts for spec in self.tables() for path in files[spec.name]]
+                self.write_snapshots(store, run_id, closed=closed)
+                self._stage_full_run(run_id, closed)
+                return run_id
+
+            #Each table starts uploading as soon as it is merged, while the next one merges
+            with self.metrics.stage('merge') as record:
+                for spec in self.tables():
+                    path = self._output_path(spec.name)
+                    self.writer_class.merge([path for files in parts for path in files[spec.name]], path, spec,
+                                            self.compression)
+                    self.metrics.table('merge', spec.name, bytes_written=os.path.getsize(path))
+                    record["bytes_written"] += os.path.getsize(path)
+                    self.upload_to_gcs(self.bucket_name, path, self._blob_name(spec.name))
+            self.write_snapshots(store)
+            return None
+
+    def write_tables_async(self):
+        """Runs the asyncio pipeline: files are read, flattened, written and uploaded by
+        concurrent stages joined by bounded queues, giving the same files as write_tables"""
+        store = self._summary_store()
+        dimensions = self._dimension_store()
+        run_id = self._new_run_id() if self.sharded else None
+        closed = []
+        paths = self._table_paths()
+        blob_names = {paths[spec.name]: self._blob_name(spec.name) for spec in self.tables()}
+        def upload(path):
+            if self.sharded:
+                return self.upload_shard(path)
+            return self.upload_to_gcs(self.bucket_name, path, blob_names[path])
+        #Shards are uploaded as they close; whole-table files once every writer is closed
+        outputs = [] if self.sharded else list(blob_names)
+        config = (self.today, self.vectorized, self.summaries, self.downsample, self.enrich, self.max_heart_rate,
+                  self.step_cache_size, self.decoder_name, self.project)
+        pipeline = AsyncPipeline(partial(flatten_file, config), self.tables(), paths,
+                                 self._make_writer(run_id, closed, store, upload=False, dimensions=dimensions),
+                                 upload, closed, outputs,
+                                 self.queue_size, self.upload_workers, self.extract_workers)
+
+        with self.metrics.stage('extract') as record:
+            visited = pipeline.run(list_json_files(self.data_directory))
+            files = (group_shards(closed, self.tables()) if self.sharded
+                     else {name: [path] for name, path in paths.items()})
+            self._record_extract(record, visited, pipeline.table_stats, files)
+        for stage, seconds in pipeline.stats.items():
+            self.metrics.table('pipeline', stage, wall_seconds=seconds)
+        if pipeline.reduction is not None:
+            self._record_downsampling(pipeline.reduction)
+        self._record_step_templates(pipeline.templates)
+        self.write_snapshots(store, run_id, closed=closed)
+        self.write_dimensions(dimensions, run_id, closed=closed)
+        self._save_dimensions(dimensions)
+        if self.sharded:
+            self._stage_full_run(run_id, closed)
+        return run_id
+
+    def _read_tracked(self, json_files, manifest, redelivered, tracked):
+        """Parses pending files once, noting re-delivered activities. Each file's (path, content,
+        activity id) goes to tracked, to be recorded in the manifest once it has extracted"""
+        for json_file in json_files:
+            with open(json_file, 'rb') as f:
+                content = f.read()
+            activity = self.decoder.loads(content)
+            activity_id = activity.get('activityId')
+            if activity_id in manifest.known_activity_ids:
+                redelivered.append(activity_id)
+            tracked.append((json_file, content, activity_id))
+            yield activity
+
+    def import_incremental(self):
+        """Parses only new or changed files into per-run delta files and uploads them under
+        <table>/<run id>, along with runs/<run id>.json listing the re-delivered activity ids"""
+        manifest = Manifest(f"{self.output_directory}/manifest.json")
+        json_files = manifest.pending(list_json_files(self.data_directory))
+        if not json_files:
+            manifest.save()
+            print("No new or changed activity files")
+            return None
+
+        run_id = self._new_run_id()
+        closed = []
+        if self.sharded:
+            paths = self._table_paths()
+        else:
+            paths = {spec.name: f"{self.output_directory}/{spec.name}-{run_id}.{self.extension}"
+                     for spec in self.tables()}
+        redelivered = []
+        tracked = []
+        self.engine.failed_activities.clear()
+        store = self._summary_store(f"{self.output_directory}/summaries.json")
+        dimensions = self._dimension_store()
+        with self.metrics.stage('extract') as record:
+            activities = self._prepared(self._read_tracked(json_files, manifest, redelivered, tracked))
+            visited = extract_tables(activities, self.engine, paths,
+                                     self._make_writer(run_id, closed, store, dimensions=dimensions))
+            files = (group_shards(closed, self.tables()) if self.sharded
+                     else {name: [path] for name, path in paths.items()})
+            self._record_extract(record, visited, self.engine.stats, files)
+        self._record_preparation()
+
+        if not self.sharded:
+            for spec in self.tables():
+                self.upload_to_gcs(self.bucket_name, paths[spec.name], f"{spec.name}/{run_id}.{self.extension}")
+        self.write_snapshots(store, run_id, incremental=True)
+        self.write_dimensions(dimensions, run_id, incremental=True)
+        #A re-delivered activity that failed to extract has no rows in this delta, so the loader
+        #must keep its existing rows rather than delete them
+        redelivered = sorted(set(redelivered) - self.engine.failed_activities)
+        details = {}
+        if dimensions is not None:
+            #Keyed deltas are matched to the rows they replace by activity_key
+            details["redelivered_activity_keys"] = dimensions.keys('activity', redelivered)
+        self._stage_run_file(run_id, 'incremental', files=[str(f) for f in json_files],
+                             redelivered_activity_ids=redelivered, **details)
+
+        #Only remember the files once their rows are safely staged, and leave the ones that
+        #failed to extract pending so the next run retries them
+        self.wait_for_uploads()
+        for json_file, content, activity_id in tracked:
+            if activity_id not in self.engine.failed_activities:
+                manifest.record(json_file, content, activity_id)
+        manifest.save()
+        if store is not None:
+            store.save()
+        self._save_dimensions(dimensions)
+        print(f"Staged incremental run {run_id} ({len(json_files)} files, {len(redelivered)} re-delivered)")
+        return run_id
 
     def import_data(self):
-        self.process_activity_data()
-        self.process_lap_data()
-        self.process_metadata_data()
-        self.process_waypoint_data()
-        self.process_step_data()
+        """Extracts all tables in a single pass, parsing files lazily when streaming
+        and across worker processes when workers > 1. The run is profiled when a
+        profile_path was given, and its metrics written to report_path if set"""
+        try:
+            with profiled(self.profile_path):
+                return self._import_data()
+        finally:
+            if self.report_path:
+                self.metrics.write_report(self.report_path)
+
+    def _import_data(self):
+        if self.incremental:
+            return self.import_incremental()
+        if self.workers > 1:
+            run_id = self.write_tables_parallel()
+        elif self.asynchronous:
+            run_id = self.write_tables_async()
+        elif self.streaming:
+            run_id = self.write_tables(self.iter_json_files(self.data_directory))
+        else:
+            run_id = self.write_tables(self.combined_data)
+        self.wait_for_uploads()
+        return run_id
+
+
+def importer_from_args(args, storage_client=None):
+    """WorkoutImporter for the options that cli.add_import_arguments parsed"""
+    return WorkoutImporter(data_directory=args.data_directory, incremental=args.incremental,
+                           streaming=args.streaming, workers=args.workers, vectorized=args.vectorized,
+                           decoder=args.decoder, project=args.project, queue_size=args.queue_size,
+                           upload_workers=args.upload_workers, output_format=args.format, report_path=args.report,
+                           profile_path=args.profile, trace_memory=args.trace_memory, shard_rows=args.shard_rows,
+                           shard_bytes=args.shard_bytes, compression=args.compression, summaries=args.summaries,
+                           downsample=args.downsample, asynchronous=args.asynchronous,
+                           extract_workers=args.extract_workers, surrogate_keys=args.surrogate_keys,
+                           enrich=args.enrich, max_heart_rate=args.max_heart_rate,
+                           step_cache_size=args.step_cache_size, dedupe=args.dedupe, sort_buffer=args.sort_buffer,
+                           bucket_name=args.bucket, output_directory=args.output_directory,
+                           storage_client=storage_client)
+
 
+def main(argv=None):
+    from cli import add_import_arguments
 
-def main():
+    parser = argparse.ArgumentParser(description="Flatten the activity JSON files and stage them in GCS")
+    add_import_arguments(parser)
+    args = parser.parse_args(argv)
     try:
-        importer = WorkoutImporter()
+        importer = importer_from_args(args)
         importer.import_data()
 
     except Exception as e:
@@ -0,0 +1,267 @@
+import csv
+import gzip
+import os
+import shutil
+from itertools import chain, count, islice
+from operator import itemgetter
+
+from tables import field_names
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+class CsvTableWriter:
+    """Writes the rows of one table to a csv file, gzipped when compression='gzip'.
+    BigQuery only loads gzip among compressed csv, so that is the one codec offered"""
+
+    extension = 'csv'
+    compressions = (None, 'gzip')
+
+    def __init__(self, path, spec, header=True, compression=None):
+        if compression not in self.compressions:
+            raise ValueError(f"Unsupported csv compression {compression}, expected gzip or None")
+        self.path = path
+        self.spec = spec
+        if compression == 'gzip':
+            self._file = gzip.open(path, 'wt', newline='', encoding='utf-8')
+        else:
+            self._file = open(path, 'w', newline='', encoding='utf-8')
+        self._writer = csv.DictWriter(self._file, fieldnames=field_names(spec))
+        if header:
+            self._writer.writeheader()
+
+    def writerows(self, rows):
+        self._writer.writerows(rows)
+
+    def writerecords(self, records):
+        """Writes tuples in field order straight through csv.writer, with no dict lookups"""
+        self._writer.writer.writerows(records)
+
+    def write_columns(self, batch):
+        """Writes a ColumnBatch without building a dict per row"""
+        columns = [batch.column(name) for name in self._writer.fieldnames]
+        self._writer.writer.writerows(zip(*columns))
+
+    def close(self):
+        self._file.close()
+
+    @classmethod
+    def file_extension(cls, compression=None):
+        return 'csv.gz' if compression == 'gzip' else 'csv'
+
+    @classmethod
+    def merge(cls, part_paths, path, spec, compression=None):
+        """Concatenates header-less csv parts into one csv file. Gzipped parts are copied
+        as they are, since concatenated gzip members are a valid gzip file"""
+        header = cls(path, spec, compression=compression)
+        header.close()
+        with open(path, 'ab') as csv_file:
+            for part_path in part_paths:
+                with open(part_path, 'rb') as part_file:
+                    shutil.copyfileobj(part_file, csv_file)
+
+
+def arrow_schema(spec):
+    """Builds the typed arrow schema of a table from its spec"""
+    arrow_types = {'STRING': pa.string(), 'INTEGER': pa.int64(), 'FLOAT': pa.float64(), 'DATE': pa.date32()}
+    return pa.schema([(field.name, arrow_types[field.type]) for field in spec.fields])
+
+
+class ParquetTableWriter:
+    """Writes the rows of one table to a compressed Parquet file, one row group at a time.
+    Rows must already hold values of their column types, as the extraction engine coerces them"""
+
+    extension = 'parquet'
+
+    def __init__(self, path, spec, header=True, row_group_size=100_000, compression='zstd'):
+        if pa is None:
+            raise ImportError("pyarrow is required for Parquet output: pip install pyarrow")
+        self.path = path
+        self.spec = spec
+        self.row_group_size = row_group_size
+        self.schema = arrow_schema(spec)
+        self._names = field_names(spec)
+        self._columns = {name: [] for name in self._names}
+        self._buffered = 0
+        self._batches = []
+        self._batched = 0
+        self._writer = pq.ParquetWriter(path, self.schema, compression=compression)
+
+    def writerows(self, rows):
+        columns = self._columns
+        names = self._names
+        for row in rows:
+            for name in names:
+                columns[name].append(row[name])
+            self._buffered += 1
+            if self._buffered >= self.row_group_size:
+                self._flush()
+                columns = self._columns
+
+    def writerecords(self, records):
+        columns = [self._columns[name] for name in self._names]
+        for record in records:
+            for column, value in zip(columns, record):
+                column.append(value)
+            self._buffered += 1
+            if self._buffered >= self.row_group_size:
+                self._flush()
+                columns = [self._columns[name] for name in self._names]
+
+    def write_columns(self, batch):
+        """Converts a ColumnBatch to arrow arrays in bulk, using its masks for missing values"""
+        self._buffer_rows()
+        length = len(batch)
+        arrays = []
+        for field, arrow_field in zip(self.spec.fields, self.schema):
+            if field.name in batch.constants:
+                arrays.append(pa.array([batch.constants[field.name]] * length, arrow_field.type))
+            else:
+                column = batch.values[field.name]
+                if column.dtype.kind == 'O':
+                    arrays.append(pa.array(column.tolist(), arrow_field.type))
+                else:
+                    arrays.append(pa.array(column, arrow_field.type, mask=batch.mask(field.name)))
+        self._batches.append(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        self._batched += length
+        if self._batched >= self.row_group_size:
+            self._flush()
+
+    def _buffer_rows(self):
+        """Moves buffered dict rows into a record batch so they keep their place in the file"""
+        if not self._buffered:
+            return
+        self._batches.append(pa.RecordBatch.from_pydict(self._columns, schema=self.schema))
+        self._batched += self._buffered
+        self._columns = {name: [] for name in self._names}
+        self._buffered = 0
+
+    def _flush(self):
+        self._buffer_rows()
+        if not self._batched:
+            return
+        table = pa.Table.from_batches(self._batches, schema=self.schema)
+        self._writer.write_table(table, row_group_size=self.row_group_size)
+        self._batches = []
+        self._batched = 0
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+    @classmethod
+    def file_extension(cls, compression=None):
+        return 'parquet'
+
+    @classmethod
+    def merge(cls, part_paths, path, spec, compression=None):
+        """Copies the row groups of Parquet parts into one file, in part order"""
+        schema = arrow_schema(spec)
+        with pq.ParquetWriter(path, schema, compression=compression or 'zstd') as writer:
+            for part_path in part_paths:
+                part = pq.ParquetFile(part_path)
+                for index in range(part.num_row_groups):
+                    writer.write_table(part.read_row_group(index))
+
+
+class ShardedWriter:
+    """Writes one table as a run of shard files <directory>/<prefix>-<index>.<extension>,
+    rolling over to the next shard after max_rows rows, or once the shard reaches max_bytes
+    on disk. Byte sizes are checked between writes, so a shard can overshoot max_bytes by
+    what the writer still buffers (a row group, for Parquet). A column batch is never split,
+    so it starts a new shard when it would not fit in the current one.
+
+    on_close(path) is called as each shard is finished, so it can be uploaded while the
+    next one fills. Every shard carries its own csv header."""
+
+    def __init__(self, directory, prefix, spec, writer_class=CsvTableWriter, max_rows=None, max_bytes=None,
+                 compression=None, header=True, on_close=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.spec = spec
+        self.writer_class = writer_class
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.header = header
+        self.on_close = on_close
+        self.paths = []
+        self._writer = None
+        self._rows = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _open(self):
+        extension = self.writer_class.file_extension(self.compression)
+        path = os.path.join(self.directory, f"{self.prefix}-{len(self.paths):05d}.{extension}")
+        options = {'compression': self.compression} if self.compression else {}
+        self._writer = self.writer_class(path, self.spec, header=self.header, **options)
+        self._rows = 0
+        self.paths.append(path)
+        return self._writer
+
+    def _close_shard(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._writer = None
+        if self.on_close is not None:
+            self.on_close(self.paths[-1])
+
+    def _full(self):
+        if self.max_rows is not None and self._rows >= self.max_rows:
+            return True
+        return self.max_bytes is not None and os.path.getsize(self.paths[-1]) >= self.max_bytes
+
+    def writerows(self, rows):
+        self._write_chunks(rows, 'writerows')
+
+    def writerecords(self, records):
+        self._write_chunks(records, 'writerecords')
+
+    def _write_chunks(self, rows, method):
+        rows = iter(rows)
+        #A shard is only opened once there is a row to put in it
+        for first in rows:
+            writer = self._writer or self._open()
+            room = self.max_rows - self._rows if self.max_rows is not None else None
+            chunk = chain((first,), islice(rows, None if room is None else room - 1))
+            counter = count()
+            getattr(writer, method)(map(itemgetter(0), zip(chunk, counter)))
+            written = next(counter)
+            self._rows += written
+            if self._full():
+                self._close_shard()
+            if room is None or written < room:
+                return
+
+    def write_columns(self, batch):
+        if not len(batch):
+            return
+        if self._writer is not None and self.max_rows is not None and self._rows + len(batch) > self.max_rows:
+            self._close_shard()
+        writer = self._writer or self._open()
+        writer.write_columns(batch)
+        self._rows += len(batch)
+        if self._full():
+            self._close_shard()
+
+    def close(self):
+        #An empty table still gets one (header only) shard, so its load replaces the old rows
+        if not self.paths:
+            self._open()
+        self._close_shard()
+
+
+WRITERS = {'csv': CsvTableWriter, 'parquet': ParquetTableWriter}
+
+
+def get_writer(output_format):
+    try:
+        return WRITERS[output_format]
+    except KeyError:
+        raise ValueError(f"Unknown output format {output_format}, expected one of {sorted(WRITERS)}")